@@ -9,6 +9,8 @@ import Queue
 
 import collections
 
+from corpus import load_corpus, load_corpus_statistics
+
 logger = logging.getLogger(__name__)
 
 class SSFetcher(threading.Thread):
@@ -18,16 +20,51 @@ class SSFetcher(threading.Thread):
         self.rng = numpy.random.RandomState(self.parent.seed)
         self.indexes = numpy.arange(parent.data_len)
 
-    def run(self):
+        # Position (epoch, offset) at which the last generated batch starts, and the position to start from
+        self.cursor = None
+        self.start_cursor = parent.start_cursor
+
+        # Indexes of the dialogues of the last generated batch
+        self.batch_indexes = []
+
+    def iter_batches(self):
+        """
+        Generates batches of 'batch_size' dialogues in shuffled order.
+        The generator stops at the end of the data, unless the parent iterator loops infinitely.
+
+        Before each batch is generated, its position (epoch, offset) is stored in 'cursor',
+        and the indexes of its dialogues in 'batch_indexes'.
+        If the fetcher was created with a 'start_cursor', the generator continues from that position.
+        """
+        for batch_indexes in self.iter_batch_indexes():
+            self.batch_indexes = batch_indexes
+            yield [[self.parent.get_dialogue(index)] for index in batch_indexes]
+
+    def iter_batch_indexes(self):
+        """
+        Generates the indexes of the dialogues of the batches generated by iter_batches, without
+        loading the dialogues. Before each batch is generated, its position is stored in 'cursor'.
+        """
         diter = self.parent
-        self.rng.shuffle(self.indexes)
+        if diter.length_buckets > 0:
+            for batch_indexes in self.iter_bucketed_batch_indexes():
+                yield batch_indexes
+            return
+
+        epoch, offset = 0, 0
+        if self.start_cursor:
+            epoch, offset = self.start_cursor
+
+        # The indexes are reshuffled every epoch, so all shuffles up to the epoch are repeated
+        for i in range(epoch + 1):
+            self.shuffle_indexes()
 
-        offset = 0 
         while not diter.exit_flag:
             last_batch = False
-            dialogues = []
+            batch_indexes = []
+            self.cursor = (epoch, offset)
 
-            while len(dialogues) < diter.batch_size:
+            while len(batch_indexes) < diter.batch_size:
                 if offset == diter.data_len:
                     if not diter.use_infinite_loop:
                         last_batch = True
@@ -35,30 +72,112 @@ class SSFetcher(threading.Thread):
                     else:
                         # Infinite loop here, we reshuffle the indexes
                         # and reset the offset
-                        self.rng.shuffle(self.indexes)
+                        self.shuffle_indexes()
                         offset = 0
+                        epoch += 1
 
                 index = self.indexes[offset]
-                s = diter.data[index]
-
-                # Flatten if this is a list of lists
-                if len(s) > 0:
-                    if isinstance(s[0], list):
-                        s = [item for sublist in s for item in sublist]
-
                 offset += 1
 
                 # Append only if it is shorter than max_len
-                if diter.max_len == -1 or len(s) <= diter.max_len:
-                    dialogues.append([s])
+                if diter.max_len == -1 or diter.lengths[index] <= diter.max_len:
+                    batch_indexes.append(index)
 
-            if len(dialogues):
-                diter.queue.put(dialogues)
+            if len(batch_indexes):
+                yield batch_indexes
 
             if last_batch:
-                diter.queue.put(None)
                 return
 
+    def shuffle_indexes(self):
+        """
+        Shuffles the order of the dialogues. Compressed corpora are shuffled block by block,
+        so that each block is decoded only once per epoch, and mixed corpora are sampled
+        according to the weights of their sources.
+        """
+        if hasattr(self.parent.data, 'shuffle_order'):
+            self.indexes = self.parent.data.shuffle_order(self.rng)
+        else:
+            self.rng.shuffle(self.indexes)
+
+    def iter_bucketed_batch_indexes(self):
+        """
+        Generates the indexes of batches of dialogues of similar length. Every epoch the dialogues are shuffled,
+        grouped into their length buckets and cut into batches, and the batches of all buckets
+        are shuffled together. The dialogues of a compressed corpus are bucketed inside each window of
+        blocks (see CompressedCorpus.shuffle_windows), and the batches are only shuffled within their
+        window, so that each block is still decoded only once per epoch.
+        """
+        diter = self.parent
+        usable = numpy.arange(diter.data_len)
+        if diter.max_len != -1:
+            usable = usable[diter.lengths <= diter.max_len]
+        if hasattr(diter.data, 'shuffle_order'):
+            usable = None
+
+        epoch, offset = 0, 0
+        if self.start_cursor:
+            epoch, offset = self.start_cursor
+
+        # Batches of previous epochs are planned again (and discarded) to bring the rng to the same state
+        for i in range(epoch):
+            self.plan_bucketed_epoch(usable)
+
+        while not diter.exit_flag:
+            batches = self.plan_bucketed_epoch(usable)
+
+            for position in range(offset, len(batches)):
+                if diter.exit_flag:
+                    return
+                self.cursor = (epoch, position)
+                yield batches[position]
+
+            if not diter.use_infinite_loop or not len(batches):
+                return
+            epoch, offset = epoch + 1, 0
+
+    def plan_bucketed_epoch(self, usable):
+        diter = self.parent
+        if usable is None:
+            if hasattr(diter.data, 'shuffle_windows'):
+                windows = diter.data.shuffle_windows(self.rng)
+            else:
+                windows = [diter.data.shuffle_order(self.rng)]
+            if diter.max_len != -1:
+                windows = [window[diter.lengths[window] <= diter.max_len] for window in windows]
+        else:
+            windows = [usable[self.rng.permutation(len(usable))]]
+
+        batches = []
+        for window in windows:
+            window_batches = self.cut_bucketed_batches(window)
+            self.rng.shuffle(window_batches)
+            batches.extend(window_batches)
+        return batches
+
+    def cut_bucketed_batches(self, order):
+        """
+        Groups the dialogues of a shuffled order into their length buckets, and cuts each bucket into batches.
+        """
+        diter = self.parent
+        # A stable sort keeps the shuffled order inside each bucket
+        order = order[numpy.argsort(diter.bucket_ids[order], kind='mergesort')]
+
+        bucket_starts = numpy.searchsorted(diter.bucket_ids[order], numpy.arange(diter.length_buckets + 1))
+        batches = []
+        for bucket in range(diter.length_buckets):
+            for start in range(bucket_starts[bucket], bucket_starts[bucket + 1], diter.batch_size):
+                batches.append(order[start:min(start + diter.batch_size, bucket_starts[bucket + 1])])
+        return batches
+
+    def run(self):
+        diter = self.parent
+        for dialogues in self.iter_batches():
+            diter.queue.put((self.cursor, dialogues, diter.count_source_tokens(self.batch_indexes)))
+
+        if not diter.exit_flag:
+            diter.queue.put(None)
+
 class SSIterator(object):
     def __init__(self,
                  dialogue_file,
@@ -66,6 +185,9 @@ class SSIterator(object):
                  seed,
                  max_len=-1,
                  use_infinite_loop=True,
+                 length_buckets=0,
+                 eos_sym=1,
+                 corpus_weights=None,
                  dtype="int32"):
 
         self.dialogue_file = dialogue_file
@@ -77,11 +199,51 @@ class SSIterator(object):
         self.load_files()
         self.exit_flag = False
 
+        # Position (epoch, offset) of the last batch returned by next, and the position to start from
+        self.cursor = None
+        self.start_cursor = None
+
+        # Tokens of the batches returned by next from each corpus of a mixed corpus
+        self.source_tokens = numpy.zeros(len(getattr(self.data, 'sources', [])), dtype='int64')
+
     def load_files(self):
-        self.data = cPickle.load(open(self.dialogue_file, 'rb'))
+        self.data = load_corpus(self.dialogue_file, self.corpus_weights)
         self.data_len = len(self.data)
         logger.debug('Data len is %d' % self.data_len)
 
+        # Dialogue lengths are loaded from the corpus statistics, and used to sample batches from length buckets
+        self.statistics = load_corpus_statistics(self.dialogue_file, self.eos_sym, self.data)
+        self.lengths = self.statistics['lengths']
+        self.nested = bool(self.statistics['nested'])
+
+        # Bucket boundaries are length quantiles, so that all buckets hold about the same number of dialogues
+        self.bucket_ids = numpy.zeros(self.data_len, dtype='int64')
+        if self.length_buckets > 0 and self.data_len > 0:
+            boundaries = numpy.percentile(self.lengths, numpy.linspace(0, 100, self.length_buckets + 1)[1:-1])
+            self.bucket_ids = numpy.searchsorted(boundaries, self.lengths, side='right')
+            logger.debug('Length bucket boundaries are %s' % boundaries)
+
+    def count_source_tokens(self, indexes):
+        """
+        Returns the number of tokens of the given dialogues from each source of a mixed corpus,
+        or None for other corpora.
+        """
+        if not len(self.source_tokens):
+            return None
+        indexes = numpy.asarray(indexes, dtype='int64')
+        return numpy.bincount(self.data.source_ids(indexes), weights=self.lengths[indexes], \
+                              minlength=len(self.source_tokens)).astype('int64')
+
+    def get_dialogue(self, index):
+        s = self.data[index]
+
+        # Flatten if this is a list of lists.
+        # Dialogues from a flat corpus are zero-copy array slices and are never nested.
+        if self.nested and len(s) > 0:
+            if isinstance(s[0], list):
+                s = [item for sublist in s for item in sublist]
+        return s
+
     def start(self):
         self.exit_flag = False
         self.queue = Queue.Queue(maxsize=1000)
@@ -89,6 +251,9 @@ class SSIterator(object):
         self.gather.daemon = True
         self.gather.start()
 
+        # The start position only applies to the first pass
+        self.start_cursor = None
+
     def __del__(self):
         if hasattr(self, 'gather'):
             self.gather.exitFlag = True
@@ -101,7 +266,12 @@ class SSIterator(object):
         if self.exit_flag:
             return None
         
-        batch = self.queue.get()
-        if not batch:
+        item = self.queue.get()
+        if not item:
             self.exit_flag = True
+            return None
+
+        self.cursor, batch, source_tokens = item
+        if source_tokens is not None:
+            self.source_tokens += source_tokens
         return batch
@@ -0,0 +1,96 @@
+"""
+Benchmarks the splitting of padded batches into truncated BPTT segments.
+
+The script creates random dialogues, pads them into full batches and splits each
+full batch into segments of 'max_grad_steps' tokens, both with the previous strategy
+(a deep copy of the full batch per segment) and with split_batch_into_segments
+(views into the full batch). For each strategy it reports the number of bytes
+allocated per yielded segment and the time per segment.
+
+Usage example:
+
+    python benchmark-segment-splitting.py --bs 80 --max_grad_steps 80 --mean_dialogue_length 800
+"""
+
+import argparse
+import copy
+import math
+import time
+
+import numpy
+
+from data_iterator import create_padded_batch, split_batch_into_segments
+
+def split_with_deepcopy(state, full_batch, allocated):
+    """
+    The previous splitting strategy. Every segment starts as a deep copy of the full batch,
+    whose matrices are then replaced by slices of the full batch.
+    """
+    splits = int(math.ceil(float(full_batch['max_length']) / float(state['max_grad_steps'])))
+    batches = []
+    for i in range(0, splits):
+        batch = copy.deepcopy(full_batch)
+        allocated[0] += sum(v.nbytes for v in batch.values() if isinstance(v, numpy.ndarray))
+
+        start_pos = state['max_grad_steps'] * i
+        if start_pos > 0:
+            start_pos = start_pos - 1
+        end_pos = min(full_batch['max_length'], state['max_grad_steps'] * (i + 1))
+
+        batch['x'] = full_batch['x'][start_pos:end_pos, :]
+        batch['x_reversed'] = full_batch['x_reversed'][start_pos:end_pos, :]
+        batch['x_mask'] = full_batch['x_mask'][start_pos:end_pos, :]
+        batch['max_length'] = end_pos - start_pos
+        batch['num_preds'] = numpy.sum(batch['x_mask']) - numpy.sum(batch['x_mask'][0,:])
+        batch['num_dialogues'] = float(full_batch['num_dialogues']) / float(splits)
+        batch['x_reset'] = numpy.ones(state['bs'], dtype='float32')
+        allocated[0] += batch['x_reset'].nbytes
+
+        batches.append(batch)
+
+    if len(batches) > 0:
+        batches[len(batches)-1]['x_reset'] = numpy.zeros(state['bs'], dtype='float32')
+        allocated[0] += batches[len(batches)-1]['x_reset'].nbytes
+
+    return batches
+
+def split_with_views(state, full_batch, allocated):
+    batches = split_batch_into_segments(state, full_batch)
+    for batch in batches:
+        # Only arrays which own their memory were allocated for the segment
+        allocated[0] += sum(v.nbytes for v in batch.values() if isinstance(v, numpy.ndarray) and v.base is None)
+    return batches
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark splitting of batches into truncated BPTT segments")
+    parser.add_argument("--bs", type=int, default=80, help="Batch size")
+    parser.add_argument("--max_grad_steps", type=int, default=80, help="Maximum number of tokens per segment")
+    parser.add_argument("--mean_dialogue_length", type=int, default=800, help="Mean number of tokens per dialogue")
+    parser.add_argument("--batches", type=int, default=20, help="Number of full batches to split")
+    parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    state = {'bs': args.bs, 'max_grad_steps': args.max_grad_steps, 'eos_sym': 1}
+
+    rng = numpy.random.RandomState(args.seed)
+    full_batches = []
+    for i in range(args.batches):
+        lengths = rng.randint(args.mean_dialogue_length / 2, args.mean_dialogue_length * 3 / 2 + 1, size=args.bs)
+        dialogues = [rng.randint(0, 100, size=length).astype('int32') for length in lengths]
+        full_batches.append(create_padded_batch(state, rng, [dialogues]))
+
+    for name, split in [('deepcopy (before)', split_with_deepcopy), ('views (after)', split_with_views)]:
+        allocated = [0]
+        segments = 0
+        start = time.time()
+        for full_batch in full_batches:
+            segments += len(split(state, full_batch, allocated))
+        elapsed = time.time() - start
+
+        print "%-18s segments %6d  bytes allocated per segment %12.1f  time per segment %8.4f ms" \
+            % (name, segments, float(allocated[0]) / segments, 1000. * elapsed / segments)
+
+if __name__ == "__main__":
+    main()
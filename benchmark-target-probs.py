@@ -0,0 +1,128 @@
+"""
+Benchmarks the training and evaluation functions of a model, in particular the extraction
+of the target word probabilities from the output softmax and the adaptive softmax.
+
+The script builds the model of a prototype, creates random dialogues with words drawn by their
+frequency in the dictionary, pads them into full batches and splits them into segments of
+'max_grad_steps' tokens. It then reports the compile time, the time per segment of train_fn
+and eval_fn, and the peak memory of the process.
+
+The target probabilities are extracted either with the previous strategy (the diagonal of an
+(N x N) matrix, for N = max_grad_steps x bs) or with GrabProbs (indexing one probability per row).
+The peak memory is measured for the whole process, so run the script once for each strategy:
+
+    python benchmark-target-probs.py --target_extraction diag --bs 80 --max_grad_steps 80
+    python benchmark-target-probs.py --target_extraction index --bs 80 --max_grad_steps 80
+
+To compare the full softmax with the adaptive softmax on a large vocabulary:
+
+    python benchmark-target-probs.py --dictionary <large dictionary> --bs 80 --max_grad_steps 80
+    python benchmark-target-probs.py --dictionary <large dictionary> --adaptive_softmax_cutoffs 2000,10000 --bs 80 --max_grad_steps 80
+"""
+
+import argparse
+import resource
+import time
+
+import numpy
+import theano
+import theano.tensor as T
+
+import dialog_encdec
+from data_iterator import create_padded_batch, split_batch_into_segments, add_random_variables_to_batch
+from state import *
+
+def grab_probs_diag(classProbs, target, gRange=None):
+    """
+    The previous extraction strategy, which builds an (N x N) matrix and keeps its diagonal.
+    """
+    if classProbs.ndim > 2:
+        classProbs = classProbs.reshape((classProbs.shape[0] * classProbs.shape[1], classProbs.shape[2]))
+    if target.ndim > 1:
+        target = target.flatten()
+    return T.diag(classProbs.T[target])
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark train_fn and eval_fn of a model")
+    parser.add_argument("--prototype", type=str, default="prototype_test", help="Prototype state of the model")
+    parser.add_argument("--target_extraction", type=str, default="index", choices=["diag", "index"], help="Extraction of the target probabilities")
+    parser.add_argument("--dictionary", type=str, default="", help="Dictionary of the model (default: the dictionary of the prototype)")
+    parser.add_argument("--adaptive_softmax_cutoffs", type=str, default="", help="Comma separated cutoffs of the adaptive softmax (default: full softmax)")
+    parser.add_argument("--bs", type=int, default=80, help="Batch size")
+    parser.add_argument("--max_grad_steps", type=int, default=80, help="Maximum number of tokens per segment")
+    parser.add_argument("--mean_dialogue_length", type=int, default=400, help="Mean number of tokens per dialogue")
+    parser.add_argument("--batches", type=int, default=2, help="Number of full batches")
+    parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    state = eval(args.prototype)()
+    state['bs'] = args.bs
+    state['max_grad_steps'] = args.max_grad_steps
+    state['function_cache_dir'] = ''
+    if args.dictionary:
+        state['dictionary'] = args.dictionary
+    if args.adaptive_softmax_cutoffs:
+        state['adaptive_softmax_cutoffs'] = [int(cutoff) for cutoff in args.adaptive_softmax_cutoffs.split(',')]
+
+    if args.target_extraction == 'diag':
+        dialog_encdec.GrabProbs = grab_probs_diag
+
+    start = time.time()
+    model = dialog_encdec.DialogEncoderDecoder(state)
+    if state['use_nce']:
+        train_fn = model.build_nce_function()
+    else:
+        train_fn = model.build_train_function()
+    eval_fn = model.build_eval_function()
+    compile_time = time.time() - start
+    memory_after_compile = peak_memory()
+
+    rng = numpy.random.RandomState(args.seed)
+    word_probs = None
+    if numpy.sum(model.word_freq) > 0:
+        word_probs = model.word_freq / float(numpy.sum(model.word_freq))
+    segments = []
+    for i in range(args.batches):
+        lengths = rng.randint(args.mean_dialogue_length / 2, args.mean_dialogue_length * 3 / 2 + 1, size=args.bs)
+        dialogues = [rng.choice(model.idim, size=length, p=word_probs).astype('int32') for length in lengths]
+        for dialogue in dialogues:
+            dialogue[rng.rand(len(dialogue)) < 0.1] = state['eos_sym']
+        prev_batch = None
+        for batch in split_batch_into_segments(state, create_padded_batch(state, rng, [dialogues])):
+            prev_batch = add_random_variables_to_batch(state, rng, batch, prev_batch, False)
+            segments.append(prev_batch)
+
+    def inputs(batch):
+        return [batch['x'], batch['x_reversed'], batch['max_length'], batch['x_mask'], batch['x_reset'], \
+                batch['ran_var_constutterance'], batch['ran_decoder_drop_mask'], batch['x_dialogue_reset']]
+
+    start = time.time()
+    for batch in segments:
+        if state['use_nce']:
+            y_neg = rng.choice(size=(10, batch['max_length'], batch['x'].shape[1]), a=model.idim, p=model.noise_probs).astype('int32')
+            train_fn(*(inputs(batch)[:2] + [y_neg] + inputs(batch)[2:]))
+        else:
+            train_fn(*inputs(batch))
+    train_time = time.time() - start
+
+    start = time.time()
+    for batch in segments:
+        eval_fn(*inputs(batch))
+    eval_time = time.time() - start
+
+    name = args.target_extraction
+    if state['adaptive_softmax_cutoffs']:
+        name = 'adaptive'
+
+    print "%-8s idim %6d  segments %4d  compile %7.1f s  train_fn %9.2f ms  eval_fn %9.2f ms  peak memory %8.1f MB (%8.1f MB after compiling)" \
+        % (name, model.idim, len(segments), compile_time, 1000. * train_time / len(segments), \
+           1000. * eval_time / len(segments), peak_memory(), memory_after_compile)
+
+if __name__ == "__main__":
+    main()
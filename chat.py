@@ -91,7 +91,7 @@ def main():
     
     logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
      
-    model = DialogEncoderDecoder(state)
+    model = DialogEncoderDecoder(state, inference_only=True)
     if os.path.isfile(model_path):
         logger.debug("Loading previous model")
         model.load(model_path)
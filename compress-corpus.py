@@ -0,0 +1,35 @@
+"""
+Converts a binarized dialogue corpus (pkl file, flat or compressed corpus) to a compressed corpus,
+which stores the dialogues in zlib-compressed blocks of varint-encoded token ids.
+The data iterator reads compressed corpora block by block (see corpus.py).
+
+Usage example:
+
+    python compress-corpus.py Training.dialogues.pkl Training.dialogues
+"""
+
+import argparse
+import logging
+import os
+
+from corpus import BLOCK_TOKENS, corpus_files, load_corpus, save_compressed_corpus
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('compress-corpus')
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input", type=str, help="Binarized dialogue corpus (pkl file or prefix of a flat or compressed corpus)")
+parser.add_argument("output", type=str, help="Prefix of the compressed corpus (<output>.blocks.bin and <output>.blocks.npz)")
+parser.add_argument("--block_tokens", type=int, default=BLOCK_TOKENS, help="Number of tokens per compressed block")
+parser.add_argument("--level", type=int, default=6, help="zlib compression level")
+args = parser.parse_args()
+
+if not all(os.path.isfile(filename) for filename in corpus_files(args.input)):
+    raise Exception("Input file not found!")
+
+data = load_corpus(args.input)
+save_compressed_corpus(args.output, data, args.block_tokens, args.level)
+
+input_size = sum(os.path.getsize(filename) for filename in corpus_files(args.input))
+output_size = sum(os.path.getsize(filename) for filename in corpus_files(args.output))
+logger.info("Compressed %d dialogues from %d to %d bytes (%.2f)" % (len(data), input_size, output_size, float(output_size) / max(1, input_size)))
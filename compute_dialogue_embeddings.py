@@ -116,7 +116,7 @@ def main():
 
     state['bs'] = 10
 
-    model = DialogEncoderDecoder(state) 
+    model = DialogEncoderDecoder(state, inference_only=True)
     
     if os.path.isfile(model_path):
         logger.debug("Loading previous model")
@@ -3,10 +3,36 @@ Takes as input a dialogue file and creates a processed version of it.
 If given an external dictionary, the input dialogue file will be converted
 using that input dictionary.
 
+The input file is split into chunks of whole lines (byte ranges), which are
+processed in parallel by a pool of worker processes. In a first pass the workers
+count the dialogues, tokens and (unless an external dictionary is given) word
+frequencies of each chunk. In a second pass each worker converts its chunks to
+token ids and writes them directly into its part of the flat corpus files,
+so the memory usage of the workers only depends on the chunk size. The workers
+also compute the corpus statistics of their chunks, which the main process
+concatenates without reading the corpus again; they hold a few numbers per
+dialogue and utterance. Without --flat, the flat corpus is finally converted
+into a pickled list of dialogues, which holds the whole corpus in memory.
+
+With --approximate_counts, the first pass does not merge the exact word counts
+of all chunks. Instead the most frequent words are found with a count-min sketch
+and a SpaceSaving summary of fixed size (see sketch.py), and only these candidates
+are counted exactly in an additional pass to build the vocabulary. A word which is
+not monitored by the summary occurs at most as often as its smallest count, so the
+'cutoff' most frequent words are only guaranteed to be found if that count is below
+the 'cutoff'-th largest lower bound of the candidates. Otherwise a warning is logged,
+and --candidates should be raised.
+
+With --extend_dict, the input file is a new shard of dialogues for an existing
+dictionary. Only the shard is binarized, and its word and document frequencies
+are added to those of the existing dictionary. The ids of all existing words stay
+the same, so that trained models remain compatible with the extended dictionary.
+
 @author Alessandro Sordoni, Iulian Vlad Serban
 """
 
 import collections
+import multiprocessing
 import numpy
 import operator
 import os
@@ -15,6 +41,10 @@ import logging
 import cPickle
 
 from collections import Counter
+from corpus import allocate_flat_corpus, load_corpus, corpus_files, TOKENS_SUFFIX, OFFSETS_SUFFIX
+from corpus import compute_corpus_statistics, concatenate_corpus_statistics, save_corpus_statistics
+from sketch import CountMinSketch, SpaceSaving
+from vocabulary import Vocabulary
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('text2dict')
@@ -24,31 +54,199 @@ def safe_pickle(obj, filename):
         logger.info("Overwriting %s." % filename)
     else:
         logger.info("Saving to %s." % filename)
-    
+
     with open(filename, 'wb') as f:
         cPickle.dump(obj, f, protocol=cPickle.HIGHEST_PROTOCOL)
 
+def get_chunks(filename, chunk_size):
+    """
+    Splits a file into byte ranges of about 'chunk_size' bytes, which end at line boundaries.
+    """
+    size = os.path.getsize(filename)
+    chunks = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+def read_dialogues(chunk):
+    """
+    Generates the words of each dialogue (line) in a byte range of the input file.
+    """
+    start, end = chunk
+    with open(args.input, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            dialogue_words = f.readline().strip().split()
+            if dialogue_words[len(dialogue_words)-1] != '</s>':
+                dialogue_words.append('</s>')
+            yield dialogue_words
+
+def count_chunk(chunk):
+    """
+    Returns the number of dialogues and tokens of a chunk, and the frequency of each word
+    if the dictionary is created from the input file. With approximate counts, the word
+    frequencies are returned as a SpaceSaving summary and a count-min sketch, which are
+    updated whenever the exact counts reach 'candidates' distinct words, so that the
+    memory usage does not depend on the number of distinct words of the chunk.
+    """
+    word_counter = Counter() if args.dict == "" and (args.extend_dict == "" or args.new_words > 0) else None
+    if args.approximate_counts:
+        summary = SpaceSaving(args.candidates)
+        sketch = CountMinSketch(args.sketch_width, args.sketch_depth)
+
+    num_dialogues = 0
+    num_tokens = 0
+    for dialogue_words in read_dialogues(chunk):
+        num_dialogues += 1
+        num_tokens += len(dialogue_words)
+        if word_counter is not None:
+            word_counter.update(dialogue_words)
+            if args.approximate_counts and len(word_counter) >= args.candidates:
+                summary.update(word_counter)
+                sketch.update(word_counter.keys(), word_counter.values())
+                word_counter = Counter()
+
+    if args.approximate_counts:
+        summary.update(word_counter)
+        sketch.update(word_counter.keys(), word_counter.values())
+        return num_dialogues, num_tokens, (summary, sketch)
+    return num_dialogues, num_tokens, word_counter
+
+def count_candidates(chunk):
+    """
+    Returns the exact frequencies of the candidate words in a chunk.
+    """
+    word_counter = Counter()
+    for dialogue_words in read_dialogues(chunk):
+        word_counter.update([word for word in dialogue_words if word in candidates])
+    return word_counter
+
+def binarize_chunk(task):
+    """
+    Converts the dialogues of a chunk to token ids and writes them into the flat corpus,
+    starting at the given dialogue and token positions. Returns the word frequencies,
+    document frequencies, number of unknowns and corpus statistics of the chunk.
+    """
+    chunk, first_dialogue, first_token = task
+    tokens = numpy.load(flat_output + TOKENS_SUFFIX, mmap_mode='r+')
+    offsets = numpy.load(flat_output + OFFSETS_SUFFIX, mmap_mode='r+')
+
+    dialogue_word_ids = []
+    lengths = []
+    for dialogue_words in read_dialogues(chunk):
+        dialogue_word_ids.extend([vocab.get(word, 0) for word in dialogue_words])
+        lengths.append(len(dialogue_words))
+
+    word_ids = numpy.asarray(dialogue_word_ids, dtype='int64')
+    lengths = numpy.asarray(lengths, dtype='int64')
+    tokens[first_token:first_token + len(word_ids)] = word_ids
+    offsets[first_dialogue + 1:first_dialogue + len(lengths) + 1] = first_token + numpy.cumsum(lengths)
+    tokens.flush()
+    offsets.flush()
+
+    freqs = numpy.bincount(word_ids, minlength=len(vocab))
+
+    # Document frequency counts each (dialogue, word) pair once
+    dialogue_ids = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    pairs = numpy.unique(dialogue_ids * len(vocab) + word_ids)
+    df = numpy.bincount(pairs % len(vocab), minlength=len(vocab))
+
+    # The statistics of the chunks are concatenated by the main process, which does not read the corpus again
+    statistics = compute_corpus_statistics(numpy.split(word_ids, numpy.cumsum(lengths)[:-1]), vocab['</s>'])
+
+    return freqs, df, int(freqs[0]), statistics
+
 import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument("input", type=str, help="Dialogue file; assumed shuffled with one document (e.g. one movie dialogue, or one Twitter conversation or one Ubuntu conversation) per line")
 parser.add_argument("--cutoff", type=int, default=-1, help="Vocabulary cutoff (optional)")
 parser.add_argument("--dict", type=str, default="", help="External dictionary (pkl file)")
+parser.add_argument("--extend_dict", type=str, default="", help="Existing dictionary (pkl file) to extend with the word and document frequencies of the input file")
+parser.add_argument("--new_words", type=int, default=0, help="Number of the most frequent unknown words of the input file added to the extended dictionary, with new ids after the existing ones (the model vocabulary size has to be increased to use them)")
+parser.add_argument("--flat", action="store_true", default=False, help="If on, the binarized dialogues are saved as a flat corpus (<output>.dialogues.tokens.npy and <output>.dialogues.offsets.npy), which is memory-mapped by the data iterator, instead of a pickle file")
+parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Number of worker processes")
+parser.add_argument("--chunk_size", type=int, default=64, help="Size of the chunks of the input file processed by the workers (in MB)")
+parser.add_argument("--approximate_counts", action="store_true", default=False, help="If on, the candidates for the vocabulary are found with approximate counts in fixed memory and counted exactly afterwards (requires --cutoff)")
+parser.add_argument("--candidates", type=int, default=-1, help="Number of words monitored with approximate counts (default four times the cutoff, at least twice the cutoff)")
+parser.add_argument("--sketch_width", type=int, default=2**20, help="Number of counters per row of the count-min sketch")
+parser.add_argument("--sketch_depth", type=int, default=4, help="Number of rows of the count-min sketch")
 parser.add_argument("output", type=str, help="Prefix of the pickle binarized dialogue corpus")
 args = parser.parse_args()
 
 if not os.path.isfile(args.input):
     raise Exception("Input file not found!")
 
+if args.dict != "" and args.extend_dict != "":
+    raise Exception("Use either an external dictionary or a dictionary to extend!")
+
+if args.approximate_counts:
+    if args.cutoff == -1 or args.dict != "" or args.extend_dict != "":
+        raise Exception("Approximate counts require a vocabulary cutoff and no external dictionary!")
+    if args.candidates == -1:
+        args.candidates = 4 * args.cutoff
+    # With few monitored words, the summary misses words of the vocabulary without any warning
+    if args.candidates < 2 * args.cutoff:
+        raise Exception("Approximate counts require at least twice as many candidates as the cutoff!")
+
 unk = "<unk>"
 
+chunks = get_chunks(args.input, args.chunk_size * 1024 * 1024)
+logger.info("Processing %d chunks with %d workers" % (len(chunks), args.workers))
+
+pool = multiprocessing.Pool(args.workers)
+chunk_counts = []
+word_counter = Counter()
+summary, sketch = SpaceSaving(args.candidates), None
+for num_dialogues, num_tokens, chunk_counter in pool.imap(count_chunk, chunks):
+    chunk_counts.append((num_dialogues, num_tokens))
+    if args.approximate_counts:
+        summary.merge(chunk_counter[0])
+        if sketch:
+            sketch.merge(chunk_counter[1])
+        else:
+            sketch = chunk_counter[1]
+    elif chunk_counter is not None:
+        word_counter.update(chunk_counter)
+pool.close()
+pool.join()
+
+if args.approximate_counts:
+    # A word can only be among the 'cutoff' most frequent words, if the upper bound of its count
+    # (from the summary and the sketch) reaches the 'cutoff'-th largest lower bound.
+    candidates = summary.counts.keys()
+    lower_bounds = summary.lower_bounds()
+    upper_bounds = numpy.minimum(sketch.estimate(candidates), [summary.counts[word] for word in candidates])
+    threshold = sorted(lower_bounds.values(), reverse=True)[min(args.cutoff, len(candidates)) - 1] if len(candidates) else 0
+    candidates = set(word for word, upper_bound in zip(candidates, upper_bounds) if upper_bound >= threshold)
+    # Words which are not monitored occur at most 'min_count' times, and may be missing from the vocabulary
+    if summary.min_count > 0 and summary.min_count >= threshold:
+        logger.warning("Words which are not monitored may occur up to %d times, as often as the %d-th candidate word (%d times); " \
+                       "the vocabulary may miss frequent words, raise --candidates" % (summary.min_count, args.cutoff, threshold))
+    logger.info("Counting %d candidate words exactly" % len(candidates))
+    del summary, sketch, lower_bounds, upper_bounds
+
+    pool = multiprocessing.Pool(args.workers)
+    for chunk_counter in pool.imap_unordered(count_candidates, chunks):
+        word_counter.update(chunk_counter)
+    pool.close()
+    pool.join()
+
 ###############################
 # Part I: Create the dictionary
 ###############################
-if args.dict != "":
-    # Load external dictionary
-    assert os.path.isfile(args.dict)
-    vocab = dict([(x[0], x[1]) for x in cPickle.load(open(args.dict, "rb"))])
-    
+if args.dict != "" or args.extend_dict != "":
+    # Load external dictionary, or the dictionary to extend
+    dict_file = args.dict if args.dict != "" else args.extend_dict
+    assert os.path.isfile(dict_file)
+    vocabulary = Vocabulary.load(dict_file)
+    vocab = dict(vocabulary.str_to_idx)
+
     # Check consistency
     assert '<unk>' in vocab
     assert '</s>' in vocab
@@ -63,26 +261,26 @@ if args.dict != "":
     assert '<off_screen>' in vocab
     assert '<pause>' in vocab
 
-else:
-    word_counter = Counter()
-
-
-    for line in open(args.input, 'r'):
-        line_words = line.strip().split()
-        if line_words[len(line_words)-1] != '</s>':
-            line_words.append('</s>')
-
-        s = [x for x in line_words]
-        word_counter.update(s) 
+    if args.extend_dict != "":
+        # Unknown words are added after all existing words, so that the existing ids do not change
+        new_word_count = sorted([item for item in word_counter.items() if not item[0] in vocab], \
+                                key=lambda item: (-item[1], item[0]))[:args.new_words]
+        i = max(vocab.values()) + 1
+        for (word, count) in new_word_count:
+            vocab[word] = i
+            i += 1
+        logger.info("Extending dictionary %s with %d new words" % (args.extend_dict, len(new_word_count)))
 
-    total_freq = sum(word_counter.values())
-    logger.info("Total word frequency in dictionary %d " % total_freq) 
+else:
+    total_freq = sum(count[1] for count in chunk_counts)
+    logger.info("Total word frequency in dictionary %d " % total_freq)
 
+    # Words of equal frequency are ordered alphabetically, so that the dictionary
+    # does not depend on the order in which the chunk counts were merged
+    vocab_count = sorted(word_counter.items(), key=lambda item: (-item[1], item[0]))
     if args.cutoff != -1:
         logger.info("Cutoff %d" % args.cutoff)
-        vocab_count = word_counter.most_common(args.cutoff)
-    else:
-        vocab_count = word_counter.most_common()
+        vocab_count = vocab_count[:args.cutoff]
 
     # Add special tokens to the vocabulary
     vocab = {'<unk>': 0, '</s>': 1, '</d>': 2, '<first_speaker>': 3, \
@@ -96,51 +294,74 @@ else:
             vocab[word] = i
             i += 1
 
+    del word_counter, vocab_count
+
 logger.info("Vocab size %d" % len(vocab))
 
 #################################
 # Part II: Binarize the dialogues
 #################################
 
-# Everything is loaded into memory for the moment
-binarized_corpus = []
-# Some statistics
-unknowns = 0.
-num_terms = 0.
-freqs = collections.defaultdict(lambda: 0)
+# The dialogues are always written as a flat corpus first, and converted to a pickle file if needed
+flat_output = args.output + ".dialogues"
+num_dialogues = sum(count[0] for count in chunk_counts)
+num_terms = sum(count[1] for count in chunk_counts)
+tokens, offsets = allocate_flat_corpus(flat_output, num_dialogues, num_terms, len(vocab))
+del tokens, offsets
 
-# counts the number of dialogues each unique word exists in; also known as document frequency
-df = collections.defaultdict(lambda: 0)
+# Each chunk is written at the dialogue and token position following the previous chunks
+first_dialogues = numpy.cumsum([0] + [count[0] for count in chunk_counts])
+first_tokens = numpy.cumsum([0] + [count[1] for count in chunk_counts])
+tasks = [(chunk, int(first_dialogues[i]), int(first_tokens[i])) for i, chunk in enumerate(chunks)]
 
-for line, dialogue in enumerate(open(args.input, 'r')):
-    dialogue_words = dialogue.strip().split()
-    if dialogue_words[len(dialogue_words)-1] != '</s>':
-        dialogue_words.append('</s>')
+# Some statistics
+unknowns = 0
+freqs = numpy.zeros(len(vocab), dtype='int64')
 
-    # Convert words to token ids and compute some statistics
-    dialogue_word_ids = []
-    for word in dialogue_words:
-        word_id = vocab.get(word, 0)
-        dialogue_word_ids.append(word_id)
-        unknowns += 1 * (word_id == 0)
-        freqs[word_id] += 1
+# counts the number of dialogues each unique word exists in; also known as document frequency
+df = numpy.zeros(len(vocab), dtype='int64')
 
-    num_terms += len(dialogue_words)
+# The workers are created after the dictionary, which they share with the main process
+pool = multiprocessing.Pool(args.workers)
+chunk_statistics = []
+for chunk_freqs, chunk_df, chunk_unknowns, statistics in pool.imap(binarize_chunk, tasks):
+    freqs += chunk_freqs
+    df += chunk_df
+    unknowns += chunk_unknowns
+    chunk_statistics.append(statistics)
+pool.close()
+pool.join()
 
-    # Compute document frequency statistics
-    unique_word_indices = set(dialogue_word_ids)
-    for word_id in unique_word_indices:
-        df[word_id] += 1
+# The corpus statistics are written next to the corpus, so that they are not recomputed by the data iterator
+if len(chunk_statistics):
+    statistics = concatenate_corpus_statistics(chunk_statistics)
+else:
+    statistics = compute_corpus_statistics([], vocab['</s>'])
+del chunk_statistics
 
-    # Add dialogue to corpus
-    binarized_corpus.append(dialogue_word_ids)
+if args.flat:
+    save_corpus_statistics(flat_output, statistics)
+else:
+    binarized_corpus = [dialogue.tolist() for dialogue in load_corpus(flat_output)]
+    safe_pickle(binarized_corpus, args.output + ".dialogues.pkl")
+    del binarized_corpus
+    for filename in corpus_files(flat_output):
+        os.remove(filename)
+    save_corpus_statistics(args.output + ".dialogues.pkl", statistics)
 
-safe_pickle(binarized_corpus, args.output + ".dialogues.pkl")
+if args.extend_dict != "":
+    # The frequencies of the new shard are added to those of the existing dictionary
+    freqs[:len(vocabulary)] += vocabulary.freqs
+    df[:len(vocabulary)] += vocabulary.dfs
 
 if args.dict == "":
-     safe_pickle([(word, word_id, freqs[word_id], df[word_id]) for word, word_id in vocab.items()], args.output + ".dict.pkl")
+    # The dictionary is saved together with its binary sidecar file, which is loaded by the model
+    logger.info("Saving to %s." % (args.output + ".dict.pkl"))
+    words = sorted(vocab, key=vocab.get)
+    Vocabulary(words, freqs, df).save(args.output + ".dict.pkl")
 
 logger.info("Number of unknowns %d" % unknowns)
 logger.info("Number of terms %d" % num_terms)
-logger.info("Mean document length %f" % float(sum(map(len, binarized_corpus))/len(binarized_corpus)))
-logger.info("Writing training %d dialogues (%d left out)" % (len(binarized_corpus), line + 1 - len(binarized_corpus)))
+logger.info("Number of utterances %d" % numpy.sum(statistics['utterances']))
+logger.info("Mean document length %f" % float(num_terms/num_dialogues))
+logger.info("Writing training %d dialogues" % num_dialogues)
@@ -28,6 +28,7 @@ import cPickle
 import itertools
 from collections import Counter
 from utils import *
+from vocabulary import Vocabulary
 
 from sklearn.decomposition import PCA
 from sklearn import preprocessing
@@ -111,13 +112,13 @@ if not os.path.isfile(args.embedding_dictionary):
 
 
 # Load model dictionary
-model_dict = cPickle.load(open(args.model_dictionary, 'rb'))
+model_vocabulary = Vocabulary.load(args.model_dictionary)
 
-str_to_idx = dict([(tok, tok_id) for tok, tok_id, _, _ in model_dict])
-i_dim = len(str_to_idx.keys())
+str_to_idx = model_vocabulary.str_to_idx
+i_dim = len(model_vocabulary)
 logger.info("Vocabulary size: %d" % i_dim)
 
-word_freq = dict([(tok_id, freq) for _, tok_id, freq, _ in model_dict])
+word_freq = model_vocabulary.freqs
 
 # Load pretrained word embeddings
 if uses_word2vec:
@@ -0,0 +1,469 @@
+"""
+Flat binarized dialogue corpus.
+
+A flat corpus stores all dialogues as one contiguous token array
+'<prefix>.tokens.npy' and an int64 array of dialogue boundaries
+'<prefix>.offsets.npy', such that dialogue i is
+tokens[offsets[i]:offsets[i+1]]. Both arrays are opened as numpy memory maps,
+so loading a corpus is instant and all training and validation processes
+share the same pages of the operating system page cache.
+
+A compressed corpus stores the dialogues in blocks of about BLOCK_TOKENS tokens.
+Each block holds whole consecutive dialogues, with every token id encoded as a
+varint (7 bits per byte) and the block compressed with zlib. The compressed blocks
+are stored back-to-back in '<prefix>.blocks.bin', and '<prefix>.blocks.npz' indexes
+the byte range and first dialogue of each block and the token offsets of all
+dialogues. Any dialogue can be read by decoding its block, and recently decoded
+blocks are cached, so reading the dialogues block by block decodes each block once.
+
+Several corpora can be mixed into one MixedCorpus, which is given by the list of
+their paths and is sampled according to a weight for each corpus.
+
+Statistics of a corpus (flat, compressed or pickled), such as the dialogue lengths and the
+positions of the end-of-utterance tokens, are stored once in a sidecar file
+'<corpus>.stats.npz' and loaded from there by the data iterator and scripts.
+"""
+
+import os
+import cPickle
+import collections
+import itertools
+import logging
+import zlib
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+TOKENS_SUFFIX = '.tokens.npy'
+OFFSETS_SUFFIX = '.offsets.npy'
+STATS_SUFFIX = '.stats.npz'
+BLOCKS_SUFFIX = '.blocks.bin'
+BLOCK_INDEX_SUFFIX = '.blocks.npz'
+
+# Number of tokens per block of a compressed corpus
+BLOCK_TOKENS = 2**16
+
+# Number of tokens processed at once when computing statistics of a flat corpus
+STATS_BLOCK_SIZE = 2**24
+
+def token_dtype(vocab_size):
+    """
+    Returns the smallest token dtype which can hold all word ids of a vocabulary.
+    """
+    if vocab_size <= numpy.iinfo(numpy.uint16).max + 1:
+        return numpy.uint16
+    return numpy.int32
+
+def is_flat_corpus(path):
+    return os.path.isfile(path + TOKENS_SUFFIX) and os.path.isfile(path + OFFSETS_SUFFIX)
+
+class FlatCorpus(object):
+    """
+    Read-only view of a flat corpus. Indexing returns zero-copy slices
+    of the memory-mapped token array.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tokens = numpy.load(path + TOKENS_SUFFIX, mmap_mode='r')
+        self.offsets = numpy.load(path + OFFSETS_SUFFIX, mmap_mode='r')
+
+        if self.offsets.ndim != 1 or len(self.offsets) == 0 or self.offsets[-1] != len(self.tokens):
+            raise ValueError('Malformed flat corpus %s!' % path)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+def allocate_flat_corpus(path, num_dialogues, num_tokens, vocab_size):
+    """
+    Creates the files of a flat corpus with the given number of dialogues and tokens,
+    and returns writable memory maps of its token and offset arrays. The offset array
+    starts with zero, the remaining tokens and offsets are filled in by the caller.
+    Processes may fill in disjoint parts of the arrays in parallel by opening the files
+    with numpy.load(..., mmap_mode='r+').
+    """
+    if os.path.isfile(path + TOKENS_SUFFIX):
+        logger.info("Overwriting %s." % (path + TOKENS_SUFFIX))
+    else:
+        logger.info("Saving to %s." % (path + TOKENS_SUFFIX))
+
+    tokens = numpy.lib.format.open_memmap(path + TOKENS_SUFFIX, mode='w+', dtype=token_dtype(vocab_size), shape=(num_tokens,))
+    offsets = numpy.lib.format.open_memmap(path + OFFSETS_SUFFIX, mode='w+', dtype='int64', shape=(num_dialogues + 1,))
+    offsets[0] = 0
+    return tokens, offsets
+
+def save_flat_corpus(path, dialogues, vocab_size):
+    """
+    Writes a list of dialogues (each a sequence of word ids) as a flat corpus.
+    """
+    lengths = numpy.fromiter((len(dialogue) for dialogue in dialogues), dtype='int64', count=len(dialogues))
+    tokens, offsets = allocate_flat_corpus(path, len(dialogues), int(numpy.sum(lengths)), vocab_size)
+    numpy.cumsum(lengths, out=offsets[1:])
+
+    for index, dialogue in enumerate(dialogues):
+        tokens[offsets[index]:offsets[index + 1]] = dialogue
+    tokens.flush()
+    offsets.flush()
+    del tokens, offsets
+
+def encode_varints(values):
+    """
+    Encodes non-negative integers as varints: 7 bits per byte, least significant bits first,
+    with the high bit set on every byte but the last of each value.
+    """
+    values = numpy.asarray(values, dtype='int64')
+    nbytes = numpy.ones(len(values), dtype='int64')
+    for k in range(1, 9):
+        nbytes += (values >= (1 << (7 * k)))
+    starts = numpy.cumsum(nbytes) - nbytes
+
+    encoded = numpy.zeros(int(numpy.sum(nbytes)), dtype='uint8')
+    for k in range(int(numpy.max(nbytes)) if len(values) else 0):
+        has_byte = (nbytes > k)
+        continues = (nbytes[has_byte] > k + 1) * 0x80
+        encoded[starts[has_byte] + k] = ((values[has_byte] >> (7 * k)) & 0x7f) | continues
+    return encoded
+
+def decode_varints(encoded):
+    """
+    Decodes an array of varints (see encode_varints).
+    """
+    encoded = numpy.asarray(encoded, dtype='uint8')
+    if not len(encoded):
+        return numpy.zeros(0, dtype='int64')
+
+    ends = numpy.flatnonzero(encoded < 0x80)
+    starts = numpy.concatenate([[0], ends[:-1] + 1])
+    value_ids = numpy.repeat(numpy.arange(len(starts)), ends - starts + 1)
+    shifts = 7 * (numpy.arange(len(encoded)) - starts[value_ids])
+    return numpy.add.reduceat((encoded & 0x7f).astype('int64') << shifts, starts)
+
+def is_compressed_corpus(path):
+    return os.path.isfile(path + BLOCKS_SUFFIX) and os.path.isfile(path + BLOCK_INDEX_SUFFIX)
+
+class CompressedCorpus(object):
+    """
+    Read-only view of a compressed corpus. Indexing returns the tokens of a dialogue
+    from its decoded block. The last 'cache_blocks' decoded blocks are kept in memory.
+    """
+    def __init__(self, path, cache_blocks=16):
+        self.path = path
+        index = numpy.load(path + BLOCK_INDEX_SUFFIX)
+        self.offsets = index['offsets']
+        self.block_offsets = index['block_offsets']
+        self.block_dialogues = index['block_dialogues']
+        self.dtype = numpy.dtype(str(index['dtype']))
+        self.blocks = numpy.memmap(path + BLOCKS_SUFFIX, dtype='uint8', mode='r') \
+                      if self.block_offsets[-1] > 0 else numpy.zeros(0, dtype='uint8')
+
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def num_blocks(self):
+        return len(self.block_offsets) - 1
+
+    def block(self, block_id):
+        """
+        Returns the tokens of all dialogues of a block.
+        """
+        if block_id in self.cache:
+            tokens = self.cache.pop(block_id)
+        else:
+            data = zlib.decompress(self.blocks[self.block_offsets[block_id]:self.block_offsets[block_id + 1]].tobytes())
+            tokens = decode_varints(numpy.frombuffer(data, dtype='uint8')).astype(self.dtype)
+            if len(self.cache) >= self.cache_blocks:
+                self.cache.popitem(last=False)
+        self.cache[block_id] = tokens
+        return tokens
+
+    def __getitem__(self, index):
+        block_id = numpy.searchsorted(self.block_dialogues, index, side='right') - 1
+        start = self.offsets[index] - self.offsets[self.block_dialogues[block_id]]
+        return self.block(block_id)[start:start + self.offsets[index + 1] - self.offsets[index]]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def shuffle_windows(self, rng):
+        """
+        Reads the blocks in random order, and returns the shuffled dialogues of each window
+        of 'cache_blocks' consecutive blocks. All blocks of a window fit into the cache, so
+        reading the dialogues of the windows one after another decodes each block only once.
+        """
+        block_order = rng.permutation(self.num_blocks())
+        windows = []
+        for start in range(0, len(block_order), self.cache_blocks):
+            window = [numpy.arange(self.block_dialogues[block_id], self.block_dialogues[block_id + 1]) \
+                      for block_id in block_order[start:start + self.cache_blocks]]
+            window = numpy.concatenate(window)
+            rng.shuffle(window)
+            windows.append(window)
+        return windows
+
+    def shuffle_order(self, rng):
+        """
+        Returns a shuffled order of all dialogues, which decodes each block only once (see shuffle_windows).
+        """
+        return numpy.concatenate([numpy.zeros(0, dtype='int64')] + self.shuffle_windows(rng))
+
+def save_compressed_corpus(path, dialogues, block_tokens=BLOCK_TOKENS, level=6):
+    """
+    Writes a sequence of dialogues (each a sequence of word ids) as a compressed corpus.
+    The dialogues are read once and compressed block by block, so the dialogues may be
+    a FlatCorpus or a generator.
+    """
+    logger.info("Saving to %s." % (path + BLOCKS_SUFFIX))
+    lengths = []
+    block_offsets = [0]
+    block_dialogues = [0]
+    max_token = 0
+
+    blocks = open(path + BLOCKS_SUFFIX, 'wb')
+    block = []
+    block_size = 0
+    for dialogue in itertools.chain(dialogues, [None]):
+        if block_size >= block_tokens or (dialogue is None and len(block)):
+            tokens = numpy.concatenate(block).astype('int64')
+            max_token = max(max_token, int(numpy.max(tokens)) if len(tokens) else 0)
+            data = zlib.compress(encode_varints(tokens).tobytes(), level)
+            blocks.write(data)
+            block_offsets.append(block_offsets[-1] + len(data))
+            block_dialogues.append(len(lengths))
+            block = []
+            block_size = 0
+        if dialogue is None:
+            break
+
+        dialogue = numpy.asarray(dialogue, dtype='int64')
+        block.append(dialogue)
+        block_size += len(dialogue)
+        lengths.append(len(dialogue))
+    blocks.close()
+
+    offsets = numpy.zeros(len(lengths) + 1, dtype='int64')
+    numpy.cumsum(lengths, out=offsets[1:])
+    numpy.savez(path + BLOCK_INDEX_SUFFIX, offsets=offsets, \
+                block_offsets=numpy.array(block_offsets, dtype='int64'), \
+                block_dialogues=numpy.array(block_dialogues, dtype='int64'), \
+                dtype=numpy.dtype(token_dtype(max_token + 1)).name)
+
+class MixedCorpus(object):
+    """
+    Concatenation of several corpora (the sources), where dialogue i of source s has the
+    index starts[s] + i. Each epoch of the order returned by shuffle_order has as many dialogues
+    as all sources together, and draws the source of every dialogue at random according to the
+    source weights. The dialogues of each source are taken from independent shuffles of the source.
+    """
+    def __init__(self, paths, weights=None):
+        self.paths = list(paths)
+        self.sources = [load_corpus(path) for path in self.paths]
+        sizes = numpy.array([len(source) for source in self.sources], dtype='int64')
+        self.starts = numpy.concatenate([[0], numpy.cumsum(sizes)]).astype('int64')
+
+        # By default each source is sampled in proportion to its size, as if the corpora were concatenated
+        if weights is None or not len(weights):
+            weights = sizes
+        if len(weights) != len(self.sources):
+            raise ValueError('Expected one weight per corpus, got %d weights for %d corpora!' % (len(weights), len(self.sources)))
+        self.weights = numpy.asarray(weights, dtype='float64') * (sizes > 0)
+        if len(self) > 0:
+            self.weights /= numpy.sum(self.weights)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, index):
+        source = self.source_ids(index)
+        return self.sources[source][index - self.starts[source]]
+
+    def __iter__(self):
+        for source in self.sources:
+            for dialogue in source:
+                yield dialogue
+
+    def source_ids(self, indexes):
+        return numpy.searchsorted(self.starts, indexes, side='right') - 1
+
+    def shuffle_source(self, source, rng):
+        if hasattr(self.sources[source], 'shuffle_order'):
+            return self.sources[source].shuffle_order(rng)
+        return rng.permutation(len(self.sources[source]))
+
+    def shuffle_order(self, rng):
+        order = numpy.zeros(len(self), dtype='int64')
+        if not len(self):
+            return order
+
+        source_ids = rng.choice(len(self.sources), size=len(self), p=self.weights)
+        seeds = rng.randint(0, 2**31 - 1, size=len(self.sources))
+        for source in range(len(self.sources)):
+            positions = numpy.flatnonzero(source_ids == source)
+            if not len(positions):
+                continue
+
+            # A source with more draws than dialogues is shuffled again for every pass over it
+            source_rng = numpy.random.RandomState(seeds[source])
+            passes = -(-len(positions) // len(self.sources[source]))
+            source_order = numpy.concatenate([self.shuffle_source(source, source_rng) for i in range(passes)])
+            order[positions] = self.starts[source] + source_order[:len(positions)]
+        return order
+
+def corpus_files(path):
+    """
+    Returns the files which store a binarized dialogue corpus.
+    """
+    if isinstance(path, (list, tuple)):
+        return list(itertools.chain.from_iterable(corpus_files(source) for source in path))
+    if is_flat_corpus(path):
+        return [path + TOKENS_SUFFIX, path + OFFSETS_SUFFIX]
+    if is_compressed_corpus(path):
+        return [path + BLOCKS_SUFFIX, path + BLOCK_INDEX_SUFFIX]
+    return [path]
+
+def corpus_signature(path):
+    """
+    Returns the absolute path, size and modification time of each file of a corpus,
+    which changes whenever the corpus is rewritten.
+    """
+    signature = []
+    for filename in corpus_files(path):
+        stat = os.stat(filename)
+        signature.append((os.path.abspath(filename), stat.st_size, stat.st_mtime))
+    return signature
+
+def load_corpus(path, weights=None):
+    """
+    Loads a binarized dialogue corpus, either a flat or compressed corpus (given by its prefix)
+    or a pickled list of dialogues. A list of paths is loaded as a MixedCorpus with the given weights.
+    """
+    if isinstance(path, (list, tuple)):
+        return MixedCorpus(path, weights)
+    if is_flat_corpus(path):
+        return FlatCorpus(path)
+    if is_compressed_corpus(path):
+        return CompressedCorpus(path)
+    return cPickle.load(open(path, 'rb'))
+
+def compute_corpus_statistics(data, eos_sym):
+    """
+    Computes the statistics of a corpus (a FlatCorpus or a list of dialogues):
+
+        lengths           number of tokens of each dialogue
+        offsets           start of each dialogue in the concatenation of all dialogues, and the total number of tokens
+        utterances        number of end-of-utterance tokens of each dialogue
+        eos_positions     positions of all end-of-utterance tokens in the concatenation of all dialogues
+        eos_offsets       start of the end-of-utterance positions of each dialogue in eos_positions
+        length_histogram  number of dialogues of each length
+        nested            whether the dialogues are lists of lists, which have to be flattened
+    """
+    nested = False
+    if isinstance(data, FlatCorpus):
+        lengths = data.lengths()
+        offsets = numpy.asarray(data.offsets, dtype='int64')
+        eos_positions = []
+        for start in xrange(0, len(data.tokens), STATS_BLOCK_SIZE):
+            eos_positions.append(start + numpy.flatnonzero(data.tokens[start:start + STATS_BLOCK_SIZE] == eos_sym))
+    else:
+        lengths = numpy.zeros(len(data), dtype='int64')
+        eos_positions = []
+        offset = 0
+        for index, dialogue in enumerate(data):
+            if len(dialogue) > 0 and isinstance(dialogue[0], list):
+                nested = True
+                dialogue = [item for sublist in dialogue for item in sublist]
+            dialogue = numpy.asarray(dialogue)
+            lengths[index] = len(dialogue)
+            eos_positions.append(offset + numpy.flatnonzero(dialogue == eos_sym))
+            offset += len(dialogue)
+        offsets = numpy.zeros(len(data) + 1, dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+
+    eos_positions = numpy.concatenate([numpy.zeros(0, dtype='int64')] + eos_positions).astype('int64')
+    utterances = numpy.bincount(numpy.searchsorted(offsets, eos_positions, side='right') - 1, minlength=len(lengths))
+    eos_offsets = numpy.zeros(len(lengths) + 1, dtype='int64')
+    numpy.cumsum(utterances, out=eos_offsets[1:])
+
+    return {'lengths': lengths,
+            'offsets': offsets,
+            'utterances': utterances,
+            'eos_positions': eos_positions,
+            'eos_offsets': eos_offsets,
+            'length_histogram': numpy.bincount(lengths),
+            'nested': nested,
+            'eos_sym': eos_sym}
+
+def save_corpus_statistics(path, statistics):
+    """
+    Writes the statistics of a corpus to its sidecar file, together with the signature of the corpus.
+    The file is written under a temporary name and renamed, so readers never see a partial file.
+    """
+    filename = path + STATS_SUFFIX
+    tmp_filename = path + '.stats.tmp%d.npz' % os.getpid()
+    numpy.savez(tmp_filename, signature=repr(corpus_signature(path)), **statistics)
+    os.rename(tmp_filename, filename)
+
+def load_corpus_statistics(path, eos_sym, data=None):
+    """
+    Loads the statistics of a corpus from its sidecar file. If the file does not exist,
+    or the corpus changed since it was written, the statistics are computed (from 'data',
+    if the corpus is already loaded) and the sidecar file is written.
+    The statistics of a list of corpora are those of their concatenation.
+    """
+    if isinstance(path, (list, tuple)):
+        sources = data.sources if data is not None else [None] * len(path)
+        return concatenate_corpus_statistics([load_corpus_statistics(source_path, eos_sym, source) \
+                                              for source_path, source in zip(path, sources)])
+
+    filename = path + STATS_SUFFIX
+    if os.path.isfile(filename):
+        statistics = dict(numpy.load(filename))
+        if str(statistics.pop('signature')) == repr(corpus_signature(path)) and int(statistics['eos_sym']) == eos_sym:
+            return statistics
+        logger.info("Corpus statistics %s are out of date." % filename)
+
+    logger.info("Computing corpus statistics of %s." % path)
+    if data is None:
+        data = load_corpus(path)
+    statistics = compute_corpus_statistics(data, eos_sym)
+    try:
+        save_corpus_statistics(path, statistics)
+    except (IOError, OSError) as e:
+        logger.warning("Could not save corpus statistics to %s: %s" % (filename, e))
+    return statistics
+
+def concatenate_corpus_statistics(statistics):
+    """
+    Returns the statistics of the concatenation of several corpora.
+    """
+    token_starts = numpy.cumsum([0] + [source['offsets'][-1] for source in statistics])
+    eos_starts = numpy.cumsum([0] + [source['eos_offsets'][-1] for source in statistics])
+
+    lengths = numpy.concatenate([source['lengths'] for source in statistics]).astype('int64')
+    offsets = numpy.concatenate([[0]] + [source['offsets'][1:] + token_starts[i] for i, source in enumerate(statistics)])
+    eos_offsets = numpy.concatenate([[0]] + [source['eos_offsets'][1:] + eos_starts[i] for i, source in enumerate(statistics)])
+
+    return {'lengths': lengths,
+            'offsets': offsets.astype('int64'),
+            'utterances': numpy.concatenate([source['utterances'] for source in statistics]).astype('int64'),
+            'eos_positions': numpy.concatenate([source['eos_positions'] + token_starts[i] for i, source in enumerate(statistics)]).astype('int64'),
+            'eos_offsets': eos_offsets.astype('int64'),
+            'length_histogram': numpy.bincount(lengths),
+            'nested': any(bool(source['nested']) for source in statistics),
+            'eos_sym': statistics[0]['eos_sym']}
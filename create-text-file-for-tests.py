@@ -30,7 +30,11 @@ import collections
 import string
 import os
 
+import numpy
+
+from corpus import is_compressed_corpus, is_flat_corpus, load_corpus
 from state import prototype_state
+from vocabulary import Vocabulary
 
 def indices_to_words(idx_to_str, seq):
     """
@@ -38,13 +42,28 @@ def indices_to_words(idx_to_str, seq):
     of word ids. Use unk_sym if a word is not
     known.
     """
-    r = ''
     for word_index in seq:
         if word_index > len(idx_to_str):
             raise ValueError('Word index is too large for the model vocabulary!')
-        r += idx_to_str[word_index] + ' '
 
-    return r.strip()
+    return ' '.join([idx_to_str[word_index] for word_index in seq]).strip()
+
+def split_context_and_response(dialogue, eos_positions, utterances_to_predict, max_words_in_context):
+    """
+    Splits a dialogue (a sequence of words or word ids) into the context and the last
+    'utterances_to_predict' utterances, given the positions of its end-of-utterance tokens.
+    Words after the last end-of-utterance token are not part of any utterance. If the context
+    has more than 'max_words_in_context' words, its beginning is truncated.
+    """
+    utterances = len(eos_positions)
+    context_end = eos_positions[utterances - utterances_to_predict - 1] + 1 if utterances > utterances_to_predict else 0
+    response_end = eos_positions[utterances - 1] + 1 if utterances > 0 else 0
+
+    context_start = 0
+    if max_words_in_context > 0:
+        context_start = max(0, context_end - max_words_in_context)
+
+    return dialogue[context_start:context_end], dialogue[context_end:response_end]
 
 def parse_args():
     parser = argparse.ArgumentParser("Generate text file with test dialogues")
@@ -53,7 +72,7 @@ def parse_args():
             help="Path to the model prefix (without _model.npz or _state.pkl)")
 
     parser.add_argument("test_file",
-            help="Path to the test file (pickled list, with one dialogue per entry; or plain text file with one dialogue per line)")
+            help="Path to the test file (pickled list or flat corpus, with one dialogue per entry; or plain text file with one dialogue per line)")
 
     parser.add_argument("--utterances_to_predict",
             type=int, default=1,
@@ -81,101 +100,64 @@ def main():
     # Load dictionary
 
     # Load dictionaries to convert str to idx and vice-versa
-    raw_dict = cPickle.load(open(state['dictionary'], 'rb'))
+    vocabulary = Vocabulary.load(state['dictionary'])
 
-    str_to_idx = dict([(tok, tok_id) for tok, tok_id, _, _ in raw_dict])
-    idx_to_str = dict([(tok_id, tok) for tok, tok_id, freq, _ in raw_dict])
+    str_to_idx = vocabulary.str_to_idx
+    idx_to_str = vocabulary.words
 
 
     assert len(args.test_file) > 3
-    test_contexts = ''
-    test_responses = ''
     utterances_to_predict = args.utterances_to_predict
     assert args.utterances_to_predict > 0
 
-    # Is it a pickle file? Then process using model dictionaries..
-    if args.test_file[len(args.test_file)-4:len(args.test_file)] == '.pkl':
-        test_dialogues = cPickle.load(open(args.test_file, 'rb'))
+    # Lines are written as the dialogues are processed
+    test_contexts = open('test_contexts.txt','w')
+    test_responses = open('test_responses.txt','w')
+
+    # Is it a pickle file, a flat or a compressed corpus? Then process using model dictionaries..
+    if args.test_file[len(args.test_file)-4:len(args.test_file)] == '.pkl' or is_flat_corpus(args.test_file) \
+            or is_compressed_corpus(args.test_file):
+        test_dialogues = load_corpus(args.test_file)
         for test_dialogueid,test_dialogue in enumerate(test_dialogues):
             if test_dialogueid % 100 == 0:
                 print 'test_dialogue', test_dialogueid
 
-            utterances = []
-            current_utterance = []
-            for word in test_dialogue:
-                current_utterance += [word]
-                if word == state['eos_sym']:
-                    utterances += [current_utterance]
-                    current_utterance = []
+            test_dialogue = numpy.asarray(test_dialogue, dtype='int64')
+            eos_positions = numpy.flatnonzero(test_dialogue == state['eos_sym'])
 
             if args.leave_out_short_dialogues:
-                if len(utterances) <= utterances_to_predict+1:
+                if len(eos_positions) <= utterances_to_predict+1:
                     continue
 
-            context_utterances = []
-            prediction_utterances = []
-            for utteranceid, utterance in enumerate(utterances):
-                if utteranceid >= len(utterances) - utterances_to_predict:
-                    prediction_utterances += utterance
-                else:
-                    context_utterances += utterance
+            context, prediction = split_context_and_response(test_dialogue, eos_positions, \
+                                                             utterances_to_predict, args.max_words_in_context)
 
-            if args.max_words_in_context > 0:
-                while len(context_utterances) > args.max_words_in_context:
-                    del context_utterances[0]
-
-
-            test_contexts += indices_to_words(idx_to_str, context_utterances) + '\n'
-            test_responses += indices_to_words(idx_to_str, prediction_utterances) + '\n'
+            test_contexts.write(indices_to_words(idx_to_str, context) + '\n')
+            test_responses.write(indices_to_words(idx_to_str, prediction) + '\n')
 
     else: # Assume it's a text file
 
-        test_dialogues = [[]]
-        lines = open(args.test_file, "r").readlines()
-        if len(lines):
-            test_dialogues = [x.strip() for x in lines]
+        test_dialogues = open(args.test_file, "r")
 
         for test_dialogueid,test_dialogue in enumerate(test_dialogues):
             if test_dialogueid % 100 == 0:
                 print 'test_dialogue', test_dialogueid
 
-            utterances = []
-            current_utterance = []
-            for word in test_dialogue.split():
-                current_utterance += [word]
-                if word == state['end_sym_utterance']:
-                    utterances += [current_utterance]
-                    current_utterance = []
+            test_dialogue = test_dialogue.split()
+            eos_positions = [i for i, word in enumerate(test_dialogue) if word == state['end_sym_utterance']]
 
             if args.leave_out_short_dialogues:
-                if len(utterances) <= utterances_to_predict+1:
+                if len(eos_positions) <= utterances_to_predict+1:
                     continue
 
-            context_utterances = []
-            prediction_utterances = []
-            for utteranceid, utterance in enumerate(utterances):
-                if utteranceid >= len(utterances) - utterances_to_predict:
-                    prediction_utterances += utterance
-                else:
-                    context_utterances += utterance
-
-            if args.max_words_in_context > 0:
-                while len(context_utterances) > args.max_words_in_context:
-                    del context_utterances[0]
-
-
-            test_contexts += ' '.join(context_utterances) + '\n'
-            test_responses += ' '.join(prediction_utterances) + '\n'
-
+            context, prediction = split_context_and_response(test_dialogue, eos_positions, \
+                                                             utterances_to_predict, args.max_words_in_context)
 
-    print('Writing to files...')
-    f = open('test_contexts.txt','w')
-    f.write(test_contexts)
-    f.close()
+            test_contexts.write(' '.join(context) + '\n')
+            test_responses.write(' '.join(prediction) + '\n')
 
-    f = open('test_responses.txt','w')
-    f.write(test_responses)
-    f.close()
+    test_contexts.close()
+    test_responses.close()
 
     print('All done!')
 
@@ -8,14 +8,19 @@ import logging
 from state import *
 from utils import *
 from SS_dataset import *
+from corpus import corpus_signature
 
 import itertools
+import hashlib
+import os
+import shutil
+import multiprocessing
+import traceback
 import sys
 import pickle
 import random
 import datetime
 import math
-import copy
 
 logger = logging.getLogger(__name__)
 
@@ -38,42 +43,32 @@ def add_random_variables_to_batch(state, rng, batch, prev_batch, evaluate_mode):
     if not batch:
         return batch
 
+    # Find end-of-utterance indices, and assign each token the id of the utterance it belongs to.
+    # A new random vector is sampled at the beginning of the dialogue (if it doesn't start with
+    # an end-of-utterance token) and at every end-of-utterance token. The vector stays constant
+    # until the next end-of-utterance token.
+    is_eos = (batch['x'] == state['eos_sym'])
+    starts_without_eos = 1 - is_eos[0, :].astype('int64')
+    utterance_ids = numpy.cumsum(is_eos, axis=0) - 1 + starts_without_eos[None, :]
+
+    # Sample random variables using NumPy. For each column we draw one vector per utterance
+    # plus one (unused) vector for the end of the batch, in the same order as sampling column by column.
+    vectors_per_column = numpy.sum(is_eos, axis=0) + starts_without_eos + 1
+    column_offsets = numpy.cumsum(vectors_per_column) - vectors_per_column
+    ran_vectors = rng.normal(loc=0, scale=1, size=(int(numpy.sum(vectors_per_column)), state['latent_gaussian_per_utterance_dim'])).astype('float32')
+
     # Variable to store random vector sampled at the beginning of each utterance
-    Ran_Var_ConstUtterance = numpy.zeros((batch['x'].shape[0], batch['x'].shape[1], state['latent_gaussian_per_utterance_dim']), dtype='float32')
-
-    # Go through each sample, find end-of-utterance indices and sample random variables
-    for idx in xrange(batch['x'].shape[1]):
-        # Find end-of-utterance indices
-        eos_indices = numpy.where(batch['x'][:, idx] == state['eos_sym'])[0].tolist()
-
-        # Make sure we also sample at the beginning of the utterance, and that we stop appropriately at the end
-        if len(eos_indices) > 0:
-            if not eos_indices[0] == 0:
-                eos_indices = [0] + eos_indices
-            if not eos_indices[-1] == batch['x'].shape[0]:
-                eos_indices = eos_indices + [batch['x'].shape[0]]
-        else:
-            eos_indices = [0] + [batch['x'].shape[0]]
-
-        # Sample random variables using NumPy
-        ran_vectors = rng.normal(loc=0, scale=1, size=(len(eos_indices), state['latent_gaussian_per_utterance_dim']))
-        for i in range(len(eos_indices)-1):
-            for j in range(eos_indices[i], eos_indices[i+1]):
-                Ran_Var_ConstUtterance[j, idx, :] = ran_vectors[i, :]
-
-        # If a previous batch is given, and the last utterance in the previous batch
-        # overlaps with the first utterance in the current batch, then we need to copy over 
-        # the random variables from the last utterance in the last batch to remain consistent.
-        if prev_batch:
-            if ('x_reset' in prev_batch) and (not numpy.sum(numpy.abs(prev_batch['x_reset'])) < 1) \
-              and ('ran_var_constutterance' in prev_batch):
-                prev_ran_vector = prev_batch['ran_var_constutterance'][-1,idx,:]
-                if len(eos_indices) > 1:
-                    for j in range(0, eos_indices[1]):
-                        Ran_Var_ConstUtterance[j, idx, :] = prev_ran_vector
-                else:
-                    for j in range(0, batch['x'].shape[0]):
-                        Ran_Var_ConstUtterance[j, idx, :] = prev_ran_vector
+    Ran_Var_ConstUtterance = ran_vectors[utterance_ids + column_offsets[None, :]]
+
+    # If a previous batch is given, and the last utterance in the previous batch
+    # overlaps with the first utterance in the current batch, then we need to copy over 
+    # the random variables from the last utterance in the last batch to remain consistent.
+    if prev_batch:
+        if ('x_reset' in prev_batch) and (not numpy.sum(numpy.abs(prev_batch['x_reset'])) < 1) \
+          and ('ran_var_constutterance' in prev_batch):
+            first_utterance = (utterance_ids == 0)
+            first_utterance_columns = numpy.nonzero(first_utterance)[1]
+            Ran_Var_ConstUtterance[first_utterance] = prev_batch['ran_var_constutterance'][-1, first_utterance_columns, :]
 
     # Add new random Gaussian variable to batch
     batch['ran_var_constutterance'] = Ran_Var_ConstUtterance
@@ -92,101 +87,519 @@ def add_random_variables_to_batch(state, rng, batch, prev_batch, evaluate_mode):
     return batch
 
 
-def create_padded_batch(state, rng, x, force_end_of_utterance_token = False):
-    # Find max length in batch
-    mx = 0
-    for idx in xrange(len(x[0])):
-        mx = max(mx, len(x[0][idx]))
+def create_padded_batch(state, rng, x, force_end_of_utterance_token = False, columns = None, dialogue_starts = None):
+    """
+    Pads a list of dialogues x[0] into the (max length x batch size) matrices
+    'x', 'x_reversed' and 'x_mask'. Each dialogue is put in a column of its own
+    and an end-of-utterance symbol is added at the beginning of every dialogue,
+    which doesn't already start with one. The batch size is 'bs', unless
+    the number of columns is given. If the columns hold several packed dialogues,
+    'dialogue_starts' gives the (rows, columns) at which the later dialogues start.
+
+    The matrices are built directly from the dialogue lengths and offsets
+    into the concatenated dialogues, without looping over the dialogues in Python.
+    """
+    dialogues = x[0]
+    num_dialogues = len(dialogues)
+    lengths = numpy.fromiter((len(dialogue) for dialogue in dialogues), dtype='int64', count=num_dialogues)
 
+    # Find max length in batch.
     # Take into account that sometimes we need to add the end-of-utterance symbol at the start
-    mx += 1
+    mx = 1
+    if num_dialogues > 0:
+        mx += int(lengths.max())
 
-    n = state['bs'] 
+    n = state['bs'] if columns is None else columns
     
     X = numpy.zeros((mx, n), dtype='int32')
     Xmask = numpy.zeros((mx, n), dtype='float32') 
 
-    # Variable to store each utterance in reverse form (for bidirectional RNNs)
-    X_reversed = numpy.zeros((mx, n), dtype='int32')
-
-    # Fill X and Xmask.
     # Keep track of number of predictions and maximum dialogue length.
     num_preds = 0
     max_length = 0
-    for idx in xrange(len(x[0])):
-        # Insert sequence idx in a column of matrix X
-        dialogue_length = len(x[0][idx])
 
-        # Fiddle-it if it is too long ..
-        if mx < dialogue_length: 
-            continue
+    if num_dialogues > 0:
+        offsets = numpy.zeros(num_dialogues + 1, dtype='int64')
+        numpy.cumsum(lengths, out=offsets[1:])
+        if all(isinstance(dialogue, numpy.ndarray) for dialogue in dialogues):
+            tokens = numpy.concatenate(dialogues).astype('int32')
+        else:
+            tokens = numpy.fromiter(itertools.chain.from_iterable(dialogues), dtype='int32', count=offsets[-1])
 
         # Make sure end-of-utterance symbol is at beginning of dialogue.
         # This will force model to generate first utterance too
-        if not x[0][idx][0] == state['eos_sym']:
-            X[:dialogue_length+1, idx] = [state['eos_sym']] + x[0][idx][:dialogue_length]
-            dialogue_length = dialogue_length + 1
-        else:
-            X[:dialogue_length, idx] = x[0][idx][:dialogue_length]
+        first_tokens = numpy.zeros(num_dialogues, dtype='int32')
+        non_empty = lengths > 0
+        first_tokens[non_empty] = tokens[offsets[:-1][non_empty]]
+        add_eos = first_tokens != state['eos_sym']
+        dialogue_lengths = lengths + add_eos
+
+        # Insert sequence idx in a column of matrix X, shifted by one if an end-of-utterance symbol is added.
+        columns = numpy.repeat(numpy.arange(num_dialogues), lengths)
+        rows = numpy.arange(offsets[-1]) - numpy.repeat(offsets[:-1] - add_eos, lengths)
+        X[rows, columns] = tokens
+        X[0, :num_dialogues][add_eos] = state['eos_sym']
+
+        # Initialize Xmask columns with ones in all positions that
+        # were just set in X (except for first eos symbol, because we are not evaluating this). 
+        # Note: if we need mask to depend on tokens inside X, then we need to 
+        # create a corresponding mask for X_reversed and send it further in the model
+        inside_dialogue = numpy.arange(mx)[:, None] < dialogue_lengths[None, :]
+        Xmask[:, :num_dialogues] = inside_dialogue
+
+        # Mark the end of phrase
+        if force_end_of_utterance_token:
+            X[:, :num_dialogues][~inside_dialogue] = state['eos_sym']
 
         # Keep track of longest dialogue
-        max_length = max(max_length, dialogue_length)
+        max_length = int(dialogue_lengths.max())
 
         # Set the number of predictions == sum(Xmask), for cost purposes, minus one (to exclude first eos symbol)
-        num_preds += dialogue_length - 1
-        
-        # Mark the end of phrase
-        if len(x[0][idx]) < mx:
-            if force_end_of_utterance_token:
-                X[dialogue_length:, idx] = state['eos_sym']
-
-        # Initialize Xmask column with ones in all positions that
-        # were just set in X (except for first eos symbol, because we are not evaluating this). 
-        # Note: if we need mask to depend on tokens inside X, then we need to 
-        # create a corresponding mask for X_reversed and send it further in the model
-        Xmask[0:dialogue_length, idx] = 1.
-
-        # Reverse all utterances
-        # TODO: For backward compatibility. This should be removed in future versions
-        # i.e. move all the x_reversed computations to the model itself.
-        eos_indices = numpy.where(X[:, idx] == state['eos_sym'])[0]
-        X_reversed[:, idx] = X[:, idx]
-        prev_eos_index = -1
-        for eos_index in eos_indices:
-            X_reversed[(prev_eos_index+1):eos_index, idx] = (X_reversed[(prev_eos_index+1):eos_index, idx])[::-1]
-            prev_eos_index = eos_index
-            if prev_eos_index > dialogue_length:
-                break
+        num_preds = int(numpy.sum(dialogue_lengths - 1))
+
+    # Reverse all utterances
+    # TODO: For backward compatibility. This should be removed in future versions
+    # i.e. move all the x_reversed computations to the model itself.
+    # A token at position t inside an utterance (prev_eos, next_eos) is taken from position
+    # prev_eos + next_eos - t. Tokens after the last end-of-utterance symbol of a dialogue are not reversed,
+    # so the end-of-utterance symbol which starts the next packed dialogue does not end an utterance.
+    is_eos = X == state['eos_sym']
+    positions = numpy.arange(mx)[:, None]
+    prev_eos = numpy.maximum.accumulate(numpy.where(is_eos, positions, -1), axis=0)
+    next_eos = numpy.minimum.accumulate(numpy.where(is_eos, positions, mx)[::-1], axis=0)[::-1]
+    ends_utterance = next_eos < mx
+    if dialogue_starts is not None:
+        is_start = numpy.zeros((mx + 1, n), dtype='bool')
+        is_start[numpy.asarray(dialogue_starts[0], dtype='int64'), numpy.asarray(dialogue_starts[1], dtype='int64')] = True
+        ends_utterance &= ~is_start[next_eos, numpy.arange(n)[None, :]]
+    source_rows = numpy.where(ends_utterance, prev_eos + next_eos - positions, positions)
 
+    # Variable to store each utterance in reverse form (for bidirectional RNNs)
+    X_reversed = X[source_rows, numpy.arange(n)[None, :]]
 
     assert num_preds == numpy.sum(Xmask) - numpy.sum(Xmask[0, :])
 
+    # Dialogues are not packed, so the RNN states are never reset inside the batch
+    Xdialogue_reset = numpy.ones((mx, n), dtype='float32')
+
     batch = {'x': X,                                                 \
              'x_reversed': X_reversed,                               \
              'x_mask': Xmask,                                        \
+             'x_dialogue_reset': Xdialogue_reset,                    \
              'num_preds': num_preds,                                 \
-             'num_dialogues': len(x[0]),                             \
+             'num_dialogues': num_dialogues,                         \
              'max_length': max_length                                \
             }
 
     return batch
 
+def split_batch_into_segments(state, full_batch):
+    """
+    Splits a padded batch into segments of at most 'max_grad_steps' tokens for truncated BPTT.
+
+    Segments don't copy any data. Their 'x', 'x_reversed', 'x_mask' and 'x_dialogue_reset' entries are views
+    into the matrices of the full batch, and only the small 'x_reset' vector is allocated per segment.
+    """
+    splits = int(math.ceil(float(full_batch['max_length']) / float(state['max_grad_steps'])))
+    batch_size = full_batch['x'].shape[1]
+
+    batches = []
+    for i in range(0, splits):
+        # Retrieve start and end position (index) of current mini-batch
+        start_pos = state['max_grad_steps'] * i
+        if start_pos > 0:
+            start_pos = start_pos - 1
+
+        # We need to copy over the last token from each batch onto the next, 
+        # because this is what the model expects.
+        end_pos = min(full_batch['max_length'], state['max_grad_steps'] * (i + 1))
+
+        batch = {}
+        batch['x'] = full_batch['x'][start_pos:end_pos, :]
+        batch['x_reversed'] = full_batch['x_reversed'][start_pos:end_pos, :]
+        batch['x_mask'] = full_batch['x_mask'][start_pos:end_pos, :]
+        batch['x_dialogue_reset'] = full_batch['x_dialogue_reset'][start_pos:end_pos, :]
+        batch['max_length'] = end_pos - start_pos
+        batch['num_preds'] = numpy.sum(batch['x_mask']) - numpy.sum(batch['x_mask'][0,:])
+
+        # For each batch we compute the number of dialogues as a fraction of the full batch,
+        # that way, when we add them together, we get the total number of dialogues.
+        batch['num_dialogues'] = float(full_batch['num_dialogues']) / float(splits)
+        batch['x_reset'] = numpy.ones(batch_size, dtype='float32')
+
+        batches.append(batch)
+
+    if len(batches) > 0:
+        batches[len(batches)-1]['x_reset'] = numpy.zeros(batch_size, dtype='float32')
+
+    return batches
+
+def split_by_token_budget(sorted_lengths, batch_size, token_budget):
+    """
+    Splits dialogues sorted by length into consecutive batches of at most 'batch_size' dialogues,
+    such that the number of columns times the padded length of a batch doesn't exceed 'token_budget'.
+    A dialogue which is longer than the budget gets a batch of its own.
+    """
+    # The padded length includes the end-of-utterance symbol added at the beginning of the dialogue
+    padded_lengths = sorted_lengths + 1
+
+    batch_indices = []
+    start = 0
+    while start < len(padded_lengths):
+        end = start + 1
+        while end < len(padded_lengths) and end - start < batch_size \
+          and (end - start + 1) * padded_lengths[end] <= token_budget:
+            end += 1
+        batch_indices.append(numpy.arange(start, end))
+        start = end
+    return batch_indices
+
+def pack_dialogues(state, lengths):
+    """
+    Packs dialogues into columns with first-fit decreasing bin packing. The capacity of a column
+    is the length of the longest dialogue, but at least 'max_grad_steps' tokens.
+    Returns a list of columns, each a list of dialogue indices.
+    """
+    # Every packed dialogue starts with an end-of-utterance symbol
+    capacity = max(int(lengths.max()) + 1, state['max_grad_steps'])
+
+    remaining = numpy.zeros(len(lengths), dtype='int64')
+    columns = []
+    for index in numpy.argsort(-lengths, kind='mergesort'):
+        fits = numpy.nonzero(remaining[:len(columns)] >= lengths[index] + 1)[0]
+        if len(fits):
+            column = fits[0]
+        else:
+            column = len(columns)
+            columns.append([])
+            remaining[column] = capacity
+        columns[column].append(index)
+        remaining[column] -= lengths[index] + 1
+    return columns
+
+def create_packed_batch(state, rng, columns):
+    """
+    Pads a list of columns, each a list of dialogues which are put back-to-back.
+    Each dialogue starts with an end-of-utterance symbol. The mask is zero at the first token of every
+    dialogue, since it is not predicted, and so is 'x_dialogue_reset', which resets the RNN states of the model.
+    """
+    eos = numpy.array([state['eos_sym']], dtype='int32')
+
+    packed = []
+    start_rows, start_columns = [], []
+    num_dialogues = 0
+    for column, dialogues in enumerate(columns):
+        pieces = []
+        position = 0
+        for dialogue in dialogues:
+            dialogue = numpy.asarray(dialogue, dtype='int32')
+            if len(dialogue) == 0 or dialogue[0] != state['eos_sym']:
+                dialogue = numpy.concatenate([eos, dialogue])
+            if position > 0:
+                start_rows.append(position)
+                start_columns.append(column)
+            pieces.append(dialogue)
+            position += len(dialogue)
+        packed.append(numpy.concatenate(pieces))
+        num_dialogues += len(dialogues)
+
+    batch = create_padded_batch(state, rng, [packed], columns=len(packed), dialogue_starts=(start_rows, start_columns))
+    batch['x_mask'][start_rows, start_columns] = 0
+    batch['x_dialogue_reset'][start_rows, start_columns] = 0
+    batch['num_preds'] -= len(start_rows)
+    batch['num_dialogues'] = num_dialogues
+    return batch
+
+def create_packed_group_segments(state, rng, data_x, batch_size):
+    """
+    Packs the dialogues of a group into columns, pads columns of similar lengths
+    into full batches of 'batch_size' columns and yields their truncated BPTT segments.
+    """
+    lengths = numpy.fromiter((len(dialogue) for dialogue in data_x), dtype='int64', count=len(data_x))
+    columns = pack_dialogues(state, lengths)
+
+    column_lengths = numpy.array([numpy.sum(lengths[column] + 1) for column in columns])
+    order = numpy.argsort(column_lengths, kind='mergesort')
+
+    for k in range(0, len(columns), batch_size):
+        batch_columns = [[data_x[i] for i in columns[c]] for c in order[k:k + batch_size]]
+        full_batch = create_packed_batch(state, rng, batch_columns)
+
+        for batch in split_batch_into_segments(state, full_batch):
+            if batch:
+                yield batch
+
+def create_group_segments(state, rng, data, batch_size):
+    """
+    Sorts a group of batches (as returned by the SSFetcher) by dialogue length,
+    pads them into full batches of similar lengths and yields their truncated BPTT segments.
+    """
+    number_of_batches = len(data)
+    data = list(itertools.chain.from_iterable(data))
+
+    # Split list of words from the dialogue index.
+    # Dialogues are kept as a list, since they may be (memory-mapped) arrays of different lengths.
+    data_x = []
+    for i in range(len(data)):
+        data_x.append(data[i][0])
+
+    lens = numpy.asarray([map(len, data_x)])
+    order = numpy.argsort(lens.max(axis=0))
+
+    if state.get('pack_dialogues', False):
+        for batch in create_packed_group_segments(state, rng, data_x, batch_size):
+            yield batch
+        return
+
+    token_budget = state.get('batch_token_budget', 0)
+    if token_budget > 0:
+        batch_indices = split_by_token_budget(lens[0][order], batch_size, token_budget)
+    else:
+        batch_indices = [numpy.arange(k * batch_size, min((k + 1) * batch_size, len(order))) for k in range(number_of_batches)]
+         
+    for indices in batch_indices:
+        indices = order[indices]
+        if token_budget > 0:
+            full_batch = create_padded_batch(state, rng, [[data_x[i] for i in indices]], columns=len(indices))
+        else:
+            full_batch = create_padded_batch(state, rng, [[data_x[i] for i in indices]])
+
+        # Then split batches to have size 'max_grad_steps'
+        batches = split_batch_into_segments(state, full_batch)
+
+        for batch in batches:
+            if batch:
+                yield batch
+
+class SharedBatchRing(object):
+    """
+    Ring buffer of segment batches in shared memory, written by one producer process
+    and read by the training process. Each slot holds the padded matrices and random
+    variables of one segment, so the reader only gets numpy views and nothing is pickled.
+    For mixed corpora, the first segment of each group also holds the tokens of the group
+    from each of the 'num_sources' corpora.
+    """
+    SEGMENT, END_OF_GROUP, END_OF_DATA, ERROR = range(4)
+    MATRICES = ['x', 'x_reversed', 'x_mask', 'x_dialogue_reset', 'ran_var_constutterance', 'ran_decoder_drop_mask']
+
+    def __init__(self, state, slots, num_sources=0):
+        self.rows = state['max_grad_steps'] + 1
+        self.cols = state['bs']
+        self.dim = state['latent_gaussian_per_utterance_dim']
+
+        self.slots = []
+        for i in range(slots):
+            slot = {}
+            slot['x'] = self._allocate((self.rows, self.cols), 'int32')
+            slot['x_reversed'] = self._allocate((self.rows, self.cols), 'int32')
+            slot['x_mask'] = self._allocate((self.rows, self.cols), 'float32')
+            slot['x_dialogue_reset'] = self._allocate((self.rows, self.cols), 'float32')
+            slot['ran_var_constutterance'] = self._allocate((self.rows, self.cols, self.dim), 'float32')
+            slot['ran_decoder_drop_mask'] = self._allocate((self.rows, self.cols), 'float32')
+            slot['x_reset'] = self._allocate((self.cols,), 'float32')
+            # Kind of message, max_length, columns, num_preds, num_dialogues and the position (epoch, offset) of the group
+            slot['meta'] = self._allocate((7,), 'float64')
+            slot['source_tokens'] = self._allocate((num_sources,), 'int64')
+            self.slots.append(slot)
+
+        self.free = multiprocessing.Semaphore(slots)
+        self.filled = multiprocessing.Semaphore(0)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.held = False
+
+    def _allocate(self, shape, dtype):
+        size = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+        return numpy.frombuffer(multiprocessing.RawArray('b', size), dtype=dtype).reshape(shape)
+
+    def put(self, kind, batch=None, cursor=None, source_tokens=None):
+        self.free.acquire()
+        slot = self.slots[self.write_pos % len(self.slots)]
+        slot['meta'][0] = kind
+        if kind == SharedBatchRing.SEGMENT:
+            rows, cols = batch['x'].shape
+            for key in SharedBatchRing.MATRICES:
+                slot[key][:rows, :cols] = batch[key]
+            slot['x_reset'][:cols] = batch['x_reset']
+            slot['meta'][1:] = [rows, cols, batch['num_preds'], batch['num_dialogues'], cursor[0], cursor[1]]
+            slot['source_tokens'][:] = 0 if source_tokens is None else source_tokens
+        self.write_pos += 1
+        self.filled.release()
+
+    def get(self, is_alive):
+        """
+        Returns the kind of the next message and, for segments, a batch of views into its slot,
+        the position of the group of the segment and the tokens it adds from each source corpus.
+        The slot stays valid until the following call to get.
+        """
+        self.release()
+        while not self.filled.acquire(True, 1.0):
+            if not is_alive():
+                raise RuntimeError('Batch producer process died unexpectedly.')
+
+        slot = self.slots[self.read_pos % len(self.slots)]
+        self.read_pos += 1
+        self.held = True
+
+        kind = int(slot['meta'][0])
+        if kind != SharedBatchRing.SEGMENT:
+            return kind, None, None, None
+
+        rows, cols = int(slot['meta'][1]), int(slot['meta'][2])
+        batch = {}
+        for key in SharedBatchRing.MATRICES:
+            batch[key] = slot[key][:rows, :cols]
+        batch['x_reset'] = slot['x_reset'][:cols]
+        batch['max_length'] = rows
+        batch['num_preds'] = numpy.float32(slot['meta'][3])
+        batch['num_dialogues'] = float(slot['meta'][4])
+        return kind, batch, (int(slot['meta'][5]), int(slot['meta'][6])), slot['source_tokens']
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.free.release()
+
+def produce_batches(state, diter, worker_id, num_workers, ring, errors, start_group=0):
+    """
+    Main loop of a batch producer process. All workers walk through the same sequence of
+    groups of 'sort_k_batches' batches, and worker i pads, splits and adds random variables
+    to the groups g with g % num_workers == i. Every group gets its own random generator,
+    seeded by the seed and the group index, so the batches only depend on the seed.
+    The batches of the groups of other workers are only planned, and their dialogues are never loaded.
+
+    When the iterator resumes from a saved position, the first group is numbered 'start_group'.
+    """
+    try:
+        fetcher = SSFetcher(diter)
+        batches = ((fetcher.cursor, indexes) for indexes in fetcher.iter_batch_indexes())
+        group_id = start_group
+        while True:
+            data = list(itertools.islice(batches, diter.k_batches))
+            if not len(data):
+                break
+
+            if group_id % num_workers == worker_id:
+                cursor = data[0][0]
+                source_tokens = None
+                if len(diter.source_tokens):
+                    source_tokens = sum(diter.count_source_tokens(indexes) for _, indexes in data)
+                data = [[[diter.get_dialogue(index)] for index in indexes] for _, indexes in data]
+                rng = numpy.random.RandomState([state['seed'], group_id])
+                prev_batch = None
+                for batch in create_group_segments(state, rng, data, diter.batch_size):
+                    batch = add_random_variables_to_batch(state, rng, batch, prev_batch, diter.evaluate_mode)
+                    prev_batch = batch
+                    ring.put(SharedBatchRing.SEGMENT, batch, cursor, source_tokens)
+                    source_tokens = None
+                ring.put(SharedBatchRing.END_OF_GROUP)
+
+            group_id += 1
+
+        ring.put(SharedBatchRing.END_OF_DATA)
+    except Exception:
+        errors.put(traceback.format_exc())
+        ring.put(SharedBatchRing.ERROR)
+
+class BatchProducerPool(object):
+    """
+    Pool of processes producing segment batches for an Iterator.
+    Groups are read back in the order the workers were assigned to them.
+
+    The pool keeps track of the current group, its position and the number of its segments
+    read so far. To resume from such a position, the pool starts at group 'start_group'
+    (from diter.start_cursor) and discards the first 'skip_segments' segments.
+
+    For mixed corpora, 'source_tokens' counts the tokens from each source corpus of the groups
+    read so far, and 'group_source_tokens' those of the groups before the current group.
+    """
+    def __init__(self, state, diter, num_workers, buffer_size, start_group=0, skip_segments=0):
+        self.num_workers = num_workers
+        self.rings = [SharedBatchRing(state, buffer_size, len(diter.source_tokens)) for i in range(num_workers)]
+        self.errors = multiprocessing.Queue()
+        self.group_id = start_group
+        self.group_cursor = diter.start_cursor
+        self.group_segments = 0
+        self.skip_segments = skip_segments
+        self.source_tokens = numpy.array(diter.source_tokens)
+        self.group_source_tokens = numpy.array(diter.source_tokens)
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = multiprocessing.Process(target=produce_batches, \
+                                             args=(state, diter, i, num_workers, self.rings[i], self.errors, start_group))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def next(self):
+        while True:
+            worker_id = self.group_id % self.num_workers
+            kind, batch, cursor, source_tokens = self.rings[worker_id].get(self.workers[worker_id].is_alive)
+            if kind == SharedBatchRing.SEGMENT:
+                self.group_cursor = cursor
+                self.source_tokens += source_tokens
+                self.group_segments += 1
+                if self.group_segments > self.skip_segments:
+                    return batch
+            elif kind == SharedBatchRing.END_OF_GROUP:
+                self.group_id += 1
+                self.group_segments = 0
+                self.skip_segments = 0
+                self.group_source_tokens[:] = self.source_tokens
+            elif kind == SharedBatchRing.END_OF_DATA:
+                return None
+            else:
+                raise RuntimeError('Batch producer process failed:\n' + self.errors.get())
+
+    def close(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self.workers = []
+
 class Iterator(SSIterator):
     def __init__(self, dialogue_file, batch_size, **kwargs):
         SSIterator.__init__(self, dialogue_file, batch_size,                          \
                             seed=kwargs.pop('seed', 1234),                            \
                             max_len=kwargs.pop('max_len', -1),                        \
-                            use_infinite_loop=kwargs.pop('use_infinite_loop', False))
+                            use_infinite_loop=kwargs.pop('use_infinite_loop', False), \
+                            length_buckets=kwargs['state'].get('length_buckets', 0), \
+                            eos_sym=kwargs['state'].get('eos_sym', 1),               \
+                            corpus_weights=kwargs.pop('corpus_weights', None))
 
         self.k_batches = kwargs.pop('sort_k_batches', 20)
         self.state = kwargs.pop('state', None)
 
+        # Batches sampled from length buckets are already homogenous, so they are not sorted again
+        if self.length_buckets > 0:
+            self.k_batches = 1
+
+        # Keep track of the padding efficiency (real tokens / padded tokens) of each epoch
+        if self.max_len == -1:
+            self.dialogues_per_epoch = self.data_len
+        else:
+            self.dialogues_per_epoch = int(numpy.sum(self.lengths <= self.max_len))
+        self.padding_efficiency = []
+        self.reset_padding_statistics()
+
         self.batch_iter = None
         self.rng = numpy.random.RandomState(self.state['seed'])
 
         # Keep track of previous batch, because this is needed to specify random variables
         self.prev_batch = None
 
+        # Position of the current group of batches and the number of its segments returned so far,
+        # and the saved state to resume from on the next start (see get_state and set_state)
+        self.group_cursor = None
+        self.group_segments = 0
+        self.skip_segments = 0
+        self.resume_state = None
+
+        # Tokens from each source of a mixed corpus before the current group of batches
+        self.group_source_tokens = numpy.array(self.source_tokens)
+
         # Store whether the iterator operates in evaluate mode or not
         self.evaluate_mode = kwargs.pop('evaluate_mode', False)
         print 'Data Iterator Evaluate Mode: ', self.evaluate_mode
@@ -196,76 +609,158 @@ class Iterator(SSIterator):
             batch_size = self.batch_size if (batch_size == -1) else batch_size 
            
             data = []
+            self.group_source_tokens[:] = self.source_tokens
             for k in range(self.k_batches):
                 batch = SSIterator.next(self)
                 if batch:
+                    if not len(data):
+                        self.group_cursor = self.cursor
                     data.append(batch)
             
             if not len(data):
                 return
-            
-            number_of_batches = len(data)
-            data = list(itertools.chain.from_iterable(data))
-
-            # Split list of words from the dialogue index
-            data_x = []
-            for i in range(len(data)):
-                data_x.append(data[i][0])
-
-            x = numpy.asarray(list(itertools.chain(data_x)))
-
-            lens = numpy.asarray([map(len, x)])
-            order = numpy.argsort(lens.max(axis=0))
-                 
-            for k in range(number_of_batches):
-                indices = order[k * batch_size:(k + 1) * batch_size]
-                full_batch = create_padded_batch(self.state, self.rng, [x[indices]])
-
-                # Then split batches to have size 'max_grad_steps'
-                splits = int(math.ceil(float(full_batch['max_length']) / float(self.state['max_grad_steps'])))
-                batches = []
-                for i in range(0, splits):
-                    batch = copy.deepcopy(full_batch)
-
-                    # Retrieve start and end position (index) of current mini-batch
-                    start_pos = self.state['max_grad_steps'] * i
-                    if start_pos > 0:
-                        start_pos = start_pos - 1
 
-                    # We need to copy over the last token from each batch onto the next, 
-                    # because this is what the model expects.
-                    end_pos = min(full_batch['max_length'], self.state['max_grad_steps'] * (i + 1))
+            self.group_segments = 0
+            for batch in create_group_segments(self.state, self.rng, data, batch_size):
+                self.group_segments += 1
+                # Segments returned before the iterator state was saved are skipped
+                if self.group_segments > self.skip_segments:
+                    yield batch
+            self.skip_segments = 0
 
-                    batch['x'] = full_batch['x'][start_pos:end_pos, :]
-                    batch['x_reversed'] = full_batch['x_reversed'][start_pos:end_pos, :]
-                    batch['x_mask'] = full_batch['x_mask'][start_pos:end_pos, :]
-                    batch['max_length'] = end_pos - start_pos
-                    batch['num_preds'] = numpy.sum(batch['x_mask']) - numpy.sum(batch['x_mask'][0,:])
+    def reset_padding_statistics(self):
+        self.epoch_dialogues = 0.
+        self.epoch_real_tokens = 0.
+        self.epoch_padded_tokens = 0.
 
-                    # For each batch we compute the number of dialogues as a fraction of the full batch,
-                    # that way, when we add them together, we get the total number of dialogues.
-                    batch['num_dialogues'] = float(full_batch['num_dialogues']) / float(splits)
-                    batch['x_reset'] = numpy.ones(self.state['bs'], dtype='float32')
-
-                    batches.append(batch)
-
-                if len(batches) > 0:
-                    batches[len(batches)-1]['x_reset'] = numpy.zeros(self.state['bs'], dtype='float32')
-
-                for batch in batches:
-                    if batch:
-                        yield batch
+    def track_padding(self, batch):
+        """
+        Accumulates the real and padded tokens of a batch, and logs the padding efficiency
+        at the end of every epoch. The first row of each segment is not predicted, and is not counted.
+        """
+        if batch:
+            self.epoch_dialogues += batch['num_dialogues']
+            self.epoch_real_tokens += batch['num_preds']
+            self.epoch_padded_tokens += (batch['max_length'] - 1) * batch['x'].shape[1]
+
+        if (not batch or self.epoch_dialogues >= self.dialogues_per_epoch - 1e-6) and self.epoch_padded_tokens > 0:
+            efficiency = float(self.epoch_real_tokens) / float(self.epoch_padded_tokens)
+            self.padding_efficiency.append(efficiency)
+            logger.info('Epoch %d padding efficiency (real tokens / padded tokens): %.4f (%d / %d)' \
+                        % (len(self.padding_efficiency), efficiency, self.epoch_real_tokens, self.epoch_padded_tokens))
+            source_tokens = self.source_token_counts()
+            if len(source_tokens):
+                logger.info('Epoch %d tokens per corpus: %s' % (len(self.padding_efficiency), \
+                            ', '.join('%d (%.4f)' % (n, n / max(1., float(sum(source_tokens)))) for n in source_tokens)))
+            self.reset_padding_statistics()
+
+    def source_token_counts(self):
+        """
+        Returns the number of tokens read so far from each source of a mixed corpus
+        (an empty array for other corpora).
+        """
+        if getattr(self, 'producer', None):
+            return numpy.array(self.producer.source_tokens)
+        return numpy.array(self.source_tokens)
 
+    def get_state(self):
+        """
+        Returns the position of the iterator: the position of the current group of batches
+        in the shuffled data, the number of its segments returned so far, the state of the random
+        generator, the random variables carried over to the next segment and the padding statistics.
+        The iterator continues exactly from this position after set_state and start,
+        as long as the data and the batching options are the same.
+        """
+        if getattr(self, 'producer', None):
+            group_cursor = self.producer.group_cursor
+            group_id = self.producer.group_id
+            group_segments = max(self.producer.group_segments, self.producer.skip_segments)
+            group_source_tokens = self.producer.group_source_tokens
+        else:
+            group_cursor = self.group_cursor
+            group_id = 0
+            group_segments = max(self.group_segments, self.skip_segments)
+            group_source_tokens = self.group_source_tokens
+
+        prev_carry = None
+        if self.prev_batch:
+            prev_carry = {'x_reset': numpy.array(self.prev_batch['x_reset']), \
+                          'ran_var_constutterance': numpy.array(self.prev_batch['ran_var_constutterance'][-1:])}
+
+        return {'group_cursor': group_cursor,
+                'group_id': group_id,
+                'group_segments': group_segments,
+                'rng_state': self.rng.get_state(),
+                'prev_carry': prev_carry,
+                'padding_statistics': (self.epoch_dialogues, self.epoch_real_tokens, self.epoch_padded_tokens),
+                'padding_efficiency': list(self.padding_efficiency),
+                'source_tokens': numpy.array(group_source_tokens)}
+
+    def set_state(self, iterator_state):
+        """
+        Sets the position (as returned by get_state) to continue from on the next start.
+        """
+        self.resume_state = iterator_state
 
     def start(self):
+        self.reset_padding_statistics()
+        self.group_cursor = None
+        self.group_segments = 0
+        self.skip_segments = 0
+        start_group = 0
+
+        if self.resume_state:
+            resume_state, self.resume_state = self.resume_state, None
+            self.start_cursor = self.group_cursor = resume_state['group_cursor']
+            self.skip_segments = resume_state['group_segments']
+            start_group = resume_state['group_id']
+            self.rng.set_state(resume_state['rng_state'])
+            self.prev_batch = resume_state['prev_carry']
+            self.epoch_dialogues, self.epoch_real_tokens, self.epoch_padded_tokens = resume_state['padding_statistics']
+            self.padding_efficiency = list(resume_state['padding_efficiency'])
+            if 'source_tokens' in resume_state:
+                self.source_tokens[:] = resume_state['source_tokens']
+            self.group_source_tokens[:] = self.source_tokens
+            logger.debug('Resuming iterator at position %s' % (self.start_cursor,))
+
+        if self.state.get('batch_producer_processes', 0) > 0:
+            self.stop_producer()
+            self.exit_flag = False
+            self.producer = BatchProducerPool(self.state, self, self.state['batch_producer_processes'], \
+                                              self.state.get('batch_producer_buffer_size', 8), \
+                                              start_group, self.skip_segments)
+            self.start_cursor = None
+            return
+
         SSIterator.start(self)
         self.batch_iter = None
 
+    def stop_producer(self):
+        if getattr(self, 'producer', None):
+            self.producer.close()
+            self.source_tokens[:] = self.producer.source_tokens
+            self.producer = None
+
+    def __del__(self):
+        self.stop_producer()
+        SSIterator.__del__(self)
+
     def next(self, batch_size = -1):
         """ 
         We can specify a batch size,
         independent of the object initialization. 
         """
+        # In process mode the workers deliver batches which are already padded and contain random variables
+        if getattr(self, 'producer', None):
+            if self.exit_flag:
+                return None
+            batch = self.producer.next()
+            if not batch:
+                self.exit_flag = True
+                self.stop_producer()
+            self.track_padding(batch)
+            return batch
+
         # If there are no more batches in list, try to generate new batches
         if not self.batch_iter:
             self.batch_iter = self.get_homogenous_batch_iter(batch_size)
@@ -282,7 +777,129 @@ class Iterator(SSIterator):
             # Keep track of last batch
             self.prev_batch = batch
         except StopIteration:
+            self.track_padding(None)
+            return None
+
+        self.track_padding(batch)
+        return batch
+
+# State entries which determine the segment batches of an iterator in evaluate mode
+BATCH_CACHE_STATE_KEYS = ['seed', 'bs', 'max_grad_steps', 'eos_sym', 'latent_gaussian_per_utterance_dim', \
+                          'length_buckets', 'batch_token_budget', 'pack_dialogues', 'batch_producer_processes']
+
+class CachedIterator(object):
+    """
+    Iterator over the segment batches of an Iterator in evaluate mode, which are materialized once
+    into a directory of flat binary files inside state['batch_cache_dir']. Each following pass
+    streams the batches as views into memory maps of these files, without constructing any batches.
+
+    The cache directory is named by a hash of the corpus files (path, size and modification time),
+    the iterator arguments and the state entries which determine the batches, so that the batches
+    are recomputed automatically whenever one of these changes.
+    """
+    MATRICES = SharedBatchRing.MATRICES + ['x_reset']
+
+    def __init__(self, dialogue_file, batch_size, **kwargs):
+        self.dialogue_file = dialogue_file
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+        self.state = kwargs['state']
+        self.dim = self.state['latent_gaussian_per_utterance_dim']
+        assert kwargs.get('evaluate_mode', False) and not kwargs.get('use_infinite_loop', False)
+
+        self.cache_path = os.path.join(self.state['batch_cache_dir'], self.cache_key())
+        if not os.path.isfile(os.path.join(self.cache_path, 'index.npz')):
+            self.write_cache()
+
+        index = numpy.load(os.path.join(self.cache_path, 'index.npz'))
+        self.segments = index['segments']
+        self.statistics = index['statistics']
+        self.data_len = int(index['data_len'])
+        self.position = len(self.segments)
+
+    def cache_key(self):
+        arguments = sorted((k, v) for k, v in self.kwargs.items() if k != 'state')
+        state = [(k, self.state.get(k, None)) for k in BATCH_CACHE_STATE_KEYS]
+        key = [corpus_signature(self.dialogue_file), self.batch_size, arguments, state]
+        return hashlib.md5(repr(key)).hexdigest()
+
+    def write_cache(self):
+        logger.debug('Writing batch cache %s' % self.cache_path)
+        tmp_path = self.cache_path + '.tmp%d' % os.getpid()
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        iterator = Iterator(self.dialogue_file, self.batch_size, **dict(self.kwargs))
+        iterator.start()
+
+        files = dict((key, open(os.path.join(tmp_path, key + '.bin'), 'wb')) for key in CachedIterator.MATRICES)
+        segments = []
+        statistics = []
+        while True:
+            batch = iterator.next()
+            if not batch:
+                break
+            for key in CachedIterator.MATRICES:
+                files[key].write(numpy.ascontiguousarray(batch[key], dtype=CachedIterator.dtype(key)).tobytes())
+            segments.append(batch['x'].shape)
+            statistics.append((batch['num_preds'], batch['num_dialogues']))
+
+        for f in files.values():
+            f.close()
+
+        numpy.savez(os.path.join(tmp_path, 'index.npz'), \
+                    segments=numpy.array(segments, dtype='int64').reshape((-1, 2)), \
+                    statistics=numpy.array(statistics, dtype='float64').reshape((-1, 2)), \
+                    data_len=iterator.data_len)
+
+        # Another process may have written the same cache in the meantime
+        if os.path.isdir(self.cache_path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, self.cache_path)
+
+    @staticmethod
+    def dtype(key):
+        return 'int32' if key in ['x', 'x_reversed'] else 'float32'
+
+    def start(self):
+        # Memory maps are opened in copy-on-write mode, so callers may modify the batches (e.g. the mask)
+        # without changing the cache. They are reopened on every pass to discard such modifications.
+        self.memmaps = {}
+        for key in CachedIterator.MATRICES:
+            filename = os.path.join(self.cache_path, key + '.bin')
+            if os.path.getsize(filename) > 0:
+                self.memmaps[key] = numpy.memmap(filename, dtype=CachedIterator.dtype(key), mode='c')
+
+        sizes = numpy.prod(self.segments, axis=1)
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(sizes)])
+        self.reset_offsets = numpy.concatenate([[0], numpy.cumsum(self.segments[:, 1])])
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.position >= len(self.segments):
             return None
+
+        i = self.position
+        self.position += 1
+
+        rows, cols = self.segments[i]
+        start, end = self.offsets[i], self.offsets[i + 1]
+
+        batch = {}
+        for key in SharedBatchRing.MATRICES:
+            if key == 'ran_var_constutterance':
+                batch[key] = self.memmaps[key][start * self.dim:end * self.dim].reshape((rows, cols, self.dim))
+            else:
+                batch[key] = self.memmaps[key][start:end].reshape((rows, cols))
+        batch['x_reset'] = self.memmaps['x_reset'][self.reset_offsets[i]:self.reset_offsets[i + 1]]
+        batch['max_length'] = int(rows)
+        batch['num_preds'] = numpy.float32(self.statistics[i, 0])
+        batch['num_dialogues'] = float(self.statistics[i, 1])
         return batch
 
 def get_train_iterator(state):
@@ -291,11 +908,18 @@ def get_train_iterator(state):
         int(state['bs']),
         state=state,
         seed=state['seed'],
+        corpus_weights=state.get('train_dialogues_weights', None) or None,
         use_infinite_loop=True,
         max_len=-1,
         evaluate_mode=False)
      
-    valid_data = Iterator(
+    # Validation batches are the same in every validation round, and may be cached
+    if state.get('batch_cache_dir', ''):
+        valid_iterator = CachedIterator
+    else:
+        valid_iterator = Iterator
+
+    valid_data = valid_iterator(
         state['valid_dialogues'],
         int(state['bs']),
         state=state,
@@ -309,7 +933,12 @@ def get_test_iterator(state):
     assert 'test_dialogues' in state
     test_path = state.get('test_dialogues')
 
-    test_data = Iterator(
+    if state.get('batch_cache_dir', ''):
+        test_iterator = CachedIterator
+    else:
+        test_iterator = Iterator
+
+    test_data = test_iterator(
         test_path,
         int(state['bs']), 
         state=state,
@@ -11,6 +11,8 @@ import theano.tensor as T
 import numpy as np
 import cPickle
 import logging
+import os
+import time
 logger = logging.getLogger(__name__)
 
 from theano import scan
@@ -21,9 +23,23 @@ from collections import OrderedDict
 
 from model import *
 from utils import *
+from vocabulary import Vocabulary
+from function_cache import FunctionCache
 
 import operator
 
+# Source files of the model and of the cache itself, which change the compiled functions or how they are pickled,
+# and the default state, whose new entries change the graph
+FUNCTION_CACHE_CODE_FILES = ['dialog_encdec.py', 'model.py', 'utils.py', 'adam.py', 'vocabulary.py', 'function_cache.py', 'state.py']
+
+# State entries which do not change the compiled functions
+FUNCTION_CACHE_IGNORED_STATE_KEYS = ['train_dialogues', 'train_dialogues_weights', 'valid_dialogues', 'test_dialogues', \
+                                     'dictionary', 'pretrained_word_embeddings_file', 'save_dir', 'prefix', 'run_id', \
+                                     'level', 'train_freq', 'valid_freq', 'loop_iters', 'time_stop', 'minerr', 'patience', \
+                                     'cost_threshold', 'sort_k_batches', 'length_buckets', 'batch_token_budget', \
+                                     'pack_dialogues', 'batch_cache_dir', 'batch_producer_processes', \
+                                     'batch_producer_buffer_size', 'function_cache_dir']
+
 # Theano speed-up
 #theano.config.scan.allow_gc = False
 #
@@ -45,6 +61,17 @@ class EncoderDecoderBase():
          
         self.params = []
 
+    def add_dialogue_reset(self, step):
+        """
+        Wraps a scan step function, which takes its sequences followed by a single recurrent state,
+        such that it takes the dialogue reset signal as an additional last sequence. The recurrent
+        state is set to zero before the first token of every dialogue packed into a batch column.
+        """
+        def step_with_dialogue_reset(*args):
+            r_t = args[-2].dimshuffle(0, 'x')
+            return step(*(args[:-2] + (r_t * args[-1],)))
+        return step_with_dialogue_reset
+
 class UtteranceEncoder(EncoderDecoderBase):
     """
     This is the GRU-gated RNN encoder class, which operates on hidden states at the word level (intra-utterance level).
@@ -116,7 +143,7 @@ class UtteranceEncoder(EncoderDecoderBase):
         # return both reset state and non-reset state
         return [h_t, r_t, z_t, h_tilde]
 
-    def build_encoder(self, x, xmask=None, prev_state=None, **kwargs):
+    def build_encoder(self, x, xmask=None, prev_state=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -182,8 +209,13 @@ class UtteranceEncoder(EncoderDecoderBase):
 
         # Run through all the utterances (encode everything)
         if not one_step: 
+            sequences = [xe, rolled_xmask]
+            if dialogue_reset is not None:
+                f_enc = self.add_dialogue_reset(f_enc)
+                sequences.append(dialogue_reset)
+
             _res, _ = theano.scan(f_enc,
-                              sequences=[xe, rolled_xmask],\
+                              sequences=sequences,\
                               outputs_info=o_enc_info)
         else: # Make just one step further
             _res = f_enc(xe, rolled_xmask, [h_0])[0]
@@ -246,7 +278,7 @@ class DCGMEncoder(EncoderDecoderBase):
     def approx_embedder(self, x):
         return self.W_emb[x]
 
-    def build_encoder(self, x, xmask=None, prev_state=None, **kwargs):
+    def build_encoder(self, x, xmask=None, prev_state=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -291,8 +323,15 @@ class DCGMEncoder(EncoderDecoderBase):
 
        # Run through all the utterances (encode everything)
         if not one_step: 
+            sequences = [xe, rolled_xmask]
+            if dialogue_reset is not None:
+                # The count n is stored as a row vector, so it is reset separately from the average
+                f_enc = lambda x_t, m_t, r_t, avg_past, n_past: \
+                            self.mean_step(x_t, m_t, r_t.dimshuffle(0, 'x') * avg_past, r_t.dimshuffle('x', 0) * n_past)
+                sequences.append(dialogue_reset)
+
             _res, _ = theano.scan(f_enc,
-                              sequences=[xe, rolled_xmask],\
+                              sequences=sequences,\
                               outputs_info=o_enc_info)
         else: # Make just one step further
             _res, _ = f_enc(xe, rolled_xmask, [avg_0, n_0])
@@ -378,7 +417,7 @@ class DialogEncoder(EncoderDecoderBase):
         hs_t = (m_t) * hs_tm1 + (1 - m_t) * hs_update
         return hs_t, hs_tilde, rs_t, zs_t
 
-    def build_encoder(self, h, x, xmask=None, prev_state=None, **kwargs):
+    def build_encoder(self, h, x, xmask=None, prev_state=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -419,8 +458,13 @@ class DialogEncoder(EncoderDecoderBase):
         
         # The hs sequence is based on the original mask
         if not one_step:
+            sequences = [h, xmask]
+            if dialogue_reset is not None:
+                f_hier = self.add_dialogue_reset(f_hier)
+                sequences.append(dialogue_reset)
+
             _res,  _ = theano.scan(f_hier,\
-                               sequences=[h, xmask],\
+                               sequences=sequences,\
                                outputs_info=o_hier_info)
         # Just one step further
         else:
@@ -463,7 +507,7 @@ class DialogDummyEncoder(EncoderDecoderBase):
         hs_t = (m_t) * hs_tm1 + (1 - m_t) * transformed_h_t 
         return hs_t
 
-    def build_encoder(self, h, x, xmask=None, prev_state=None, **kwargs):
+    def build_encoder(self, h, x, xmask=None, prev_state=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -500,8 +544,13 @@ class DialogDummyEncoder(EncoderDecoderBase):
         
         # The hs sequence is based on the original mask
         if not one_step:
+            sequences = [h, xmask]
+            if dialogue_reset is not None:
+                f_hier = self.add_dialogue_reset(f_hier)
+                sequences.append(dialogue_reset)
+
             _res,  _ = theano.scan(f_hier,\
-                               sequences=[h, xmask],\
+                               sequences=sequences,\
                                outputs_info=o_hier_info)
         # Just one step further
         else:
@@ -688,6 +737,25 @@ class UtteranceDecoder(EncoderDecoderBase):
              
             if self.decoder_bias_type != 'first': 
                 self.Wd_s_out = add_to_params(self.params, theano.shared(value=NormalInit(self.rng, self.input_dim, out_target_dim), name='Wd_s_out'))
+
+        # Set up adaptive softmax. The words share the output embeddings Wd_emb and biases bd_out
+        # with the full softmax, and the head cluster has an additional output embedding for each tail cluster.
+        if self.adaptive_softmax_cutoffs:
+            self.clusters = self.parent.adaptive_softmax_clusters
+            self.Wd_cluster_emb = add_to_params(self.params, theano.shared(value=NormalInit(self.rng, len(self.clusters) - 1, self.rankdim), name='Wd_cluster_emb'))
+            self.bd_cluster_out = add_to_params(self.params, theano.shared(value=np.zeros((len(self.clusters) - 1,), dtype='float32'), name='bd_cluster_out'))
+
+            # Cluster of each word, and position of each word in its cluster
+            word_cluster = np.zeros((self.idim,), dtype='int32')
+            word_position = np.zeros((self.idim,), dtype='int32')
+            for cluster, words in enumerate(self.clusters):
+                word_cluster[words] = cluster
+                word_position[words] = np.arange(len(words))
+            self.word_cluster = T.constant(word_cluster)
+            self.word_position = T.constant(word_position)
+
+            # Position of each word in the concatenation of all clusters
+            self.cluster_order_position = T.constant(np.argsort(np.concatenate(self.clusters)).astype('int32'))
    
     def build_output_layer(self, hs, xd, hd):
         if self.utterance_decoder_gating == "LSTM":
@@ -723,7 +791,57 @@ class UtteranceDecoder(EncoderDecoderBase):
      
     def output_softmax(self, pre_activ):
         # returns a (timestep, bs, idim) matrix (huge)
+        if self.adaptive_softmax_cutoffs:
+            return self.output_adaptive_softmax(pre_activ)
         return SoftMax(T.dot(pre_activ, self.Wd_emb.T) + self.bd_out)
+
+    def output_cluster_softmax(self, pre_activ, cluster):
+        # returns a (n, cluster size) matrix, where pre_activ is (n x rankdim)
+        # the head cluster (cluster 0) is followed by the probability of each tail cluster
+        words = self.clusters[cluster]
+        if cluster == 0:
+            return SoftMax(T.dot(pre_activ, T.concatenate([self.Wd_emb[words], self.Wd_cluster_emb]).T) \
+                           + T.concatenate([self.bd_out[words], self.bd_cluster_out]))
+        return SoftMax(T.dot(pre_activ, self.Wd_emb[words].T) + self.bd_out[words])
+
+    def output_adaptive_softmax(self, pre_activ):
+        # returns a (timestep, bs, idim) matrix (huge) with the probabilities of all clusters,
+        # where the probability of a tail word is the probability of its cluster times its probability in the cluster
+        flat_pre_activ = pre_activ
+        if pre_activ.ndim > 2:
+            flat_pre_activ = pre_activ.reshape((pre_activ.shape[0] * pre_activ.shape[1], pre_activ.shape[2]))
+
+        head_size = len(self.clusters[0])
+        head_probs = self.output_cluster_softmax(flat_pre_activ, 0)
+        probs = [head_probs[:, :head_size]]
+        for cluster in range(1, len(self.clusters)):
+            cluster_probs = head_probs[:, head_size + cluster - 1].dimshuffle(0, 'x')
+            probs.append(cluster_probs * self.output_cluster_softmax(flat_pre_activ, cluster))
+        probs = T.concatenate(probs, axis=1).T[self.cluster_order_position].T
+
+        if pre_activ.ndim > 2:
+            probs = probs.reshape((pre_activ.shape[0], pre_activ.shape[1], self.idim))
+        return probs
+
+    def output_adaptive_target_probs(self, pre_activ, y):
+        # returns a (timestep x bs) vector with the probability of each target word under the adaptive softmax
+        # every tail cluster is only computed for the targets in it, so the (timestep, bs, idim) matrix is never built
+        if pre_activ.ndim > 2:
+            pre_activ = pre_activ.reshape((pre_activ.shape[0] * pre_activ.shape[1], pre_activ.shape[2]))
+        y = y.flatten()
+        y_cluster = self.word_cluster[y]
+        y_position = self.word_position[y]
+
+        # Probability of the head word, or of the tail cluster of the target
+        head_size = len(self.clusters[0])
+        head_targets = T.switch(T.eq(y_cluster, 0), y_position, head_size + y_cluster - 1)
+        target_probs = GrabProbs(self.output_cluster_softmax(pre_activ, 0), head_targets)
+
+        for cluster in range(1, len(self.clusters)):
+            rows = T.eq(y_cluster, cluster).nonzero()[0]
+            cluster_target_probs = GrabProbs(self.output_cluster_softmax(pre_activ[rows], cluster), y_position[rows])
+            target_probs = T.set_subtensor(target_probs[rows], target_probs[rows] * cluster_target_probs)
+        return target_probs
     
     def output_nce(self, pre_activ, y, y_hat):
         # returns a (timestep, bs, pos + neg) matrix (very small)
@@ -746,7 +864,7 @@ class UtteranceDecoder(EncoderDecoderBase):
         neg_scores = - T.log(1 - T.nnet.sigmoid(neg_scores - T.log(neg_noise))).sum(0)
         return pos_scores + neg_scores
 
-    def build_decoder(self, decoder_inp, x, xmask=None, xdropmask=None, y=None, y_neg=None, mode=EVALUATION, prev_state=None, step_num=None):
+    def build_decoder(self, decoder_inp, x, xmask=None, xdropmask=None, y=None, y_neg=None, mode=EVALUATION, prev_state=None, step_num=None, dialogue_reset=None):
 
         # If model collapses to standard RNN reset all input to decoder
         if self.collaps_to_standard_rnn:
@@ -813,8 +931,13 @@ class UtteranceDecoder(EncoderDecoderBase):
         # then we evaluate by default all the utterances
         # xd - i.e. xd.ndim == 3, xd = (timesteps, batch_size, qdim_decoder)
         if mode == UtteranceDecoder.EVALUATION or mode == UtteranceDecoder.NCE: 
+            sequences = [xd, xmask, decoder_inp]
+            if dialogue_reset is not None:
+                f_dec = self.add_dialogue_reset(f_dec)
+                sequences.append(dialogue_reset)
+
             _res, _ = theano.scan(f_dec,
-                              sequences=[xd, xmask, decoder_inp],\
+                              sequences=sequences,\
                               outputs_info=o_dec_info)
         # else we evaluate only one step of the recurrence using the
         # previous hidden states and the previous computed hierarchical 
@@ -838,7 +961,10 @@ class UtteranceDecoder(EncoderDecoderBase):
         # target_probs.ndim == 3
         if mode == UtteranceDecoder.EVALUATION:
             outputs = self.output_softmax(pre_activ)
-            target_probs = GrabProbs(outputs, y)
+            if self.adaptive_softmax_cutoffs:
+                target_probs = self.output_adaptive_target_probs(pre_activ, y)
+            else:
+                target_probs = GrabProbs(outputs, y)
             return target_probs, hd, _res, outputs
 
         elif mode == UtteranceDecoder.NCE:
@@ -857,7 +983,7 @@ class UtteranceDecoder(EncoderDecoderBase):
             sample = self.trng.multinomial(pvals=outputs, dtype='int64').argmax(axis=-1)
             if outputs.ndim == 1:
                 sample = sample[0] 
-            log_prob = -T.log(T.diag(outputs.T[sample])) 
+            log_prob = -T.log(GrabProbs(outputs, sample))
             return sample, log_prob, hd
 
     def LSTM_step(self, xd_t, m_t, decoder_inp_t, hd_tm1): 
@@ -1064,7 +1190,7 @@ class DialogLevelLatentEncoder(EncoderDecoderBase):
 
         return hs_t
 
-    def build_encoder(self, h, x, xmask=None, latent_variable_mask=None, prev_state=None, **kwargs):
+    def build_encoder(self, h, x, xmask=None, latent_variable_mask=None, prev_state=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -1103,8 +1229,13 @@ class DialogLevelLatentEncoder(EncoderDecoderBase):
 
 
         if not one_step:
+            sequences = [h_out, xmask]
+            if dialogue_reset is not None:
+                f_hier = self.add_dialogue_reset(f_hier)
+                sequences.append(dialogue_reset)
+
             _res,  _ = theano.scan(f_hier,\
-                               sequences=[h_out, xmask],\
+                               sequences=sequences,\
                                outputs_info=o_hier_info)
 
         # Just one step further
@@ -1142,7 +1273,7 @@ class DialogLevelRollLeft(EncoderDecoderBase):
         hs_t = (m_t) * hs_tm1 + (1 - m_t) * h_t
         return hs_t
 
-    def build_encoder(self, h, x, xmask=None, **kwargs):
+    def build_encoder(self, h, x, xmask=None, dialogue_reset=None, **kwargs):
         one_step = False
         if len(kwargs):
             one_step = True
@@ -1178,8 +1309,16 @@ class DialogLevelRollLeft(EncoderDecoderBase):
         h_reversed = h[::-1]
         xmask_reversed = xmask[::-1]
         if not one_step:
+            sequences = [h_reversed, xmask_reversed]
+            if dialogue_reset is not None:
+                # Going backwards, the state is reset after the first token of every packed dialogue,
+                # so that no information is rolled over from the next dialogue.
+                next_dialogue_reset = T.concatenate([dialogue_reset[1:], T.ones_like(dialogue_reset[:1])], axis=0)
+                f_hier = self.add_dialogue_reset(f_hier)
+                sequences.append(next_dialogue_reset[::-1])
+
             _res,  _ = theano.scan(f_hier,\
-                               sequences=[h_reversed, xmask_reversed],\
+                               sequences=sequences,\
                                outputs_info=o_hier_info)
 
 
@@ -1292,16 +1431,42 @@ class DialogEncoderDecoder(Model):
 
         return updates
   
+    def shared_variables(self):
+        """
+        Returns the named shared variables of the model (parameters and previous states) by name.
+        """
+        variables = dict((param.name, param) for param in self.params)
+        for value in self.__dict__.values():
+            if isinstance(value, theano.compile.SharedVariable) and value.name:
+                variables.setdefault(value.name, value)
+        return variables
+
+    # Compiles a Theano function, and writes it to the compiled function cache
+    def compile_function(self, cache_name, **kwargs):
+        start_time = time.time()
+        function = theano.function(**kwargs)
+        self.function_cache.save(cache_name, function, self.shared_variables(), time.time() - start_time)
+        return function
+
+    # Returns a function from the compiled function cache, or None if it is not cached
+    def load_function(self, cache_name):
+        return self.function_cache.load(cache_name, self.shared_variables())
+
     # Batch training function.
     def build_train_function(self):
+        if self.inference_only:
+            raise Exception("Model was created with inference_only=True and cannot be trained!")
+
         if not hasattr(self, 'train_fn'):
+            self.train_fn = self.load_function('train_fn')
+        if self.train_fn is None:
             # Compile functions
             logger.debug("Building train function")
                 
-            self.train_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, 
+            self.train_fn = self.compile_function('train_fn', inputs=[self.x_data, self.x_data_reversed, 
                                                          self.x_max_length, self.x_cost_mask,
                                                          self.x_reset_mask, 
-                                                         self.ran_cost_utterance, self.x_dropmask],
+                                                         self.ran_cost_utterance, self.x_dropmask, self.x_dialogue_reset],
                                             outputs=[self.training_cost, self.kl_divergence_cost_acc, self.latent_utterance_variable_approx_posterior_mean_var],
                                             updates=self.updates + self.state_updates, 
                                             on_unused_input='warn', 
@@ -1312,13 +1477,16 @@ class DialogEncoderDecoder(Model):
     # Helper function used for computing the initial decoder hidden states before sampling starts.
     def build_decoder_encoding(self):
         if not hasattr(self, 'decoder_encoding_fn'):
+            self.decoder_encoding_fn = self.load_function('decoder_encoding_fn')
+        if self.decoder_encoding_fn is None:
             # Compile functions
             logger.debug("Building decoder encoding function")
+            self.build_training_graph()
                 
-            self.decoder_encoding_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, 
+            self.decoder_encoding_fn = self.compile_function('decoder_encoding_fn', inputs=[self.x_data, self.x_data_reversed, 
                                                          self.x_max_length, self.x_cost_mask,
                                                          self.x_reset_mask, 
-                                                         self.ran_cost_utterance, self.x_dropmask],
+                                                         self.ran_cost_utterance, self.x_dropmask, self.x_dialogue_reset],
                                             outputs=[self.hd],
                                             on_unused_input='warn', 
                                             name="decoder_encoding_fn")
@@ -1326,30 +1494,41 @@ class DialogEncoderDecoder(Model):
         return self.decoder_encoding_fn
 
     # Helper function used for the training with noise contrastive estimation (NCE).
-    # This function is currently not supported.
+    # The function only computes the scores of the targets and noise samples,
+    # and never the softmax over the whole vocabulary.
     def build_nce_function(self):
-        if not hasattr(self, 'train_fn'):
+        if self.inference_only:
+            raise Exception("Model was created with inference_only=True and cannot be trained!")
+        if not self.use_nce:
+            raise Exception("Model was created with use_nce=False and cannot be trained with NCE!")
+
+        if not hasattr(self, 'nce_fn'):
+            self.nce_fn = self.load_function('nce_fn')
+        if self.nce_fn is None:
             # Compile functions
             logger.debug("Building NCE train function")
 
-            self.nce_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, 
+            self.nce_fn = self.compile_function('nce_fn', inputs=[self.x_data, self.x_data_reversed, 
                                                   self.y_neg, self.x_max_length, 
                                                   self.x_cost_mask,
                                                   self.x_reset_mask, self.ran_cost_utterance, 
-                                                  self.x_dropmask],
+                                                  self.x_dropmask, self.x_dialogue_reset],
                                             outputs=[self.training_cost, self.kl_divergence_cost_acc, self.latent_utterance_variable_approx_posterior_mean_var],
-                                            updates=self.updates + self.state_updates, 
+                                            updates=self.updates + self.nce_state_updates, 
                                             on_unused_input='warn', 
-                                            name="train_fn")
+                                            name="nce_fn")
 
         return self.nce_fn
 
     # Batch evaluation function.
     def build_eval_function(self):
         if not hasattr(self, 'eval_fn'):
+            self.eval_fn = self.load_function('eval_fn')
+        if self.eval_fn is None:
             # Compile functions
             logger.debug("Building evaluation function")
-            self.eval_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_cost_mask, self.x_reset_mask, self.ran_cost_utterance, self.x_dropmask], 
+            self.build_training_graph()
+            self.eval_fn = self.compile_function('eval_fn', inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_cost_mask, self.x_reset_mask, self.ran_cost_utterance, self.x_dropmask, self.x_dialogue_reset], 
                                             outputs=[self.evaluation_cost, self.kl_divergence_cost_acc, self.softmax_cost, self.kl_divergence_cost, self.latent_utterance_variable_approx_posterior_mean_var], 
                                             updates=self.state_updates,
                                             on_unused_input='warn', name="eval_fn")
@@ -1358,9 +1537,12 @@ class DialogEncoderDecoder(Model):
     # Helper function used to compare gradients given by reconstruction cost (softmax cost) and KL divergence between prior and approximate posterior for the (forward) utterance encoder.
     def build_eval_grads(self):
         if not hasattr(self, 'grads_eval_fn'):
+            self.grads_eval_fn = self.load_function('grads_eval_fn')
+        if self.grads_eval_fn is None:
             # Compile functions
             logger.debug("Building grad eval function")
-            self.grads_eval_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_cost_mask, self.x_reset_mask, self.ran_cost_utterance, self.x_dropmask], 
+            self.build_training_graph()
+            self.grads_eval_fn = self.compile_function('grads_eval_fn', inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_cost_mask, self.x_reset_mask, self.ran_cost_utterance, self.x_dropmask, self.x_dialogue_reset], 
                                             outputs=[self.softmax_cost_acc, self.kl_divergence_cost_acc, self.grads_wrt_softmax_cost, self.grads_wrt_kl_divergence_cost],
                                             on_unused_input='warn', name="eval_fn")
         return self.grads_eval_fn
@@ -1368,11 +1550,14 @@ class DialogEncoderDecoder(Model):
     # Helper function used to compute encoder, context and decoder hidden states.
     def build_get_states_function(self):
         if not hasattr(self, 'get_states_fn'):
+            self.get_states_fn = self.load_function('get_states_fn')
+        if self.get_states_fn is None:
             # Compile functions
             logger.debug("Building selective function")
+            self.build_training_graph()
             
             outputs = [self.h, self.hs, self.hd] + [x for x in self.utterance_decoder_states]
-            self.get_states_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_reset_mask],
+            self.get_states_fn = self.compile_function('get_states_fn', inputs=[self.x_data, self.x_data_reversed, self.x_max_length, self.x_reset_mask, self.x_dialogue_reset],
                                             outputs=outputs, updates=self.state_updates, on_unused_input='warn',
                                             name="get_states_fn")
         return self.get_states_fn
@@ -1381,6 +1566,8 @@ class DialogEncoderDecoder(Model):
     # Currently this function does not supported truncated computations.
     def build_next_probs_function(self):
         if not hasattr(self, 'next_probs_fn'):
+            self.next_probs_fn = self.load_function('next_probs_fn')
+        if self.next_probs_fn is None:
 
             if self.add_latent_gaussian_per_utterance:
 
@@ -1405,7 +1592,7 @@ class DialogEncoderDecoder(Model):
                 decoder_inp = self.beam_hs
 
             outputs, hd = self.utterance_decoder.build_next_probs_predictor(decoder_inp, self.beam_source, prev_state=self.beam_hd)
-            self.next_probs_fn = theano.function(inputs=[self.beam_hs, self.beam_hd, self.beam_source, self.beam_x_data, self.beam_ran_cost_utterance],
+            self.next_probs_fn = self.compile_function('next_probs_fn', inputs=[self.beam_hs, self.beam_hd, self.beam_source, self.beam_x_data, self.beam_ran_cost_utterance],
                 outputs=[outputs, hd],
                 on_unused_input='warn',
                 name="next_probs_fn")
@@ -1417,6 +1604,8 @@ class DialogEncoderDecoder(Model):
     # then the encoding must be extracted at index of the last non-padded (non-zero) token.
     def build_encoder_function(self):
         if not hasattr(self, 'encoder_fn'):
+            self.encoder_fn = self.load_function('encoder_fn')
+        if self.encoder_fn is None:
 
             if self.bidirectional_utterance_encoder:
                 res_forward = self.utterance_encoder_forward.build_encoder(self.x_data)
@@ -1523,21 +1712,277 @@ class DialogEncoderDecoder(Model):
 
 
             if self.add_latent_gaussian_per_utterance:
-                self.encoder_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, \
+                self.encoder_fn = self.compile_function('encoder_fn', inputs=[self.x_data, self.x_data_reversed, \
                              self.x_max_length], \
                              outputs=[h, hs_complete, hd], on_unused_input='warn', name="encoder_fn")
                 #self.encoder_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, \
                 #             self.x_max_length], \
                 #             outputs=[h, hs_complete, hs_and_h_future, latent_utterance_variable_approx_posterior_mean], on_unused_input='warn', name="encoder_fn")
             else:
-                self.encoder_fn = theano.function(inputs=[self.x_data, self.x_data_reversed, \
+                self.encoder_fn = self.compile_function('encoder_fn', inputs=[self.x_data, self.x_data_reversed, \
                              self.x_max_length], \
                              outputs=[h, hs_complete, hd], on_unused_input='warn', name="encoder_fn")
 
 
         return self.encoder_fn
 
-    def __init__(self, state):
+    def build_training_graph(self):
+        """
+        Builds the graph of the training and evaluation costs of a batch and the updates of the
+        previous states variables. The graph is built by the constructor, unless the model is created
+        with inference_only=True (e.g. for sampling), in which case it is built on demand.
+        """
+        if hasattr(self, 'training_cost'):
+            return
+
+        # The 'x' data (input) is defined as all symbols except the last, and
+        # the 'y' data (output) is defined as all symbols except the first.
+        training_x = self.x_data[:(self.x_max_length-1)]
+        training_x_reversed = self.x_data_reversed[:(self.x_max_length-1)]
+        training_y = self.x_data[1:self.x_max_length]
+        training_x_dropmask = self.x_dropmask[:(self.x_max_length-1)]
+
+        # The noise samples for NCE are given for every symbol, like the 'x' data.
+        training_y_neg = self.y_neg[:, :(self.x_max_length-1)]
+
+        # The dialogue reset signal is zero at the first token of every dialogue packed into a column,
+        # where all RNN states are set to zero. Otherwise it is one.
+        training_x_dialogue_reset = self.x_dialogue_reset[:(self.x_max_length-1)]
+
+        # Here we find the end-of-utterance tokens in the minibatch.
+        training_hs_mask = T.neq(training_x, self.eos_sym)
+        training_x_cost_mask = self.x_cost_mask[1:self.x_max_length]
+        training_x_cost_mask_flat = training_x_cost_mask.flatten()
+
+        # Batches may have fewer columns than 'bs' (e.g. when they are formed under a token budget).
+        # In that case only the first columns of the previous states variables are used and updated.
+        batch_columns = self.x_data.shape[1]
+
+        # Build utterance encoders
+        if self.bidirectional_utterance_encoder:
+            logger.debug("Build forward utterance encoder")
+            res_forward = self.utterance_encoder_forward.build_encoder(training_x, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.ph_fwd[:batch_columns])
+
+            logger.debug("Build backward utterance encoder")
+            res_backward = self.utterance_encoder_backward.build_encoder(training_x_reversed, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.ph_bck[:batch_columns])
+
+            # The encoder h embedding is a concatenation of final states of the forward and backward encoder RNNs
+            self.h = T.concatenate([res_forward, res_backward], axis=2)
+
+        else:
+            logger.debug("Build utterance encoder")
+
+            # The encoder h embedding is the final hidden state of the forward encoder RNN
+            self.h = self.utterance_encoder.build_encoder(training_x, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.ph[:batch_columns])
+
+        logger.debug("Build dialog encoder")
+        self.hs = self.dialog_encoder.build_encoder(self.h, training_x, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.phs[:batch_columns])
+
+        # We initialize the stochastic "latent" variables
+        # platent_utterance_variable_prior
+        if self.add_latent_gaussian_per_utterance:
+            # First ,compute mask over latent Gaussian variables. 
+            # One means that a variable is part of the computational graph and zero that it's not.
+            latent_variable_mask = T.eq(training_x, self.eos_sym) * training_x_cost_mask
+
+            # We consider two kinds of prior: one case where the latent variable is 
+            # conditioned on the dialogue encoder, and one case where it is not conditioned on anything.
+            if self.condition_latent_variable_on_dialogue_encoder:
+                self.hs_to_condition_latent_variable_on = self.hs
+            else:
+                self.hs_to_condition_latent_variable_on = T.alloc(np.float32(0), self.hs.shape[0], self.hs.shape[1], self.hs.shape[2])
+
+            logger.debug("Build prior encoder for utterance-level latent variable")
+            _prior_out = self.latent_utterance_variable_prior_encoder.build_encoder(self.hs_to_condition_latent_variable_on, training_x, xmask=training_hs_mask, latent_variable_mask=latent_variable_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.platent_utterance_variable_prior[:batch_columns])
+
+            self.latent_utterance_variable_prior = _prior_out[0]
+            self.latent_utterance_variable_prior_mean = _prior_out[1]
+            self.latent_utterance_variable_prior_var = _prior_out[2]
+
+            # Retrieve hidden state at the end of next utterance from the utterance encoders
+            # (or at the end of the batch, if there are no end-of-token symbols at the end of the batch)
+            if self.condition_latent_variable_on_dcgm_encoder:
+                logger.debug("Build dcgm encoder")
+                latent_dcgm_res, self.latent_dcgm_avg, self.latent_dcgm_n = self.dcgm_encoder.build_encoder(training_x, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=[self.platent_dcgm_avg[:batch_columns], self.platent_dcgm_n[:, :batch_columns]])
+
+                self.h_future = self.utterance_encoder_rolledleft.build_encoder( \
+                                     latent_dcgm_res, \
+                                     training_x, \
+                                     xmask=training_hs_mask, \
+                                     dialogue_reset=training_x_dialogue_reset)
+
+            else:
+                self.h_future = self.utterance_encoder_rolledleft.build_encoder( \
+                                     self.h, \
+                                     training_x, \
+                                     xmask=training_hs_mask, \
+                                     dialogue_reset=training_x_dialogue_reset)
+
+
+            self.hs_and_h_future = T.concatenate([self.hs_to_condition_latent_variable_on, self.h_future], axis=2)
+
+            logger.debug("Build approximate posterior encoder for utterance-level latent variable")
+            _posterior_out = self.latent_utterance_variable_approx_posterior_encoder.build_encoder( \
+                                     self.hs_and_h_future, \
+                                     training_x, \
+                                     xmask=training_hs_mask, \
+                                     latent_variable_mask=latent_variable_mask, \
+                                     dialogue_reset=training_x_dialogue_reset, \
+                                     prev_state=self.platent_utterance_variable_approx_posterior[:batch_columns])
+            self.latent_utterance_variable_approx_posterior = _posterior_out[0]
+            self.latent_utterance_variable_approx_posterior_mean = _posterior_out[1]
+            self.latent_utterance_variable_approx_posterior_var = _posterior_out[2]
+
+
+
+            self.latent_utterance_variable_approx_posterior_mean_var = T.sum(T.mean(self.latent_utterance_variable_approx_posterior_var,axis=2)*latent_variable_mask) / (T.sum(latent_variable_mask) + 0.0000001)
+# * self.x_cost_mask[1:self.x_max_length]) * (T.sum(T.eq(training_x, self.eos_sym)) / (T.sum(training_x_cost_mask_flat)))
+
+            # Sample utterance latent variable from posterior
+            self.posterior_sample = self.ran_cost_utterance[:(self.x_max_length-1)] * T.sqrt(self.latent_utterance_variable_approx_posterior_var) + self.latent_utterance_variable_approx_posterior_mean
+
+            # Compute KL divergence cost
+            mean_diff_squared = (self.latent_utterance_variable_prior_mean \
+                                 - self.latent_utterance_variable_approx_posterior_mean)**2
+
+            logger.debug("Build KL divergence cost")
+            kl_divergences_between_prior_and_posterior            \
+                = (T.sum(self.latent_utterance_variable_approx_posterior_var/self.latent_utterance_variable_prior_var, axis=2)         \
+                   + T.sum(mean_diff_squared/self.latent_utterance_variable_prior_var, axis=2) \
+                   - self.latent_gaussian_per_utterance_dim   \
+                   + T.sum(T.log(self.latent_utterance_variable_prior_var), axis=2)              \
+                   - T.sum(T.log(self.latent_utterance_variable_approx_posterior_var), axis=2)          \
+                  ) / 2
+
+            self.kl_divergence_cost = kl_divergences_between_prior_and_posterior * latent_variable_mask
+            self.kl_divergence_cost_acc = T.sum(self.kl_divergence_cost)
+
+        else:
+            # Set KL divergence cost to zero
+            self.kl_divergence_cost = training_x_cost_mask*0
+            self.kl_divergence_cost_acc = theano.shared(value=numpy.float(0))
+            self.latent_utterance_variable_approx_posterior_mean_var = theano.shared(value=numpy.float(0))
+
+
+        if self.direct_connection_between_encoders_and_decoder:
+            logger.debug("Build dialog dummy encoder")
+            self.hs_dummy = self.dialog_dummy_encoder.build_encoder(self.h, training_x, xmask=training_hs_mask, dialogue_reset=training_x_dialogue_reset, prev_state=self.phs_dummy[:batch_columns])
+
+            if self.add_latent_gaussian_per_utterance:
+                if self.condition_decoder_only_on_latent_variable:
+                    self.hd_input = self.posterior_sample
+                else:
+                    self.hd_input = T.concatenate([self.hs, self.hs_dummy, self.posterior_sample], axis=2)
+            else:
+                self.hd_input = T.concatenate([self.hs, self.hs_dummy], axis=2)
+
+            if self.use_nce:
+                logger.debug("Build decoder (NCE) with direct connection from encoder(s)")
+                contrastive_cost, self.hd_nce = self.utterance_decoder.build_decoder(self.hd_input, training_x, y_neg=training_y_neg, y=training_y, xmask=training_hs_mask, xdropmask=training_x_dropmask, mode=UtteranceDecoder.NCE, dialogue_reset=training_x_dialogue_reset, prev_state=self.phd[:batch_columns])
+
+            logger.debug("Build decoder (EVAL) with direct connection from encoder(s)")
+            target_probs, self.hd, self.utterance_decoder_states, target_probs_full_matrix = self.utterance_decoder.build_decoder(self.hd_input, training_x, xmask=training_hs_mask, xdropmask=training_x_dropmask, y=training_y, mode=UtteranceDecoder.EVALUATION, dialogue_reset=training_x_dialogue_reset, prev_state=self.phd[:batch_columns])
+
+        else:
+            if self.add_latent_gaussian_per_utterance:
+                if self.condition_decoder_only_on_latent_variable:
+                    self.hd_input = self.posterior_sample
+                else:
+                    self.hd_input = T.concatenate([self.hs, self.posterior_sample], axis=2)
+            else:
+                self.hd_input = self.hs
+
+            if self.use_nce:
+                logger.debug("Build decoder (NCE)")
+                contrastive_cost, self.hd_nce = self.utterance_decoder.build_decoder(self.hd_input, training_x, y_neg=training_y_neg, y=training_y, xmask=training_hs_mask, xdropmask=training_x_dropmask, mode=UtteranceDecoder.NCE, dialogue_reset=training_x_dialogue_reset, prev_state=self.phd[:batch_columns])
+
+            logger.debug("Build decoder (EVAL)")
+            target_probs, self.hd, self.utterance_decoder_states, target_probs_full_matrix = self.utterance_decoder.build_decoder(self.hd_input, training_x, xmask=training_hs_mask, xdropmask=training_x_dropmask, y=training_y, mode=UtteranceDecoder.EVALUATION, dialogue_reset=training_x_dialogue_reset, prev_state=self.phd[:batch_columns])
+
+        # Prediction cost and rank cost
+        if self.use_nce:
+            self.contrastive_cost = T.sum(contrastive_cost.flatten() * training_x_cost_mask_flat)
+        self.softmax_cost = -T.log(target_probs) * training_x_cost_mask_flat
+        self.softmax_cost_acc = T.sum(self.softmax_cost)
+
+        # Prediction accuracy
+        self.training_misclassification = T.neq(T.argmax(target_probs_full_matrix, axis=2), training_y).flatten() * training_x_cost_mask_flat
+
+        self.training_misclassification_acc = T.sum(self.training_misclassification)
+
+        # Compute training cost, which equals standard cross-entropy error
+        # or the NCE cost. The evaluation cost is always the cross-entropy error.
+        self.training_cost = self.softmax_cost_acc
+        if self.use_nce:
+            self.training_cost = self.contrastive_cost
+        self.evaluation_cost = self.softmax_cost_acc
+
+        # Compute training cost as variational lower bound with possible annealing of KL-divergence term
+        if self.add_latent_gaussian_per_utterance:
+            if self.train_latent_gaussians_with_kl_divergence_annealing:
+                self.evaluation_cost = self.evaluation_cost + self.kl_divergence_cost_acc
+                self.training_cost = self.training_cost + self.kl_divergence_cost_weight*self.kl_divergence_cost_acc
+            else:
+                self.training_cost += self.kl_divergence_cost_acc
+                self.evaluation_cost = self.evaluation_cost + self.kl_divergence_cost_acc
+
+            # Compute gradient of utterance decoder Wd_hh for debugging purposes
+            self.grads_wrt_softmax_cost = T.grad(self.softmax_cost_acc, self.utterance_decoder.Wd_hh)
+            if self.bidirectional_utterance_encoder:
+                self.grads_wrt_kl_divergence_cost = T.grad(self.kl_divergence_cost_acc, self.utterance_encoder_forward.W_in)
+            else:
+                self.grads_wrt_kl_divergence_cost = T.grad(self.kl_divergence_cost_acc, self.utterance_encoder.W_in)
+
+
+
+
+        # Truncate gradients properly by bringing forward previous states
+        # First, create reset mask
+        x_reset = self.x_reset_mask.dimshuffle(0, 'x')
+        # if flag 'reset_hidden_states_between_subsequences' is on, then always reset
+        if self.reset_hidden_states_between_subsequences:
+            x_reset = 0
+
+        # Previous states are stored in the first columns, and the remaining columns are set to zero
+        def carry_update(prev_state, new_state):
+            return (prev_state, T.set_subtensor(T.zeros_like(prev_state)[:batch_columns], new_state))
+
+        # Next, compute updates using reset mask (this depends on the number of RNNs in the model)
+        self.state_updates = []
+        if self.bidirectional_utterance_encoder:
+            self.state_updates.append(carry_update(self.ph_fwd, x_reset * res_forward[-1]))
+            self.state_updates.append(carry_update(self.ph_bck, x_reset * res_backward[-1]))
+            self.state_updates.append(carry_update(self.phs, x_reset * self.hs[-1]))
+            self.state_updates.append(carry_update(self.phd, x_reset * self.hd[-1]))
+        else:
+            self.state_updates.append(carry_update(self.ph, x_reset * self.h[-1]))
+            self.state_updates.append(carry_update(self.phs, x_reset * self.hs[-1]))
+            self.state_updates.append(carry_update(self.phd, x_reset * self.hd[-1]))
+
+        if self.direct_connection_between_encoders_and_decoder:
+            self.state_updates.append(carry_update(self.phs_dummy, x_reset * self.hs_dummy[-1]))
+
+        if self.add_latent_gaussian_per_utterance:
+            self.state_updates.append(carry_update(self.platent_utterance_variable_prior, x_reset * self.latent_utterance_variable_prior[-1]))
+            self.state_updates.append(carry_update(self.platent_utterance_variable_approx_posterior, x_reset * self.latent_utterance_variable_approx_posterior[-1]))
+
+            if self.condition_latent_variable_on_dcgm_encoder:
+                self.state_updates.append(carry_update(self.platent_dcgm_avg, x_reset * self.latent_dcgm_avg[-1]))
+                self.state_updates.append((self.platent_dcgm_n, T.set_subtensor(T.zeros_like(self.platent_dcgm_n)[:, :batch_columns], x_reset.T * self.latent_dcgm_n[-1])))
+
+            if self.train_latent_gaussians_with_kl_divergence_annealing:
+                self.state_updates.append((self.kl_divergence_cost_weight, T.minimum(1.0, self.kl_divergence_cost_weight + self.kl_divergence_annealing_rate)))
+
+        # The NCE training function carries over the decoder states of the NCE decoder,
+        # so that it never evaluates the decoder with the full softmax output layer
+        if self.use_nce:
+            self.nce_state_updates = []
+            for prev_state, new_state in self.state_updates:
+                if prev_state is self.phd:
+                    new_state = carry_update(self.phd, x_reset * self.hd_nce[-1])[1]
+                self.nce_state_updates.append((prev_state, new_state))
+
+    def __init__(self, state, inference_only=False):
         Model.__init__(self)
 
         # Make sure eos_sym is never zero, otherwise generate_encodings script would fail
@@ -1598,10 +2043,15 @@ class DialogEncoderDecoder(Model):
            state['latent_gaussian_linear_dynamics'] = False
         if not 'train_latent_gaussians_with_kl_divergence_annealing' in state:
            state['train_latent_gaussians_with_kl_divergence_annealing'] = False
+        if not 'adaptive_softmax_cutoffs' in state:
+           state['adaptive_softmax_cutoffs'] = []
 
         if state['train_latent_gaussians_with_kl_divergence_annealing']:
             assert state['kl_divergence_annealing_rate']
 
+        if state['use_nce'] and state['adaptive_softmax_cutoffs']:
+            raise Exception("The adaptive softmax cannot be combined with NCE!")
+
         if state['collaps_to_standard_rnn']:
             # If we collapse to standard RNN (e.g. LSTM language model) then we should not reset.
             # If we did reset, we'd have a language model over individual utterances, which is what we want!
@@ -1611,27 +2061,24 @@ class DialogEncoderDecoder(Model):
         self.global_params = []
 
         self.__dict__.update(state)
+        self.inference_only = inference_only
         self.rng = numpy.random.RandomState(state['seed']) 
 
         # Load dictionary
-        raw_dict = cPickle.load(open(self.dictionary, 'rb'))
+        self.vocabulary = Vocabulary.load(self.dictionary)
 
         # Probabilities for each term in the corpus used for noise contrastive estimation (NCE)
-        self.noise_probs = [x[2] for x in sorted(raw_dict, key=operator.itemgetter(1))]
-        self.noise_probs = numpy.array(self.noise_probs, dtype='float64')
-        self.noise_probs /= numpy.sum(self.noise_probs)
-        self.noise_probs = self.noise_probs ** 0.75
-        self.noise_probs /= numpy.sum(self.noise_probs)
+        self.noise_probs = self.vocabulary.noise_probs
         
         self.t_noise_probs = theano.shared(self.noise_probs.astype('float32'), 't_noise_probs')
 
-        # Dictionaries to convert str to idx and vice-versa
-        self.str_to_idx = dict([(tok, tok_id) for tok, tok_id, _, _ in raw_dict])
-        self.idx_to_str = dict([(tok_id, tok) for tok, tok_id, freq, _ in raw_dict])
+        # Tables to convert str to idx and vice-versa
+        self.str_to_idx = self.vocabulary.str_to_idx
+        self.idx_to_str = self.vocabulary.words
 
         # Extract document (dialogue) frequency for each word
-        self.word_freq = dict([(tok_id, freq) for _, tok_id, freq, _ in raw_dict])
-        self.document_freq = dict([(tok_id, df) for _, tok_id, _, df in raw_dict])
+        self.word_freq = self.vocabulary.freqs
+        self.document_freq = self.vocabulary.dfs
 
         if self.end_sym_utterance not in self.str_to_idx:
            raise Exception("Error, malformed dictionary!")
@@ -1641,6 +2088,21 @@ class DialogEncoderDecoder(Model):
         self.state['idim'] = self.idim
         logger.debug("idim: " + str(self.idim))
 
+        # Clusters of the adaptive softmax by word frequency. The special symbols are always in the head cluster.
+        if self.adaptive_softmax_cutoffs:
+            special_syms = [value for key, value in self.state.items() if key.endswith('_sym') and 0 <= value < self.idim]
+            self.adaptive_softmax_clusters = self.vocabulary.frequency_clusters(self.adaptive_softmax_cutoffs, special_syms)
+            logger.debug("Adaptive softmax cluster sizes: " + str([len(words) for words in self.adaptive_softmax_clusters]))
+
+        # Compiled functions are cached by all state entries which may change them, and the model code
+        key_data = sorted((key, value) for key, value in self.state.items() if not key in FUNCTION_CACHE_IGNORED_STATE_KEYS)
+        # The adaptive softmax clusters are compiled into the functions, and depend on the dictionary
+        if self.adaptive_softmax_cutoffs:
+            key_data.append(('adaptive_softmax_clusters', [words.tolist() for words in self.adaptive_softmax_clusters]))
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        self.function_cache = FunctionCache(self.state.get('function_cache_dir', ''), key_data, \
+                                            [os.path.join(code_dir, filename) for filename in FUNCTION_CACHE_CODE_FILES])
+
         logger.debug("Initializing Theano variables")
         self.y_neg = T.itensor3('y_neg')
         self.x_data = T.imatrix('x_data')
@@ -1650,21 +2112,8 @@ class DialogEncoderDecoder(Model):
         self.x_max_length = T.iscalar('x_max_length')
         self.ran_cost_utterance = T.tensor3('ran_cost_utterance')
         self.x_dropmask = T.matrix('x_dropmask')
+        self.x_dialogue_reset = T.matrix('x_dialogue_reset')
 
-
-        
-        # The 'x' data (input) is defined as all symbols except the last, and
-        # the 'y' data (output) is defined as all symbols except the first.
-        training_x = self.x_data[:(self.x_max_length-1)]
-        training_x_reversed = self.x_data_reversed[:(self.x_max_length-1)]
-        training_y = self.x_data[1:self.x_max_length]
-        training_x_dropmask = self.x_dropmask[:(self.x_max_length-1)]
-
-        # Here we find the end-of-utterance tokens in the minibatch.
-        training_hs_mask = T.neq(training_x, self.eos_sym)
-        training_x_cost_mask = self.x_cost_mask[1:self.x_max_length]
-        training_x_cost_mask_flat = training_x_cost_mask.flatten()
-        
         # Backward compatibility
         if 'decoder_bias_type' in self.state:
             logger.debug("Decoder bias type {}".format(self.decoder_bias_type))
@@ -1720,61 +2169,25 @@ class DialogEncoderDecoder(Model):
                 self.platent_dcgm_n = theano.shared(value=numpy.zeros((1, self.bs), dtype='float32'), name='platent_dcgm_n')
 
 
-        # Build utterance encoders
+        # Initialize utterance encoders
         if self.bidirectional_utterance_encoder:
             logger.debug("Initializing forward utterance encoder")
             self.utterance_encoder_forward = UtteranceEncoder(self.state, self.rng, self.W_emb, self, 'fwd')
-            logger.debug("Build forward utterance encoder")
-            res_forward = self.utterance_encoder_forward.build_encoder(training_x, xmask=training_hs_mask, prev_state=self.ph_fwd)
 
             logger.debug("Initializing backward utterance encoder")
             self.utterance_encoder_backward = UtteranceEncoder(self.state, self.rng, self.W_emb, self, 'bck')
-            logger.debug("Build backward utterance encoder")
-            res_backward = self.utterance_encoder_backward.build_encoder(training_x_reversed, xmask=training_hs_mask, prev_state=self.ph_bck)
-
-            # The encoder h embedding is a concatenation of final states of the forward and backward encoder RNNs
-            self.h = T.concatenate([res_forward, res_backward], axis=2)
-
         else:
             logger.debug("Initializing utterance encoder")
             self.utterance_encoder = UtteranceEncoder(self.state, self.rng, self.W_emb, self, 'fwd')
 
-            logger.debug("Build utterance encoder")
-
-            # The encoder h embedding is the final hidden state of the forward encoder RNN
-            self.h = self.utterance_encoder.build_encoder(training_x, xmask=training_hs_mask, prev_state=self.ph)
-
         logger.debug("Initializing dialog encoder")
         self.dialog_encoder = DialogEncoder(self.state, self.rng, self, '')
 
-        logger.debug("Build dialog encoder")
-        self.hs = self.dialog_encoder.build_encoder(self.h, training_x, xmask=training_hs_mask, prev_state=self.phs)
-
         # We initialize the stochastic "latent" variables
-        # platent_utterance_variable_prior
         if self.add_latent_gaussian_per_utterance:
             logger.debug("Initializing prior encoder for utterance-level latent variable")
-
-            # First ,compute mask over latent Gaussian variables. 
-            # One means that a variable is part of the computational graph and zero that it's not.
-            latent_variable_mask = T.eq(training_x, self.eos_sym) * training_x_cost_mask
-
-            # We consider two kinds of prior: one case where the latent variable is 
-            # conditioned on the dialogue encoder, and one case where it is not conditioned on anything.
-            if self.condition_latent_variable_on_dialogue_encoder:
-                self.hs_to_condition_latent_variable_on = self.hs
-            else:
-                self.hs_to_condition_latent_variable_on = T.alloc(np.float32(0), self.hs.shape[0], self.hs.shape[1], self.hs.shape[2])
-
             self.latent_utterance_variable_prior_encoder = DialogLevelLatentEncoder(self.state, self.sdim, self.latent_gaussian_per_utterance_dim, self.rng, self, 'latent_utterance_prior')
 
-            logger.debug("Build prior encoder for utterance-level latent variable")
-            _prior_out = self.latent_utterance_variable_prior_encoder.build_encoder(self.hs_to_condition_latent_variable_on, training_x, xmask=training_hs_mask, latent_variable_mask=latent_variable_mask, prev_state=self.platent_utterance_variable_prior)
-
-            self.latent_utterance_variable_prior = _prior_out[0]
-            self.latent_utterance_variable_prior_mean = _prior_out[1]
-            self.latent_utterance_variable_prior_var = _prior_out[2]
-
             logger.debug("Initializing approximate posterior encoder for utterance-level latent variable")
             if self.bidirectional_utterance_encoder and not self.condition_latent_variable_on_dcgm_encoder:
                 posterior_input_size = self.sdim + self.qdim_encoder*2
@@ -1790,69 +2203,10 @@ class DialogEncoderDecoder(Model):
 
             if self.condition_latent_variable_on_dcgm_encoder:
                 logger.debug("Initializing dcgm encoder for conditioning input to the utterance-level latent variable")
-
                 self.dcgm_encoder = DCGMEncoder(self.state, self.rng, self.W_emb, self.qdim_encoder, self, 'latent_dcgm_encoder')
-                logger.debug("Build dcgm encoder")
-                latent_dcgm_res, self.latent_dcgm_avg, self.latent_dcgm_n = self.dcgm_encoder.build_encoder(training_x, xmask=training_hs_mask, prev_state=[self.platent_dcgm_avg, self.platent_dcgm_n])
-
-                self.h_future = self.utterance_encoder_rolledleft.build_encoder( \
-                                     latent_dcgm_res, \
-                                     training_x, \
-                                     xmask=training_hs_mask)
-
-            else:
-                self.h_future = self.utterance_encoder_rolledleft.build_encoder( \
-                                     self.h, \
-                                     training_x, \
-                                     xmask=training_hs_mask)
-
 
             self.latent_utterance_variable_approx_posterior_encoder = DialogLevelLatentEncoder(self.state, posterior_input_size, self.latent_gaussian_per_utterance_dim, self.rng, self, 'latent_utterance_approx_posterior')
 
-            self.hs_and_h_future = T.concatenate([self.hs_to_condition_latent_variable_on, self.h_future], axis=2)
-
-            logger.debug("Build approximate posterior encoder for utterance-level latent variable")
-            _posterior_out = self.latent_utterance_variable_approx_posterior_encoder.build_encoder( \
-                                     self.hs_and_h_future, \
-                                     training_x, \
-                                     xmask=training_hs_mask, \
-                                     latent_variable_mask=latent_variable_mask, \
-                                     prev_state=self.platent_utterance_variable_approx_posterior)
-            self.latent_utterance_variable_approx_posterior = _posterior_out[0]
-            self.latent_utterance_variable_approx_posterior_mean = _posterior_out[1]
-            self.latent_utterance_variable_approx_posterior_var = _posterior_out[2]
-
-
-
-            self.latent_utterance_variable_approx_posterior_mean_var = T.sum(T.mean(self.latent_utterance_variable_approx_posterior_var,axis=2)*latent_variable_mask) / (T.sum(latent_variable_mask) + 0.0000001)
-# * self.x_cost_mask[1:self.x_max_length]) * (T.sum(T.eq(training_x, self.eos_sym)) / (T.sum(training_x_cost_mask_flat)))
-
-            # Sample utterance latent variable from posterior
-            self.posterior_sample = self.ran_cost_utterance[:(self.x_max_length-1)] * T.sqrt(self.latent_utterance_variable_approx_posterior_var) + self.latent_utterance_variable_approx_posterior_mean
-
-            # Compute KL divergence cost
-            mean_diff_squared = (self.latent_utterance_variable_prior_mean \
-                                 - self.latent_utterance_variable_approx_posterior_mean)**2
-
-            logger.debug("Build KL divergence cost")
-            kl_divergences_between_prior_and_posterior            \
-                = (T.sum(self.latent_utterance_variable_approx_posterior_var/self.latent_utterance_variable_prior_var, axis=2)         \
-                   + T.sum(mean_diff_squared/self.latent_utterance_variable_prior_var, axis=2) \
-                   - state['latent_gaussian_per_utterance_dim']   \
-                   + T.sum(T.log(self.latent_utterance_variable_prior_var), axis=2)              \
-                   - T.sum(T.log(self.latent_utterance_variable_approx_posterior_var), axis=2)          \
-                  ) / 2
-
-            self.kl_divergence_cost = kl_divergences_between_prior_and_posterior * latent_variable_mask
-            self.kl_divergence_cost_acc = T.sum(self.kl_divergence_cost)
-
-        else:
-            # Set KL divergence cost to zero
-            self.kl_divergence_cost = training_x_cost_mask*0
-            self.kl_divergence_cost_acc = theano.shared(value=numpy.float(0))
-            self.latent_utterance_variable_approx_posterior_mean_var = theano.shared(value=numpy.float(0))
-
-
         # We initialize the decoder, and fix its word embeddings to that of the encoder(s)
         logger.debug("Initializing decoder")
         self.utterance_decoder = UtteranceDecoder(self.state, self.rng, self, self.dialog_encoder, self.W_emb)
@@ -1864,74 +2218,9 @@ class DialogEncoderDecoder(Model):
             else:
                 self.dialog_dummy_encoder = DialogDummyEncoder(self.state, self.rng, self, self.qdim_encoder)
 
-            logger.debug("Build dialog dummy encoder")
-            self.hs_dummy = self.dialog_dummy_encoder.build_encoder(self.h, training_x, xmask=training_hs_mask, prev_state=self.phs_dummy)
-
-            logger.debug("Build decoder (NCE) with direct connection from encoder(s)")
-            if self.add_latent_gaussian_per_utterance:
-                if self.condition_decoder_only_on_latent_variable:
-                    self.hd_input = self.posterior_sample
-                else:
-                    self.hd_input = T.concatenate([self.hs, self.hs_dummy, self.posterior_sample], axis=2)
-            else:
-                self.hd_input = T.concatenate([self.hs, self.hs_dummy], axis=2)
-
-            contrastive_cost, self.hd_nce = self.utterance_decoder.build_decoder(self.hd_input, training_x, y_neg=self.y_neg, y=training_y, xmask=training_hs_mask, xdropmask=training_x_dropmask, mode=UtteranceDecoder.NCE, prev_state=self.phd)
-
-            logger.debug("Build decoder (EVAL) with direct connection from encoder(s)")
-            target_probs, self.hd, self.utterance_decoder_states, target_probs_full_matrix = self.utterance_decoder.build_decoder(self.hd_input, training_x, xmask=training_hs_mask, xdropmask=training_x_dropmask, y=training_y, mode=UtteranceDecoder.EVALUATION, prev_state=self.phd)
-
-        else:
-            if self.add_latent_gaussian_per_utterance:
-                if self.condition_decoder_only_on_latent_variable:
-                    self.hd_input = self.posterior_sample
-                else:
-                    self.hd_input = T.concatenate([self.hs, self.posterior_sample], axis=2)
-            else:
-                self.hd_input = self.hs
-
-            logger.debug("Build decoder (NCE)")
-            contrastive_cost, self.hd_nce = self.utterance_decoder.build_decoder(self.hd_input, training_x, y_neg=self.y_neg, y=training_y, xmask=training_hs_mask, xdropmask=training_x_dropmask, mode=UtteranceDecoder.NCE, prev_state=self.phd)
-
-            logger.debug("Build decoder (EVAL)")
-            target_probs, self.hd, self.utterance_decoder_states, target_probs_full_matrix = self.utterance_decoder.build_decoder(self.hd_input, training_x, xmask=training_hs_mask, xdropmask=training_x_dropmask, y=training_y, mode=UtteranceDecoder.EVALUATION, prev_state=self.phd)
-
-        # Prediction cost and rank cost
-        self.contrastive_cost = T.sum(contrastive_cost.flatten() * training_x_cost_mask_flat)
-        self.softmax_cost = -T.log(target_probs) * training_x_cost_mask_flat
-        self.softmax_cost_acc = T.sum(self.softmax_cost)
-
-        # Prediction accuracy
-        self.training_misclassification = T.neq(T.argmax(target_probs_full_matrix, axis=2), training_y).flatten() * training_x_cost_mask_flat
-
-        self.training_misclassification_acc = T.sum(self.training_misclassification)
-
-        # Compute training cost, which equals standard cross-entropy error
-        self.training_cost = self.softmax_cost_acc
-        if self.use_nce:
-            self.training_cost = self.contrastive_cost
-
-        # Compute training cost as variational lower bound with possible annealing of KL-divergence term
-        if self.add_latent_gaussian_per_utterance:
-            if self.train_latent_gaussians_with_kl_divergence_annealing:
-                self.evaluation_cost = self.training_cost + self.kl_divergence_cost_acc
-
-                self.kl_divergence_cost_weight = add_to_params(self.global_params, theano.shared(value=numpy.float32(0), name='kl_divergence_cost_weight'))
-                self.training_cost = self.training_cost + self.kl_divergence_cost_weight*self.kl_divergence_cost_acc
-            else:
-                self.training_cost += self.kl_divergence_cost_acc
-                self.evaluation_cost = self.training_cost
-
-            # Compute gradient of utterance decoder Wd_hh for debugging purposes
-            self.grads_wrt_softmax_cost = T.grad(self.softmax_cost_acc, self.utterance_decoder.Wd_hh)
-            if self.bidirectional_utterance_encoder:
-                self.grads_wrt_kl_divergence_cost = T.grad(self.kl_divergence_cost_acc, self.utterance_encoder_forward.W_in)
-            else:
-                self.grads_wrt_kl_divergence_cost = T.grad(self.kl_divergence_cost_acc, self.utterance_encoder.W_in)
-        else:
-            self.evaluation_cost = self.training_cost
-
-
+        # Weight of the KL divergence term, which is annealed during training
+        if self.add_latent_gaussian_per_utterance and self.train_latent_gaussians_with_kl_divergence_annealing:
+            self.kl_divergence_cost_weight = add_to_params(self.global_params, theano.shared(value=numpy.float32(0), name='kl_divergence_cost_weight'))
 
         # Init params
         if self.collaps_to_standard_rnn:
@@ -1980,40 +2269,12 @@ class DialogEncoderDecoder(Model):
             if not param in self.params_to_exclude:
                 self.params_to_train += [param]
 
-        self.updates = self.compute_updates(self.training_cost / training_x.shape[1], self.params_to_train)
-
-        # Truncate gradients properly by bringing forward previous states
-        # First, create reset mask
-        x_reset = self.x_reset_mask.dimshuffle(0, 'x')
-        # if flag 'reset_hidden_states_between_subsequences' is on, then always reset
-        if self.reset_hidden_states_between_subsequences:
-            x_reset = 0
-
-        # Next, compute updates using reset mask (this depends on the number of RNNs in the model)
-        self.state_updates = []
-        if self.bidirectional_utterance_encoder:
-            self.state_updates.append((self.ph_fwd, x_reset * res_forward[-1]))
-            self.state_updates.append((self.ph_bck, x_reset * res_backward[-1]))
-            self.state_updates.append((self.phs, x_reset * self.hs[-1]))
-            self.state_updates.append((self.phd, x_reset * self.hd[-1]))
+        # The training graph and the optimizer state are not needed for sampling and encoding
+        if self.inference_only:
+            self.updates = []
         else:
-            self.state_updates.append((self.ph, x_reset * self.h[-1]))
-            self.state_updates.append((self.phs, x_reset * self.hs[-1]))
-            self.state_updates.append((self.phd, x_reset * self.hd[-1]))
-
-        if self.direct_connection_between_encoders_and_decoder:
-            self.state_updates.append((self.phs_dummy, x_reset * self.hs_dummy[-1]))
-
-        if self.add_latent_gaussian_per_utterance:
-            self.state_updates.append((self.platent_utterance_variable_prior, x_reset * self.latent_utterance_variable_prior[-1]))
-            self.state_updates.append((self.platent_utterance_variable_approx_posterior, x_reset * self.latent_utterance_variable_approx_posterior[-1]))
-
-            if self.condition_latent_variable_on_dcgm_encoder:
-                self.state_updates.append((self.platent_dcgm_avg, x_reset * self.latent_dcgm_avg[-1]))
-                self.state_updates.append((self.platent_dcgm_n, x_reset.T * self.latent_dcgm_n[-1]))
-
-            if self.train_latent_gaussians_with_kl_divergence_annealing:
-                self.state_updates.append((self.kl_divergence_cost_weight, T.minimum(1.0, self.kl_divergence_cost_weight + self.kl_divergence_annealing_rate)))
+            self.build_training_graph()
+            self.updates = self.compute_updates(self.training_cost / self.x_data.shape[1], self.params_to_train)
 
 
         # Beam-search variables
@@ -51,6 +51,9 @@ def parse_args():
     parser.add_argument("--exclude-stop-words", action="store_true",
                        help="Exclude stop words (English pronouns, puntucation signs and special tokens) from all metrics. These words make up approximate 48.37% of the training set, so removing them should focus the metrics on the topical content and ignore syntatic errors.")
 
+    parser.add_argument("--batch-cache-dir",
+            type=str, help="Directory in which the padded test batches are cached. If the batches have been cached before, they are read from the cache.")
+
     parser.add_argument("--document-ids",
             type=str, help="File containing document ids for each triple (one id per line, if there are multiple tabs the first entry will be taken as the doc id). If this is given the script will compute standard deviations across documents for all metrics. CURRENTLY NOT IMPLEMENTED.")
 
@@ -80,6 +83,9 @@ def main():
     if args.test_path:
         state['test_dialogues'] = args.test_path
 
+    if args.batch_cache_dir:
+        state['batch_cache_dir'] = args.batch_cache_dir
+
     # Initialize list of stopwords to remove
     if args.exclude_stop_words:
         logger.debug("Initializing stop-word list")
@@ -135,6 +141,7 @@ def main():
         reset_mask = batch['x_reset']
         ran_cost_utterance = batch['ran_var_constutterance']
         ran_decoder_drop_mask = batch['ran_decoder_drop_mask']
+        x_dialogue_reset = batch['x_dialogue_reset']
 
         if args.exclude_stop_words:
             for word_index in stopwords_indices:
@@ -142,7 +149,7 @@ def main():
 
         batch['num_preds'] = numpy.sum(x_cost_mask)
 
-        c, _, c_list, _, _  = eval_batch(x_data, x_data_reversed, max_length, x_cost_mask, reset_mask, ran_cost_utterance, ran_decoder_drop_mask)
+        c, _, c_list, _, _  = eval_batch(x_data, x_data_reversed, max_length, x_cost_mask, reset_mask, ran_cost_utterance, ran_decoder_drop_mask, x_dialogue_reset)
 
         c_list = c_list.reshape((batch['x'].shape[1],max_length-1), order=(1,0))
         c_list = numpy.sum(c_list, axis=1)     
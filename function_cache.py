@@ -0,0 +1,128 @@
+"""
+Cache of compiled Theano functions.
+
+Compiling the functions of a large model (graph optimization and linking) takes minutes.
+A FunctionCache pickles every compiled function to '<cache_dir>/<name>.<key>.pkl', where
+the key hashes the model configuration, the model code and the Theano configuration,
+and later runs with the same key unpickle the function instead of compiling it.
+
+The shared variables of the model (parameters and previous states), their storage and their
+values are pickled by name only (as persistent ids), and are resolved to the shared variables
+of the loading model. The loaded functions therefore read and update the parameters of the model
+in place, exactly like freshly compiled functions. Other shared variables (e.g. optimizer
+statistics) are pickled with the function, and belong to it alone.
+"""
+
+import os
+import sys
+import time
+import cPickle
+import cStringIO
+import hashlib
+import logging
+import zlib
+
+import theano
+
+logger = logging.getLogger(__name__)
+
+# Pickling and unpickling a graph recurses once per node
+RECURSION_LIMIT = 100000
+
+class FunctionCache(object):
+    """
+    Compiled functions cache in the directory 'cache_dir'. The key of the cache is computed from
+    'key_data' (a picklable description of the model configuration), the contents of the
+    files 'code_files' and the Theano version and configuration.
+    Caching is disabled if 'cache_dir' is empty.
+    """
+    def __init__(self, cache_dir, key_data, code_files=[]):
+        self.cache_dir = cache_dir
+        self.time_saved = 0.
+
+        key = hashlib.sha1()
+        key.update(repr(key_data))
+        for filename in code_files:
+            key.update(open(filename, 'rb').read())
+        key.update(repr((theano.__version__, theano.config.floatX, theano.config.device, \
+                         theano.config.mode, theano.config.optimizer, theano.config.linker)))
+        self.key = key.hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, '%s.%s.pkl' % (name, self.key))
+
+    def load(self, name, shared_variables):
+        """
+        Returns the cached function 'name', operating on the given shared variables
+        (a dictionary of names to shared variables), or None if it is not cached.
+        """
+        if not self.cache_dir or not os.path.isfile(self.path(name)):
+            return None
+
+        def persistent_load(persistent_id):
+            kind, variable_name = persistent_id
+            variable = shared_variables[variable_name]
+            if kind == 'variable':
+                return variable
+            elif kind == 'container':
+                return variable.container
+            elif kind == 'storage':
+                return variable.container.storage
+            return variable.get_value(borrow=True, return_internal_type=True)
+
+        start_time = time.time()
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+        try:
+            with open(self.path(name), 'rb') as f:
+                unpickler = cPickle.Unpickler(cStringIO.StringIO(zlib.decompress(f.read())))
+            unpickler.persistent_load = persistent_load
+            cached = unpickler.load()
+        except Exception as e:
+            logger.warning("Could not load function %s from %s: %s" % (name, self.path(name), e))
+            return None
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+        load_time = time.time() - start_time
+        self.time_saved += max(0., cached['compile_time'] - load_time)
+        logger.debug("Loaded function %s from cache in %.1f s (compiled in %.1f s)" % (name, load_time, cached['compile_time']))
+        return cached['function']
+
+    def save(self, name, function, shared_variables, compile_time):
+        """
+        Writes the function 'name' to the cache. The given shared variables
+        (a dictionary of names to shared variables) are stored by name.
+        """
+        if not self.cache_dir:
+            return
+
+        persistent_ids = {}
+        for variable_name, variable in shared_variables.items():
+            persistent_ids[id(variable)] = ('variable', variable_name)
+            persistent_ids[id(variable.container)] = ('container', variable_name)
+            persistent_ids[id(variable.container.storage)] = ('storage', variable_name)
+            persistent_ids[id(variable.get_value(borrow=True, return_internal_type=True))] = ('value', variable_name)
+
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+        try:
+            data = cStringIO.StringIO()
+            pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = lambda obj: persistent_ids.get(id(obj))
+            pickler.dump({'function': function, 'compile_time': compile_time})
+
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_filename = self.path(name) + '.tmp%d' % os.getpid()
+            with open(tmp_filename, 'wb') as f:
+                f.write(zlib.compress(data.getvalue(), 1))
+            os.rename(tmp_filename, self.path(name))
+        except Exception as e:
+            logger.warning("Could not save function %s to %s: %s" % (name, self.path(name), e))
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+    def report(self):
+        if self.cache_dir:
+            logger.info("Compiled function cache saved %.1f s of compilation" % self.time_saved)
@@ -259,7 +259,7 @@ def init(path):
     
     logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
 
-    model = DialogEncoderDecoder(state) 
+    model = DialogEncoderDecoder(state, inference_only=True)
     
     if os.path.isfile(model_path):
         logger.debug("Loading previous model")
@@ -20,7 +20,9 @@ class Model(object):
         Save the model to file `filename`
         """
         vals = dict([(x.name, x.get_value()) for x in self.params])
-        os.makedirs(os.path.split(filename)[0])
+        directory = os.path.split(filename)[0]
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
         numpy.savez(filename, **vals)
 
     def load(self, filename, parameter_strings_to_ignore=[]):
@@ -76,7 +76,7 @@ def main():
 
     logging.basicConfig(level=getattr(logging, state['level']), format="%(asctime)s: %(name)s: %(levelname)s: %(message)s")
 
-    model = DialogEncoderDecoder(state) 
+    model = DialogEncoderDecoder(state, inference_only=True)
     
     sampler = search.RandomSampler(model)
     if args.beam_search:
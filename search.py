@@ -87,6 +87,7 @@ class Sampler(object):
         if not self.model.reset_utterance_decoder_at_end_of_utterance:
             self.compute_decoder_encoding = self.model.build_decoder_encoding()
 
+        self.model.function_cache.report()
         self.compiled = True
     
     def select_next_words(self, next_probs, step_num, how_many):
@@ -146,9 +147,10 @@ class Sampler(object):
             ran_vector = self.model.rng.normal(size=(context.shape[0],n_samples,self.model.latent_gaussian_per_utterance_dim)).astype('float32')
             zero_mask = numpy.zeros((context.shape[0], self.model.bs), dtype='float32')
             ones_mask = numpy.zeros((context.shape[0], self.model.bs), dtype='float32')
+            dialogue_reset = numpy.ones((context.shape[0], self.model.bs), dtype='float32')
 
             # Computes new utterance decoder hidden states (including intermediate utterance encoder and dialogue encoder hidden states)
-            new_hd = self.compute_decoder_encoding(enlarged_context, enlarged_reversed_context, self.max_len, zero_mask, numpy.zeros((self.model.bs), dtype='float32'), ran_vector, ones_mask)
+            new_hd = self.compute_decoder_encoding(enlarged_context, enlarged_reversed_context, self.max_len, zero_mask, numpy.zeros((self.model.bs), dtype='float32'), ran_vector, ones_mask, dialogue_reset)
             prev_hd[:] = new_hd[0][-1][0:context.shape[1], :]
 
 
@@ -0,0 +1,104 @@
+"""
+Approximate word counting in bounded memory.
+
+A CountMinSketch estimates the frequency of every word from a fixed-size table
+of counters, and a SpaceSaving summary keeps track of the most frequent words.
+Both can be built for parts of a corpus independently and merged, and are used
+by convert-text2dict.py to find the candidates for a vocabulary with a cutoff,
+which are then counted exactly in a second pass.
+"""
+
+import heapq
+
+import numpy
+
+# Mersenne prime used by the hash functions of the count-min sketch
+HASH_PRIME = 2**31 - 1
+
+class CountMinSketch(object):
+    """
+    Count-min sketch with 'depth' rows of 'width' counters. Every row hashes each word
+    to one counter, and the estimate of a word is the minimum of its counters, which
+    never underestimates its frequency.
+    """
+    def __init__(self, width, depth, seed=1234):
+        self.width = width
+        self.depth = depth
+        rng = numpy.random.RandomState(seed)
+        self.a = rng.randint(1, HASH_PRIME, size=depth).astype('int64')
+        self.b = rng.randint(0, HASH_PRIME, size=depth).astype('int64')
+        self.table = numpy.zeros((depth, width), dtype='int64')
+
+    def _buckets(self, words):
+        hashes = numpy.fromiter((hash(word) & 0x7fffffff for word in words), dtype='int64', count=len(words))
+        return (self.a[:, None] * hashes[None, :] + self.b[:, None]) % HASH_PRIME % self.width
+
+    def update(self, words, counts):
+        buckets = self._buckets(words)
+        counts = numpy.asarray(counts, dtype='float64')
+        for row in range(self.depth):
+            self.table[row] += numpy.bincount(buckets[row], weights=counts, minlength=self.width).astype('int64')
+
+    def estimate(self, words):
+        buckets = self._buckets(words)
+        return numpy.min(self.table[numpy.arange(self.depth)[:, None], buckets], axis=0)
+
+    def merge(self, other):
+        assert self.width == other.width and self.depth == other.depth
+        assert numpy.array_equal(self.a, other.a) and numpy.array_equal(self.b, other.b)
+        self.table += other.table
+
+class SpaceSaving(object):
+    """
+    SpaceSaving summary of the (at most) 'capacity' most frequent words. For each monitored word
+    it stores an overestimate of its count and the maximum error of this overestimate, and every
+    word which is not monitored occurs at most 'min_count' times.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.min_count = 0
+
+    @staticmethod
+    def from_counts(word_counts, capacity):
+        """
+        Creates a summary from exact counts (a dictionary of word counts).
+        """
+        summary = SpaceSaving(capacity)
+        summary.counts = dict(heapq.nlargest(capacity, word_counts.iteritems(), key=lambda item: item[1]))
+        summary.errors = dict.fromkeys(summary.counts, 0)
+        if len(word_counts) > capacity:
+            summary.min_count = min(summary.counts.itervalues())
+        return summary
+
+    def merge(self, other):
+        """
+        Merges the summary of another part of the data. Words which are not monitored by one
+        of the summaries are counted with its 'min_count', which bounds their count from above.
+        """
+        counts = {}
+        errors = {}
+        for word in set(self.counts) | set(other.counts):
+            counts[word] = self.counts.get(word, self.min_count) + other.counts.get(word, other.min_count)
+            errors[word] = self.errors.get(word, self.min_count) + other.errors.get(word, other.min_count)
+
+        min_count = self.min_count + other.min_count
+        if len(counts) > self.capacity:
+            kept = heapq.nlargest(self.capacity, counts.iteritems(), key=lambda item: item[1])
+            min_count = max(min_count, kept[-1][1])
+            counts = dict(kept)
+            errors = dict((word, errors[word]) for word in counts)
+
+        self.counts, self.errors, self.min_count = counts, errors, min_count
+
+    def update(self, word_counts):
+        """
+        Adds the exact counts of a part of the data (a dictionary of word counts), which is
+        merged as a summary of its own. Streaming the data in parts of at most 'capacity'
+        distinct words keeps the memory usage fixed.
+        """
+        self.merge(SpaceSaving.from_counts(word_counts, self.capacity))
+
+    def lower_bounds(self):
+        return dict((word, self.counts[word] - self.errors[word]) for word in self.counts)
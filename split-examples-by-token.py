@@ -1,5 +1,6 @@
 """
-Takes as input a binarized dialogue corpus, splits the examples by a certain token and shuffles it
+Takes as input a binarized dialogue corpus, splits the examples by a certain token and shuffles it.
+The corpus may be a pickle file, a flat or a compressed corpus, which is processed with vectorized numpy operations.
 
 Example run:
 
@@ -9,6 +10,7 @@ Example run:
 """
 
 import collections
+import itertools
 import numpy
 import math
 import operator
@@ -18,6 +20,7 @@ import logging
 import cPickle
 
 from collections import Counter
+from corpus import CompressedCorpus, FlatCorpus, allocate_flat_corpus, corpus_files, load_corpus, load_corpus_statistics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('text2dict')
@@ -31,102 +34,147 @@ def safe_pickle(obj, filename):
     with open(filename, 'wb') as f:
         cPickle.dump(obj, f, protocol=cPickle.HIGHEST_PROTOCOL)
 
-# Thanks to Emile on Stackoverflow:
-# http://stackoverflow.com/questions/4322705/split-a-list-into-nested-lists-on-a-value
-
-def _itersplit(l, splitters):
-    current = []
-    for item in l:
-        if item in splitters:
-            yield current
-            current = []
-        else:
-            current.append(item)
-    yield current
-
-def magicsplit(l, *splitters):
-    return [subl for subl in _itersplit(l, splitters) if subl]
+def split_examples(tokens, offsets, token_id, consecutive_examples_to_merge, join_last_two_examples):
+    """
+    Splits the examples of a flat corpus (token array and offsets) by a token, and merges
+    consecutive splits of each example again. Returns the token array and offsets of the new examples.
+
+    The splits of an example are the non-empty runs of tokens between occurrences of 'token_id',
+    and each split is written followed by 'token_id'. The new token array is therefore the old one
+    with leading occurrences of 'token_id' removed and repeated occurrences collapsed, and the
+    merging only determines where the new examples start.
+    """
+    num_examples = len(offsets) - 1
+    is_token = (tokens == token_id)
+
+    # Example of every token, and whether it starts or ends an example
+    example_ids = numpy.repeat(numpy.arange(num_examples), numpy.diff(offsets))
+    example_start = numpy.zeros(len(tokens), dtype='bool')
+    example_start[offsets[:-1][numpy.diff(offsets) > 0]] = True
+    example_end = numpy.zeros(len(tokens), dtype='bool')
+    example_end[offsets[1:][numpy.diff(offsets) > 0] - 1] = True
+
+    # Splits are runs of other tokens, which start after 'token_id' or at the start of an example
+    split_starts = numpy.flatnonzero(~is_token & (example_start | numpy.concatenate([[True], is_token[:-1]])))
+    split_ends = numpy.flatnonzero(~is_token & (example_end | numpy.concatenate([is_token[1:], [True]]))) + 1
+    split_example_ids = example_ids[split_starts]
+
+    # Without any splits, every example gives one empty new example
+    if not len(split_starts):
+        return tokens[:0], numpy.zeros(num_examples + 1, dtype='int64')
+
+    splits_per_example = numpy.bincount(split_example_ids, minlength=num_examples)
+    first_split = numpy.cumsum(splits_per_example) - splits_per_example
+    split_index = numpy.arange(len(split_starts)) - first_split[split_example_ids]
+
+    # If option is specified, the last split of an example is appended to the second last one,
+    # and 'token_id' is not written between them
+    joined = numpy.zeros(len(split_starts), dtype='bool')
+    if join_last_two_examples:
+        joined = (splits_per_example[split_example_ids] > 1) & (split_index == splits_per_example[split_example_ids] - 2)
+        splits_per_example = splits_per_example - (splits_per_example > 1)
+
+    # The new token array keeps all other tokens, and inserts 'token_id' after each split
+    other_tokens = tokens[~is_token]
+    split_lengths = split_ends - split_starts
+    insert_positions = numpy.cumsum(split_lengths)[~joined]
+    new_tokens = numpy.insert(other_tokens, insert_positions, token_id)
+    split_new_ends = numpy.cumsum(split_lengths + ~joined)
+
+    # Joined splits end where the following split ends
+    merged_splits = numpy.flatnonzero(~numpy.concatenate([[False], joined[:-1]]))
+    merged_new_ends = split_new_ends[merged_splits + joined[merged_splits]]
+    merged_example_ids = split_example_ids[merged_splits]
+    merged_index = split_index[merged_splits]
+
+    # Each example gives max(splits / consecutive_examples_to_merge, 1) new examples of consecutive_examples_to_merge
+    # splits, and the last new example of each example also contains the remaining splits
+    new_examples = numpy.maximum(splits_per_example // consecutive_examples_to_merge, 1)
+    ends_new_example = ((merged_index + 1) == splits_per_example[merged_example_ids]) | \
+                       (((merged_index + 1) % consecutive_examples_to_merge == 0) & \
+                        ((merged_index + 1) // consecutive_examples_to_merge < new_examples[merged_example_ids]))
+
+    # Examples without splits give one empty new example
+    new_example_ends = merged_new_ends[ends_new_example]
+    new_example_ids = merged_example_ids[ends_new_example]
+    empty_example_ids = numpy.flatnonzero(splits_per_example == 0)
+    new_lengths_per_example = numpy.bincount(split_example_ids, weights=split_lengths + ~joined, minlength=num_examples).astype('int64')
+    empty_example_ends = numpy.cumsum(new_lengths_per_example)[empty_example_ids]
+
+    new_example_ends = numpy.concatenate([new_example_ends, empty_example_ends])
+    order = numpy.lexsort((new_example_ends, numpy.concatenate([new_example_ids, empty_example_ids])))
+    new_offsets = numpy.concatenate([[0], new_example_ends[order]]).astype('int64')
+    return new_tokens, new_offsets
 
 import argparse
 parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, help="Binarized dialogue corpus (pkl file)")
+parser.add_argument("input", type=str, help="Binarized dialogue corpus (pkl file or prefix of a flat or compressed corpus)")
 parser.add_argument("token_id", type=int, help="Token index to split examples by (e.g. to split by end-of-dialogue set this to 2)")
 parser.add_argument("consecutive_examples_to_merge", type=int, default='1', help="After splitting these number of examples will be merged.")
 parser.add_argument("--join_last_two_examples",
             action="store_true", default=False,
             help="If on, will join the last two splits generated from each example. This is useful to handle empty or very short last samples")
+parser.add_argument("--flat", action="store_true", default=False, help="If on, the processed corpus is saved as a flat corpus (<output>.tokens.npy and <output>.offsets.npy) instead of a pickle file")
 
 
 parser.add_argument("output", type=str, help="Filename of processed binarized dialogue corpus (pkl file)")
 args = parser.parse_args()
 
-if not os.path.isfile(args.input):
+if not all(os.path.isfile(filename) for filename in corpus_files(args.input)):
     raise Exception("Input file not found!")
 
 logger.info("Loading dialogue corpus")
-data = cPickle.load(open(args.input, 'rb'))
-data_len = len(data)
+data = load_corpus(args.input)
+if isinstance(data, FlatCorpus):
+    tokens, offsets = data.tokens, data.offsets
+elif isinstance(data, CompressedCorpus):
+    # The blocks store whole dialogues in order, so each block is decoded once
+    offsets = data.offsets
+    tokens = numpy.concatenate([numpy.zeros(0, dtype=data.dtype)] + [data.block(block_id) for block_id in xrange(data.num_blocks())])
+    del data
+else:
+    # The dictionaries created by convert-text2dict.py have the end-of-utterance token </s> at index 1
+    offsets = load_corpus_statistics(args.input, 1, data)['offsets']
+    tokens = numpy.fromiter(itertools.chain.from_iterable(data), dtype='int64', count=offsets[-1])
+    del data
+data_len = len(offsets) - 1
 
 logger.info('Corpus loaded... Data len is %d' % data_len)
-
-# Count number of tokens
-tokens_count = 0
-for i in range(data_len):
-    tokens_count += len(data[i])
-logger.info('Tokens count %d' % tokens_count)
+logger.info('Tokens count %d' % len(tokens))
 
 
 logger.info("Splitting corpus examples by token id... ")
-processed_binarized_corpus = []
-for i in range(data_len):
-    logger.info('    Example %d ' % i)
-    new_examples = magicsplit(data[i], int(args.token_id))
-
-    # If option is specified, we append the last new example to the second last one
-    if args.join_last_two_examples and len(new_examples) > 1:
-        new_examples[len(new_examples)-2] += new_examples[len(new_examples)-1]
-        del new_examples[len(new_examples)-1]
-
-    # Simpler version of the two for loops, which does not allow merging together samples
-    #for new_example in new_examples:
-    #    processed_binarized_corpus.append(new_example + [int(args.token_id)])
-
-    s = int(math.floor(len(new_examples) / args.consecutive_examples_to_merge))
-    for j in range(1, s):
-        start_index = j*args.consecutive_examples_to_merge
-        merged_example = []
-        for k in reversed(range(args.consecutive_examples_to_merge)):
-            merged_example += new_examples[start_index-k-1] + [int(args.token_id)]
-        processed_binarized_corpus.append(merged_example)
-
-    if s > 0:
-        merged_example = []
-        for k in range((s-1)*args.consecutive_examples_to_merge, len(new_examples)):
-            merged_example += new_examples[k] + [int(args.token_id)]
-        processed_binarized_corpus.append(merged_example)
-    else:
-        merged_example = []
-        for k in range(len(new_examples)):
-            merged_example += new_examples[k] + [int(args.token_id)]
-        processed_binarized_corpus.append(merged_example)
+new_tokens, new_offsets = split_examples(tokens, offsets, int(args.token_id), args.consecutive_examples_to_merge, args.join_last_two_examples)
 
-
-logger.info('New data len is %d' % len(processed_binarized_corpus))
-
-# Count number of tokens
-processed_tokens_count = 0
-for i in range(len(processed_binarized_corpus)):
-    processed_tokens_count += len(processed_binarized_corpus[i])
-logger.info('New tokens count %d' % processed_tokens_count)
+logger.info('New data len is %d' % (len(new_offsets) - 1))
+logger.info('New tokens count %d' % len(new_tokens))
 
 # When splitting by end-of-utterance token </s>, there are some instances with multiple </s> at the end of each example. Our splitting method will effectively remove these, but it is not of any concern to us.
 # assert(processed_tokens_count == tokens_count)
 
 logger.info("Reshuffling corpus.")
 rng = numpy.random.RandomState(13248)
-rng.shuffle(processed_binarized_corpus)
+order = numpy.arange(len(new_offsets) - 1)
+rng.shuffle(order)
+
+# Gather the tokens of the shuffled examples
+lengths = numpy.diff(new_offsets)[order]
+shuffled_offsets = numpy.zeros(len(order) + 1, dtype='int64')
+numpy.cumsum(lengths, out=shuffled_offsets[1:])
+gather = numpy.arange(len(new_tokens)) + numpy.repeat(new_offsets[:-1][order] - shuffled_offsets[:-1], lengths)
+shuffled_tokens = new_tokens[gather]
+del new_tokens, gather
 
 logger.info("Saving corpus.")
-safe_pickle(processed_binarized_corpus, args.output + ".pkl")
+if args.flat:
+    vocab_size = int(shuffled_tokens.max()) + 1 if len(shuffled_tokens) else 1
+    flat_tokens, flat_offsets = allocate_flat_corpus(args.output, len(order), len(shuffled_tokens), vocab_size)
+    flat_tokens[:] = shuffled_tokens
+    flat_offsets[:] = shuffled_offsets
+    flat_tokens.flush()
+    flat_offsets.flush()
+else:
+    shuffled_tokens = shuffled_tokens.tolist()
+    safe_pickle([shuffled_tokens[shuffled_offsets[i]:shuffled_offsets[i + 1]] for i in xrange(len(order))], args.output + ".pkl")
 
 logger.info("Corpus saved. All done!")
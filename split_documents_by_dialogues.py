@@ -1,6 +1,10 @@
 """
 Takes as input a dialogue file and splits it up by end-of-dialogue tokens and shuffles it </d>.
 
+The input is processed as a stream: each dialogue is written to one of several temporary
+shard files chosen at random, then each shard is shuffled in memory and appended to the output.
+The memory usage is therefore bounded by the size of a shard, and the output only depends on the seed.
+
 Example run:
 
     python split_documents_by_dialogues.py Data/Training_Shuffled_Dataset.txt Data/Training_SplitByDialogues_Dataset.txt
@@ -9,7 +13,9 @@ Example run:
 """
 
 
-from random import shuffle
+import random
+import shutil
+import tempfile
 import os
 
 import argparse
@@ -18,24 +24,37 @@ parser = argparse.ArgumentParser()
 parser.add_argument("input", type=str, help="Dialogue file; with one document (e.g. movie) per line")
 
 parser.add_argument("output", type=str, help="Dialogue file; shuffled with one dialogue per line")
+parser.add_argument("--shards", type=int, default=64, help="Number of temporary shard files; each shard must fit in memory")
+parser.add_argument("--seed", type=int, default=1234, help="Random seed")
+parser.add_argument("--tmp_dir", type=str, default="", help="Directory for the temporary shard files (default is the directory of the output file)")
 args = parser.parse_args()
 
 if not os.path.isfile(args.input):
     raise Exception("Input file not found!")
 
+rng = random.Random(args.seed)
+
+tmp_dir = tempfile.mkdtemp(prefix='shards', dir=args.tmp_dir or os.path.dirname(os.path.abspath(args.output)))
+try:
+    shard_files = [open(os.path.join(tmp_dir, 'shard%d.txt' % k), 'w') for k in range(args.shards)]
 
-data = open(args.input, 'r').readlines()
+    # Scatter the dialogues into the shards
+    for l in open(args.input, 'r'):
+        s = l.split(' </d> </s> ')
+        for i in range(len(s)-1):
+            shard_files[rng.randrange(args.shards)].write(s[i] + ' </d> </s>\n')
 
-new_data = []
-for l in data:
-    s = l.split(' </d> </s> ')
-    for i in range(len(s)-1):
-        new_data.append(s[i] + ' </d> </s>')
-        
-shuffle(new_data)
+    for shard_file in shard_files:
+        shard_file.close()
 
-f = open(args.output,'w')
-for i in range(len(new_data)):
-    f.write(new_data[i] + '\n')
+    # Shuffle each shard and concatenate
+    f = open(args.output,'w')
+    for shard_file in shard_files:
+        new_data = open(shard_file.name, 'r').readlines()
+        rng.shuffle(new_data)
+        f.writelines(new_data)
+        os.remove(shard_file.name)
 
-f.close()
+    f.close()
+finally:
+    shutil.rmtree(tmp_dir)
@@ -167,6 +167,13 @@ def prototype_state():
     # This is significantly faster for large vocabularies (e.g. more than 20K words), 
     # but experiments show that this degrades performance.
     state['use_nce'] = False
+    # Cutoffs of the adaptive softmax output layer, which is also faster for large vocabularies.
+    # The words are ranked by their frequency in the dictionary. The head cluster contains the
+    # words ranked before the first cutoff and one entry per tail cluster, and the tail clusters contain
+    # the words ranked between consecutive cutoffs and after the last cutoff. For example, [2000, 10000]
+    # gives a head of 2000 words and two tail clusters. If empty, the full softmax is used.
+    # The adaptive softmax cannot be combined with NCE.
+    state['adaptive_softmax_cutoffs'] = []
     # Threshold to clip the gradient
     state['cutoff'] = 1.
     # Learning rate. The rate 0.0002 seems to work well across many tasks with adam.
@@ -180,11 +187,46 @@ def prototype_state():
     state['bs'] = 80
     # Sort by length groups of  
     state['sort_k_batches'] = 20
+    # Number of dialogue length buckets. If larger than zero, dialogue lengths are computed
+    # once when the corpus is loaded and each batch is sampled from a single bucket (bucket
+    # boundaries are length quantiles). Otherwise, groups of 'sort_k_batches' batches are sorted by length.
+    # The padding efficiency of every epoch is logged in both cases.
+    state['length_buckets'] = 0
+    # Maximum number of tokens (columns times padded length) per batch. If larger than zero,
+    # batches are formed under this budget, and 'bs' is the maximum number of dialogues per batch.
+    # Otherwise all batches have 'bs' columns.
+    state['batch_token_budget'] = 0
+    # If true, several dialogues are packed back-to-back into each column of a batch, up to the length
+    # of the longest dialogue in the group of 'sort_k_batches' batches (but at least 'max_grad_steps').
+    # The RNN states are reset at the beginning of every packed dialogue. This option takes precedence
+    # over 'batch_token_budget'.
+    state['pack_dialogues'] = False
+    # Directory for cached validation and test batches. If not empty, the padded segments
+    # of the validation (and test) set are written to this directory once, and all following
+    # passes read them from memory-mapped files. Changing the corpus, 'bs', 'max_grad_steps' or any
+    # other option which changes the batches creates a new cache.
+    state['batch_cache_dir'] = ''
+    # Directory for cached compiled Theano functions. If not empty, every compiled function (training,
+    # evaluation, sampling and encoding) is written to this directory, and later runs with the same
+    # model options and code load it instead of compiling it again.
+    state['function_cache_dir'] = ''
+    # Sampling weights of the training corpora. 'train_dialogues' may be a list of corpus files, which are
+    # mixed into one training set: every dialogue of the mixture is drawn from corpus i with probability
+    # proportional to its weight, and each corpus is shuffled on its own. If empty, the corpora are weighted
+    # by their number of dialogues. The tokens taken from each corpus are logged at the end of every epoch.
+    state['train_dialogues_weights'] = []
     # Training examples will be split into subsequences.
     # This parameter controls the maximum size of each subsequence.
     # Gradients will be computed on the subsequence, and the last hidden state of all RNNs will
     # be used to initialize the hidden state of the RNNs in the next subsequence.
     state['max_grad_steps'] = 80
+    # Number of processes producing training and validation batches.
+    # If zero, batches are fetched by a thread and padded on the main thread.
+    # Otherwise each process pads, splits and adds random variables to its own groups of
+    # 'sort_k_batches' batches. The batches only depend on the seed and the number of processes.
+    state['batch_producer_processes'] = 0
+    # Number of segment batches each producer process can buffer in shared memory
+    state['batch_producer_buffer_size'] = 8
     # Modify this in the prototype
     state['save_dir'] = './'
     # Frequency of training error reports (in number of batches)
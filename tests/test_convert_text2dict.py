@@ -0,0 +1,94 @@
+"""
+Runs convert-text2dict.py on a small dialogue file, and checks the binarized corpus,
+its statistics sidecar and the dictionary.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, CODE_DIR)
+
+from corpus import compute_corpus_statistics, corpus_signature, load_corpus, STATS_SUFFIX
+from vocabulary import Vocabulary
+
+class ConvertText2DictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = numpy.random.RandomState(1234)
+        # Word i occurs with a probability decreasing in i, so that the most frequent words are well separated
+        probabilities = 1.0 / numpy.arange(1, 201)
+        probabilities /= numpy.sum(probabilities)
+
+        self.dialogues = []
+        for i in range(300):
+            dialogue = []
+            for utterance in range(rng.randint(1, 5)):
+                dialogue += ['w%d' % word for word in rng.choice(200, size=rng.randint(0, 8), p=probabilities)] + ['</s>']
+            self.dialogues.append(dialogue)
+        with open(self.path('dialogues.txt'), 'w') as f:
+            for dialogue in self.dialogues:
+                f.write(' '.join(dialogue) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def convert(self, output, *options):
+        # Chunks of 0 MB hold a single line each, so that every dialogue is processed by its own task
+        # Returns the log of the script
+        return subprocess.check_output([sys.executable, os.path.join(CODE_DIR, 'convert-text2dict.py'), self.path('dialogues.txt'), \
+                                        '--workers', '3', '--chunk_size', '0'] + list(options) + [self.path(output)], \
+                                       stderr=subprocess.STDOUT)
+
+    def check_corpus(self, corpus_path, dict_path):
+        vocabulary = Vocabulary.load(dict_path)
+        data = load_corpus(corpus_path)
+        self.assertEqual([[vocabulary.words[word_id] for word_id in dialogue] for dialogue in data], \
+                         [[word if word in vocabulary.str_to_idx else '<unk>' for word in dialogue] for dialogue in self.dialogues])
+
+        # The statistics computed per chunk are those of the whole corpus, and match the corpus files
+        statistics = dict(numpy.load(corpus_path + STATS_SUFFIX))
+        self.assertEqual(str(statistics.pop('signature')), repr(corpus_signature(corpus_path)))
+        expected = compute_corpus_statistics(data, vocabulary.str_to_idx['</s>'])
+        for key in expected:
+            numpy.testing.assert_array_equal(statistics[key], expected[key])
+
+    def test_flat(self):
+        self.convert('Training', '--cutoff', '50', '--flat')
+        self.check_corpus(self.path('Training.dialogues'), self.path('Training.dict.pkl'))
+
+    def test_pickle(self):
+        self.convert('Training', '--cutoff', '50')
+        self.check_corpus(self.path('Training.dialogues.pkl'), self.path('Training.dict.pkl'))
+
+    def test_approximate_counts(self):
+        # The exact counts of the words are streamed into the summary in parts of at most 40 distinct words,
+        # which find the same vocabulary as the exact counts
+        self.convert('Exact', '--cutoff', '10', '--flat')
+        log = self.convert('Approximate', '--cutoff', '10', '--flat', '--approximate_counts', '--candidates', '40', \
+                           '--sketch_width', '64', '--chunk_size', '1')
+        self.assertNotIn('raise --candidates', log)
+        self.assertEqual(Vocabulary.load(self.path('Approximate.dict.pkl')).words, Vocabulary.load(self.path('Exact.dict.pkl')).words)
+        self.check_corpus(self.path('Approximate.dialogues'), self.path('Approximate.dict.pkl'))
+
+    def test_approximate_counts_warn_about_missed_words(self):
+        # With summaries of single dialogues merged into 60 monitored words, the bound does not hold
+        log = self.convert('Approximate', '--cutoff', '30', '--flat', '--approximate_counts', '--candidates', '60', \
+                           '--sketch_width', '64')
+        self.assertIn('raise --candidates', log)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Checks that flat and compressed corpora return the dialogues they were written from,
+and that compressed corpora are read block by block.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import cPickle
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import corpus
+from corpus import CompressedCorpus, FlatCorpus, MixedCorpus, load_corpus, save_compressed_corpus, save_flat_corpus
+from SS_dataset import SSIterator
+
+def random_dialogues(rng, num_dialogues, max_length=40, vocab_size=300):
+    return [rng.randint(0, vocab_size, size=rng.randint(0, max_length)).tolist() for i in range(num_dialogues)]
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rng = numpy.random.RandomState(1234)
+        self.dialogues = random_dialogues(self.rng, 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_flat_round_trip(self):
+        save_flat_corpus(self.path('flat'), self.dialogues, 300)
+        data = load_corpus(self.path('flat'))
+        self.assertIsInstance(data, FlatCorpus)
+        self.assertEqual([dialogue.tolist() for dialogue in data], self.dialogues)
+
+    def test_compressed_round_trip(self):
+        save_compressed_corpus(self.path('compressed'), self.dialogues, block_tokens=200)
+        data = load_corpus(self.path('compressed'))
+        self.assertIsInstance(data, CompressedCorpus)
+        self.assertGreater(data.num_blocks(), 1)
+        self.assertEqual([dialogue.tolist() for dialogue in data], self.dialogues)
+        self.assertEqual(data.lengths().tolist(), [len(dialogue) for dialogue in self.dialogues])
+
+        # Random access in any order
+        for index in self.rng.permutation(len(self.dialogues)):
+            self.assertEqual(data[index].tolist(), self.dialogues[index])
+
+    def test_compressed_from_flat(self):
+        save_flat_corpus(self.path('flat'), self.dialogues, 300)
+        save_compressed_corpus(self.path('compressed'), load_corpus(self.path('flat')), block_tokens=200)
+        self.assertEqual([dialogue.tolist() for dialogue in load_corpus(self.path('compressed'))], self.dialogues)
+
+    def test_shuffle_order_is_a_permutation(self):
+        save_compressed_corpus(self.path('compressed'), self.dialogues, block_tokens=200)
+        data = CompressedCorpus(self.path('compressed'), cache_blocks=4)
+        order = data.shuffle_order(numpy.random.RandomState(1))
+        self.assertEqual(sorted(order.tolist()), range(len(self.dialogues)))
+
+    def test_mixed_round_trip(self):
+        sources = [self.dialogues[:100], self.dialogues[100:300], self.dialogues[300:]]
+        cPickle.dump(sources[0], open(self.path('pickled.pkl'), 'wb'))
+        save_flat_corpus(self.path('flat'), sources[1], 300)
+        save_compressed_corpus(self.path('compressed'), sources[2], block_tokens=200)
+
+        data = load_corpus([self.path('pickled.pkl'), self.path('flat'), self.path('compressed')], [1, 1, 2])
+        self.assertIsInstance(data, MixedCorpus)
+        self.assertEqual(len(data), len(self.dialogues))
+        self.assertEqual([list(data[index]) for index in range(len(data))], self.dialogues)
+        self.assertEqual(data.source_ids([0, 99, 100, 299, 300, 499]).tolist(), [0, 0, 1, 1, 2, 2])
+
+        # Every epoch draws the sources according to the weights
+        order = data.shuffle_order(numpy.random.RandomState(1))
+        self.assertEqual(len(order), len(data))
+        fractions = numpy.bincount(data.source_ids(order), minlength=3) / float(len(order))
+        numpy.testing.assert_allclose(fractions, [0.25, 0.25, 0.5], atol=0.08)
+
+    def count_decoded_blocks(self, length_buckets):
+        save_compressed_corpus(self.path('compressed'), self.dialogues, block_tokens=200)
+        data = CompressedCorpus(self.path('compressed'))
+
+        decoded = []
+        decompress = zlib.decompress
+        def counting_decompress(data):
+            decoded.append(data)
+            return decompress(data)
+
+        diter = SSIterator(self.path('compressed'), 8, 1234, use_infinite_loop=False, length_buckets=length_buckets)
+        # Blocks decoded while computing the corpus statistics are dropped from the cache
+        diter.data.cache.clear()
+        corpus.zlib.decompress = counting_decompress
+        try:
+            diter.start()
+            seen = []
+            while True:
+                batch = diter.next()
+                if batch is None:
+                    break
+                seen.extend(dialogue[0].tolist() for dialogue in batch)
+        finally:
+            corpus.zlib.decompress = decompress
+
+        self.assertEqual(sorted(seen), sorted(self.dialogues))
+        return len(decoded), data.num_blocks()
+
+    def test_shuffled_epoch_decodes_each_block_once(self):
+        decoded, num_blocks = self.count_decoded_blocks(0)
+        self.assertEqual(decoded, num_blocks)
+
+    def test_bucketed_epoch_decodes_each_block_once(self):
+        decoded, num_blocks = self.count_decoded_blocks(4)
+        self.assertEqual(decoded, num_blocks)
+
+if __name__ == '__main__':
+    unittest.main()
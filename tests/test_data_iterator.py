@@ -0,0 +1,131 @@
+"""
+Checks the batches of data_iterator.py.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import cPickle
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from corpus import save_flat_corpus
+from data_iterator import Iterator, create_packed_batch, create_padded_batch
+from state import prototype_state
+
+def test_state(**entries):
+    state = prototype_state()
+    state.update({'eos_sym': 1, 'bs': 4, 'max_grad_steps': 8, 'seed': 1234, 'sort_k_batches': 3, \
+                  'latent_gaussian_per_utterance_dim': 3})
+    state.update(entries)
+    return state
+
+def random_dialogues(rng, num_dialogues, max_length=30, vocab_size=20):
+    return [rng.randint(1, vocab_size, size=rng.randint(1, max_length)).tolist() for i in range(num_dialogues)]
+
+class PackedBatchTest(unittest.TestCase):
+    def test_packed_columns_match_single_dialogues(self):
+        state = test_state()
+        rng = numpy.random.RandomState(1234)
+        # Dialogues with and without a leading end-of-utterance symbol, and with tokens after the last one
+        columns = [[[1, 5, 6, 1, 7, 1], [8, 9, 1, 10, 11]],
+                   [[1, 12, 13], [14, 15, 16, 1], [1, 17, 1, 18]],
+                   [[19, 20, 21, 22, 1]]]
+        batch = create_packed_batch(state, rng, columns)
+        self.assertEqual(batch['num_dialogues'], 6)
+        self.assertEqual(batch['x'].shape[1], 3)
+
+        num_preds = 0
+        for column, dialogues in enumerate(columns):
+            row = 0
+            for position, dialogue in enumerate(dialogues):
+                single = create_padded_batch(state, rng, [[dialogue]], columns=1)
+                length = single['max_length']
+                rows = slice(row, row + length)
+
+                # Each packed dialogue is batched, reversed and masked as if it were alone in its column
+                numpy.testing.assert_array_equal(batch['x'][rows, column], single['x'][:length, 0])
+                numpy.testing.assert_array_equal(batch['x_reversed'][rows, column], single['x_reversed'][:length, 0])
+                numpy.testing.assert_array_equal(batch['x_mask'][rows, column][1:], single['x_mask'][1:length, 0])
+
+                # The first token of every later dialogue is not predicted, and resets the RNN states
+                reset = batch['x_dialogue_reset'][rows, column]
+                self.assertEqual(reset[0], 0 if position > 0 else 1)
+                self.assertTrue(numpy.all(reset[1:] == 1))
+                if position > 0:
+                    self.assertEqual(batch['x_mask'][row, column], 0)
+
+                num_preds += single['num_preds']
+                row += length
+            self.assertTrue(numpy.all(batch['x_mask'][row:, column] == 0))
+        self.assertEqual(batch['num_preds'], num_preds)
+
+class ResumeTest(unittest.TestCase):
+    BATCH_KEYS = ['x', 'x_reversed', 'x_mask', 'x_reset', 'x_dialogue_reset', 'ran_var_constutterance', 'ran_decoder_drop_mask']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.directory, 'corpus')
+        save_flat_corpus(self.corpus, random_dialogues(numpy.random.RandomState(1234), 60), 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def iterator(self, state):
+        return Iterator(self.corpus, state['bs'], state=state, seed=state['seed'], use_infinite_loop=True, evaluate_mode=False)
+
+    def next_batches(self, diter, num_batches):
+        batches = []
+        for i in range(num_batches):
+            batch = diter.next()
+            batches.append(dict((key, numpy.array(batch[key])) for key in self.BATCH_KEYS))
+        return batches
+
+    def check_resume(self, **entries):
+        """
+        Checks that an iterator restored from a saved state continues with exactly the batches
+        of the original iterator, including the random variables. The state is saved in the first
+        and in the second epoch, in the middle of a group of batches.
+        """
+        for skipped in [7, 50]:
+            state = test_state(decoder_drop_previous_input_tokens=True, decoder_drop_previous_input_tokens_rate=0.75, **entries)
+            diter = self.iterator(state)
+            diter.start()
+            self.next_batches(diter, skipped)
+            iterator_state = cPickle.loads(cPickle.dumps(diter.get_state(), cPickle.HIGHEST_PROTOCOL))
+            expected = self.next_batches(diter, 20)
+            diter.stop_producer()
+
+            resumed = self.iterator(state)
+            resumed.set_state(iterator_state)
+            resumed.start()
+            for batch, expected_batch in zip(self.next_batches(resumed, 20), expected):
+                for key in self.BATCH_KEYS:
+                    numpy.testing.assert_array_equal(batch[key], expected_batch[key])
+            resumed.stop_producer()
+
+    def test_resume(self):
+        self.check_resume()
+
+    def test_resume_length_buckets(self):
+        self.check_resume(length_buckets=3)
+
+    def test_resume_token_budget(self):
+        self.check_resume(batch_token_budget=60)
+
+    def test_resume_packed(self):
+        self.check_resume(pack_dialogues=True)
+
+    def test_resume_producer_processes(self):
+        self.check_resume(batch_producer_processes=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Checks the output layers of the model and the previous states carried between the segments of
+batches with fewer columns than 'bs'. The tests build small models, which takes a few minutes.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import theano
+import theano.tensor as T
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_iterator import add_random_variables_to_batch, create_padded_batch, split_batch_into_segments
+from dialog_encdec import DialogEncoderDecoder
+from state import prototype_test
+from utils import SoftMax
+from vocabulary import Vocabulary
+
+SPECIAL_WORDS = ['<unk>', '</s>', '</d>', '<first_speaker>', '<second_speaker>', '<third_speaker>', \
+                 '<minor_speaker>', '<voice_over>', '<off_screen>', '<pause>']
+
+class DialogEncoderDecoderTest(unittest.TestCase):
+    def setUp(self):
+        # The model is built for float32, as with THEANO_FLAGS=floatX=float32
+        self.floatX = theano.config.floatX
+        theano.config.floatX = 'float32'
+
+        self.directory = tempfile.mkdtemp()
+        words = SPECIAL_WORDS + ['w%d' % i for i in range(30)]
+        freqs = numpy.arange(len(words), 0, -1)
+        Vocabulary(words, freqs, freqs).save(os.path.join(self.directory, 'dict.pkl'))
+
+    def tearDown(self):
+        theano.config.floatX = self.floatX
+        shutil.rmtree(self.directory)
+
+    def test_state(self, **entries):
+        state = prototype_test()
+        state['dictionary'] = os.path.join(self.directory, 'dict.pkl')
+        state['save_dir'] = self.directory
+        state['bs'] = 4
+        state['max_grad_steps'] = 6
+        state.update(entries)
+        return state
+
+    def test_adaptive_softmax_matches_full_softmax(self):
+        model = DialogEncoderDecoder(self.test_state(adaptive_softmax_cutoffs=[12, 25]), inference_only=True)
+        decoder = model.utterance_decoder
+        self.assertEqual([len(words) for words in model.adaptive_softmax_clusters], [12, 13, 15])
+
+        pre_activ = T.matrix('pre_activ')
+        y = T.ivector('y')
+        full_probs = theano.function([pre_activ], SoftMax(T.dot(pre_activ, decoder.Wd_emb.T) + decoder.bd_out))
+        adaptive_probs = theano.function([pre_activ], decoder.output_adaptive_softmax(pre_activ))
+        adaptive_target_probs = theano.function([pre_activ, y], decoder.output_adaptive_target_probs(pre_activ, y))
+
+        # The logit of each tail cluster is set to the log of the sum of the exponentiated logits of its words
+        # for one input, for which the adaptive softmax then equals the full softmax
+        rng = numpy.random.RandomState(1234)
+        inputs = numpy.tile(rng.normal(size=(1, model.rankdim)), (model.idim, 1)).astype('float32')
+        logits = numpy.dot(inputs[0], decoder.Wd_emb.get_value().T) + decoder.bd_out.get_value()
+        decoder.Wd_cluster_emb.set_value(numpy.zeros_like(decoder.Wd_cluster_emb.get_value()))
+        decoder.bd_cluster_out.set_value(numpy.array([numpy.log(numpy.sum(numpy.exp(logits[words]))) \
+                                                      for words in model.adaptive_softmax_clusters[1:]], dtype='float32'))
+
+        expected = full_probs(inputs)
+        numpy.testing.assert_allclose(adaptive_probs(inputs), expected, rtol=1e-4)
+        targets = numpy.arange(model.idim, dtype='int32')
+        numpy.testing.assert_allclose(adaptive_target_probs(inputs, targets), expected[targets, targets], rtol=1e-4)
+
+        # For any other inputs, the probabilities of all words sum to one, and the targets are indexed correctly
+        inputs = rng.normal(size=(7, model.rankdim)).astype('float32')
+        targets = rng.randint(0, model.idim, size=7).astype('int32')
+        probs = adaptive_probs(inputs)
+        numpy.testing.assert_allclose(numpy.sum(probs, axis=1), 1, rtol=1e-4)
+        numpy.testing.assert_allclose(adaptive_target_probs(inputs, targets), probs[numpy.arange(7), targets], rtol=1e-4)
+
+    def evaluate_segments(self, model, eval_batch, dialogues, columns):
+        """
+        Evaluates the truncated BPTT segments of a batch of the dialogues with the given number of columns,
+        starting from zero previous states. Returns the costs and the previous states after each segment.
+        """
+        for variable, update in model.state_updates:
+            variable.set_value(numpy.zeros_like(variable.get_value()))
+
+        rng = numpy.random.RandomState(1234)
+        full_batch = create_padded_batch(model.state, rng, [dialogues], columns=columns)
+        results = []
+        prev_batch = None
+        for batch in split_batch_into_segments(model.state, full_batch):
+            batch = add_random_variables_to_batch(model.state, rng, batch, prev_batch, True)
+            prev_batch = batch
+            outputs = eval_batch(batch['x'], batch['x_reversed'], batch['max_length'], batch['x_mask'], batch['x_reset'], \
+                                 batch['ran_var_constutterance'], batch['ran_decoder_drop_mask'], batch['x_dialogue_reset'])
+            results.append((outputs[2].reshape((-1, columns)), [variable.get_value() for variable, update in model.state_updates]))
+        return results
+
+    def test_narrow_batches_carry_their_columns(self):
+        model = DialogEncoderDecoder(self.test_state())
+        eval_batch = model.build_eval_function()
+        dialogues = [[1, 12, 13, 14, 1, 15, 16, 17, 18, 1, 19], [1, 20, 21, 1, 22, 23, 24, 25, 26, 27, 1, 28, 29]]
+
+        # A batch of two columns gives the same costs and previous states as a batch of 'bs' columns,
+        # in which the other columns are empty, and the previous states of the other columns are zero
+        narrow = self.evaluate_segments(model, eval_batch, dialogues, 2)
+        wide = self.evaluate_segments(model, eval_batch, dialogues, model.bs)
+        self.assertEqual(len(narrow), 3)
+        self.assertEqual(len(narrow), len(wide))
+        for (narrow_costs, narrow_states), (wide_costs, wide_states) in zip(narrow, wide):
+            numpy.testing.assert_allclose(narrow_costs, wide_costs[:, :2], rtol=1e-5, atol=1e-6)
+            for narrow_state, wide_state in zip(narrow_states, wide_states):
+                self.assertEqual(narrow_state.shape, wide_state.shape)
+                numpy.testing.assert_allclose(narrow_state[:2], wide_state[:2], rtol=1e-5, atol=1e-6)
+                self.assertTrue(numpy.all(narrow_state[2:] == 0))
+
+if __name__ == '__main__':
+    unittest.main()
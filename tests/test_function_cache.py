@@ -0,0 +1,77 @@
+"""
+Checks the key of the compiled function cache, and that cached functions are bound
+to the shared variables of the loading model.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import theano
+import theano.tensor as T
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, CODE_DIR)
+
+from function_cache import FunctionCache
+
+class FunctionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.code_file = os.path.join(self.directory, 'model_code.py')
+        with open(self.code_file, 'w') as f:
+            f.write('x = 1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache(self, key_data):
+        return FunctionCache(os.path.join(self.directory, 'cache'), key_data, [self.code_file])
+
+    def test_key(self):
+        key = self.cache([('qdim', 10)]).key
+        self.assertEqual(self.cache([('qdim', 10)]).key, key)
+        self.assertNotEqual(self.cache([('qdim', 11)]).key, key)
+
+        # Changing the code changes the key
+        with open(self.code_file, 'w') as f:
+            f.write('x = 2\n')
+        self.assertNotEqual(self.cache([('qdim', 10)]).key, key)
+
+    def test_key_covers_the_cache_and_default_state(self):
+        from dialog_encdec import FUNCTION_CACHE_CODE_FILES
+        for filename in ['dialog_encdec.py', 'model.py', 'function_cache.py', 'state.py']:
+            self.assertIn(filename, FUNCTION_CACHE_CODE_FILES)
+        for filename in FUNCTION_CACHE_CODE_FILES:
+            self.assertTrue(os.path.isfile(os.path.join(CODE_DIR, filename)))
+
+    def build(self, value):
+        W = theano.shared(numpy.asarray(value, dtype=theano.config.floatX), name='W')
+        x = T.vector('x')
+        return W, x, T.dot(W, x)
+
+    def test_load_binds_shared_variables(self):
+        W, x, y = self.build([[1, 2], [3, 4]])
+        function = theano.function([x], y, updates=[(W, W * 2)])
+        self.cache([('qdim', 10)]).save('f', function, {'W': W}, 1.)
+
+        # The loaded function reads and updates the shared variable of the new model
+        new_W = theano.shared(numpy.asarray([[1, 0], [0, 1]], dtype=theano.config.floatX), name='W')
+        loaded = self.cache([('qdim', 10)]).load('f', {'W': new_W})
+        self.assertIsNotNone(loaded)
+        numpy.testing.assert_allclose(loaded(numpy.asarray([1, 2], dtype=theano.config.floatX)), [1, 2])
+        numpy.testing.assert_allclose(new_W.get_value(), [[2, 0], [0, 2]])
+        numpy.testing.assert_allclose(W.get_value(), [[1, 2], [3, 4]])
+
+        # Functions of another configuration are not found
+        self.assertIsNone(self.cache([('qdim', 11)]).load('f', {'W': new_W}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Checks the bounds of the approximate word counts of sketch.py.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy
+
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sketch import CountMinSketch, SpaceSaving
+
+class SketchTest(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(1234)
+        probabilities = 1.0 / numpy.arange(1, 2001)
+        probabilities /= numpy.sum(probabilities)
+        self.words = ['w%d' % word for word in rng.choice(2000, size=20000, p=probabilities)]
+        self.counts = Counter(self.words)
+
+    def test_count_min_sketch_never_underestimates(self):
+        sketch = CountMinSketch(256, 4)
+        for start in range(0, len(self.words), 1000):
+            part = Counter(self.words[start:start + 1000])
+            sketch.update(part.keys(), part.values())
+        words = self.counts.keys()
+        estimates = sketch.estimate(words)
+        self.assertTrue(numpy.all(estimates >= [self.counts[word] for word in words]))
+
+    def test_streamed_space_saving_bounds(self):
+        capacity = 100
+        summary = SpaceSaving(capacity)
+        part = Counter()
+        for word in self.words:
+            part[word] += 1
+            if len(part) >= capacity:
+                summary.update(part)
+                part = Counter()
+        summary.update(part)
+
+        self.assertLessEqual(len(summary.counts), capacity)
+        lower_bounds = summary.lower_bounds()
+        for word, count in self.counts.iteritems():
+            if word in summary.counts:
+                self.assertLessEqual(lower_bounds[word], count)
+                self.assertGreaterEqual(summary.counts[word], count)
+            else:
+                self.assertLessEqual(count, summary.min_count)
+
+        # The most frequent words are monitored
+        for word, count in self.counts.most_common(10):
+            self.assertIn(word, summary.counts)
+
+if __name__ == '__main__':
+    unittest.main()
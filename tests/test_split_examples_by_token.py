@@ -0,0 +1,95 @@
+"""
+Runs split-examples-by-token.py on small corpora, and compares the new examples
+with those of a direct implementation of the splitting.
+
+Run from the code directory with:
+
+    python -m unittest discover tests
+"""
+
+import cPickle
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, CODE_DIR)
+
+from corpus import load_corpus, save_flat_corpus
+
+def split_example(example, token_id, consecutive_examples_to_merge, join_last_two_examples):
+    """
+    Returns the new examples of an example, as computed by the original list-based version of the script.
+    """
+    splits = [[]]
+    for token in example:
+        if token == token_id:
+            splits.append([])
+        else:
+            splits[-1].append(token)
+    splits = [split for split in splits if split]
+
+    if join_last_two_examples and len(splits) > 1:
+        splits[-2] += splits[-1]
+        del splits[-1]
+
+    new_examples = []
+    s = len(splits) // consecutive_examples_to_merge
+    for j in range(1, s):
+        new_examples.append(sum([split + [token_id] for split in splits[(j - 1) * consecutive_examples_to_merge:j * consecutive_examples_to_merge]], []))
+    first = (s - 1) * consecutive_examples_to_merge if s > 0 else 0
+    new_examples.append(sum([split + [token_id] for split in splits[first:]], []))
+    return new_examples
+
+class SplitExamplesByTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def split(self, data, consecutive_examples_to_merge, join_last_two_examples, flat=False):
+        """
+        Returns the new examples of the script, in the order of the shuffled output.
+        """
+        if flat:
+            save_flat_corpus(self.path('input'), data, 10)
+            input_path = self.path('input')
+        else:
+            input_path = self.path('input.pkl')
+            cPickle.dump(data, open(input_path, 'wb'))
+
+        options = ['--join_last_two_examples'] if join_last_two_examples else []
+        subprocess.check_call([sys.executable, os.path.join(CODE_DIR, 'split-examples-by-token.py'), input_path, '2', \
+                               str(consecutive_examples_to_merge)] + options + [self.path('output')], \
+                              stderr=open(os.devnull, 'w'))
+        return sorted(list(example) for example in load_corpus(self.path('output.pkl')))
+
+    def check(self, data, flat=False):
+        for consecutive_examples_to_merge in [1, 2, 3]:
+            for join_last_two_examples in [False, True]:
+                expected = sum([split_example(example, 2, consecutive_examples_to_merge, join_last_two_examples) for example in data], [])
+                self.assertEqual(self.split(data, consecutive_examples_to_merge, join_last_two_examples, flat), sorted(expected))
+
+    def test_random_corpus(self):
+        rng = numpy.random.RandomState(1234)
+        data = [rng.randint(0, 4, size=rng.randint(0, 20)).tolist() for i in range(50)]
+        self.check(data)
+        self.check(data, flat=True)
+
+    def test_corpus_without_splits(self):
+        # Each example gives one empty new example
+        self.check([[]])
+        self.check([[2, 2]])
+        self.check([[], [2], [2, 2, 2]], flat=True)
+
+if __name__ == '__main__':
+    unittest.main()
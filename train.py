@@ -58,21 +58,24 @@ def init_timings():
         timings[m] = []
     return timings
 
-def save(model, timings, post_fix = ''):
+def save(model, timings, post_fix = '', iterator = None):
     print "Saving the model..."
 
     # ignore keyboard interrupt while saving
     start = time.time()
     s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    if not os.path.exists(model.state['save_dir']):
-        os.makedirs(model.state['save_dir'])
-    
-    os.makedirs(model.state['save_dir'])
-    model.save(model.state['save_dir'] + '/' + model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'model.npz')
-    cPickle.dump(model.state, open(model.state['save_dir'] + '/' +  model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'state.pkl', 'wb'))
-    numpy.savez(model.state['save_dir'] + '/' + model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'timing.npz', **timings)
-    signal.signal(signal.SIGINT, s)
+    try:
+        if not os.path.exists(model.state['save_dir']):
+            os.makedirs(model.state['save_dir'])
+
+        model.save(model.state['save_dir'] + '/' + model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'model.npz')
+        cPickle.dump(model.state, open(model.state['save_dir'] + '/' +  model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'state.pkl', 'wb'))
+        numpy.savez(model.state['save_dir'] + '/' + model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'timing.npz', **timings)
+        # Position of the training data iterator, to continue exactly from here on restart
+        if iterator:
+            cPickle.dump(iterator.get_state(), open(model.state['save_dir'] + '/' +  model.state['run_id'] + "_" + model.state['prefix'] + post_fix + 'iterator.pkl', 'wb'))
+    finally:
+        signal.signal(signal.SIGINT, s)
     
     print "Model saved, took {}".format(time.time() - start)
 
@@ -82,8 +85,10 @@ def load(model, filename, parameter_strings_to_ignore):
     # ignore keyboard interrupt while saving
     start = time.time()
     s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-    model.load(filename, parameter_strings_to_ignore)
-    signal.signal(signal.SIGINT, s)
+    try:
+        model.load(filename, parameter_strings_to_ignore)
+    finally:
+        signal.signal(signal.SIGINT, s)
 
     print "Model loaded, took {}".format(time.time() - start)
 
@@ -95,6 +100,7 @@ def main(args):
     timings = init_timings() 
 
     auto_restarting = False
+    iterator_state = None
     if args.auto_restart:
         assert not args.save_every_valid_iteration
         assert len(args.resume) == 0
@@ -135,6 +141,7 @@ def main(args):
         
         state_file = args.resume + '_state.pkl'
         timings_file = args.resume + '_timing.npz'
+        iterator_file = args.resume + '_iterator.pkl'
         
         if os.path.isfile(state_file) and os.path.isfile(timings_file):
             logger.debug("Loading previous state")
@@ -144,8 +151,13 @@ def main(args):
             for x, y in timings.items():
                 timings[x] = list(y)
 
-            # Increment seed to make sure we get newly shuffled batches when training on large datasets
-            state['seed'] = state['seed'] + 10
+            if os.path.isfile(iterator_file):
+                # Continue the epoch exactly where it stopped, with the same seed
+                logger.debug("Loading previous iterator position")
+                iterator_state = cPickle.load(open(iterator_file, 'rb'))
+            else:
+                # Increment seed to make sure we get newly shuffled batches when training on large datasets
+                state['seed'] = state['seed'] + 10
 
         else:
             raise Exception("Cannot resume, cannot find files!")
@@ -211,12 +223,16 @@ def main(args):
     if model.add_latent_gaussian_per_utterance:
         eval_grads = model.build_eval_grads()
 
+    model.function_cache.report()
+
     random_sampler = search.RandomSampler(model)
     beam_sampler = search.BeamSampler(model) 
 
     logger.debug("Load data")
     train_data, \
     valid_data, = get_train_iterator(state)
+    if iterator_state:
+        train_data.set_state(iterator_state)
     train_data.start()
 
     # Start looping through the dataset
@@ -272,6 +288,7 @@ def main(args):
         x_reset = batch['x_reset']
         ran_cost_utterance = batch['ran_var_constutterance']
         ran_decoder_drop_mask = batch['ran_decoder_drop_mask']
+        x_dialogue_reset = batch['x_dialogue_reset']
 
         is_end_of_batch = False
         if numpy.sum(numpy.abs(x_reset)) < 1:
@@ -282,9 +299,9 @@ def main(args):
 
         if state['use_nce']:
             y_neg = rng.choice(size=(10, max_length, x_data.shape[1]), a=model.idim, p=model.noise_probs).astype('int32')
-            c, kl_divergence_cost, posterior_mean_variance = train_batch(x_data, x_data_reversed, y_neg, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask)
+            c, kl_divergence_cost, posterior_mean_variance = train_batch(x_data, x_data_reversed, y_neg, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask, x_dialogue_reset)
         else:
-            c, kl_divergence_cost, posterior_mean_variance = train_batch(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask)
+            c, kl_divergence_cost, posterior_mean_variance = train_batch(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask, x_dialogue_reset)
 
         # Print batch statistics
         print 'cost_sum', c
@@ -354,7 +371,7 @@ def main(args):
                     batch = add_random_variables_to_batch(model.state, model.rng, batch, None, False)
                     ran_cost_utterance = batch['ran_var_constutterance']
                     ran_decoder_drop_mask = batch['ran_decoder_drop_mask']
-                    softmax_cost, var_cost, grads_wrt_softmax, grads_wrt_kl_divergence_cost = eval_grads(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask)
+                    softmax_cost, var_cost, grads_wrt_softmax, grads_wrt_kl_divergence_cost = eval_grads(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask, x_dialogue_reset)
                     softmax_costs[k] = softmax_cost
                     var_costs[k] = var_cost
                     gradients_wrt_softmax[k, :, :] = grads_wrt_softmax
@@ -426,8 +443,9 @@ def main(args):
                     x_reset = batch['x_reset']
                     ran_cost_utterance = batch['ran_var_constutterance']
                     ran_decoder_drop_mask = batch['ran_decoder_drop_mask']
+                    x_dialogue_reset = batch['x_dialogue_reset']
 
-                    c, kl_term, c_list, kl_term_list, posterior_mean_variance = eval_batch(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask)
+                    c, kl_term, c_list, kl_term_list, posterior_mean_variance = eval_batch(x_data, x_data_reversed, max_length, x_cost_mask, x_reset, ran_cost_utterance, ran_decoder_drop_mask, x_dialogue_reset)
 
                     # Rehape into matrix, where rows are validation samples and columns are tokens
                     # Note that we use max_length-1 because we don't get a cost for the first token
@@ -475,7 +493,7 @@ def main(args):
                 if args.save_every_valid_iteration:
                     save(model, timings, '_' + str(step) + '_')
                 if args.auto_restart:
-                    save(model, timings, '_auto_')
+                    save(model, timings, '_auto_', train_data)
 
 
                 # We need to catch exceptions due to high numbers in exp
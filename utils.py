@@ -163,6 +163,11 @@ def OrthogonalInit(rng, sizeX, sizeY, sparsity=-1, scale=1):
     return values.astype(theano.config.floatX)
 
 def GrabProbs(classProbs, target, gRange=None):
+    """
+    Returns the probability of the target of every row of 'classProbs', flattened to a vector.
+    The probabilities are indexed directly, one per row, instead of taking the diagonal
+    of an (N x N) matrix.
+    """
     if classProbs.ndim > 2:
         classProbs = classProbs.reshape((classProbs.shape[0] * classProbs.shape[1], classProbs.shape[2]))
     else:
@@ -172,7 +177,7 @@ def GrabProbs(classProbs, target, gRange=None):
         tflat = target.flatten()
     else:
         tflat = target 
-    return T.diag(classProbs.T[tflat])
+    return classProbs[T.arange(tflat.shape[0]), tflat]
 
 def NormalInit(rng, sizeX, sizeY, scale=0.01, sparsity=-1):
     """ 
@@ -0,0 +1,132 @@
+"""
+Vocabulary of a model, loaded from a dictionary file created by convert-text2dict.py.
+
+The dictionary file is a pickled list of (word, word id, frequency, document frequency)
+tuples. Converting it to lookup tables is slow for large vocabularies, so the first load
+writes a compact binary sidecar file '<dictionary>.vocab.npz', which stores the words
+as one string and the frequencies as numpy arrays. Later loads read the sidecar instead.
+"""
+
+import os
+import cPickle
+import itertools
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+VOCAB_SUFFIX = '.vocab.npz'
+
+def dictionary_signature(path):
+    """
+    Returns the size and modification time of a dictionary file, which change whenever it is rewritten.
+    """
+    stat = os.stat(path)
+    return numpy.array([stat.st_size, stat.st_mtime], dtype='float64')
+
+class Vocabulary(object):
+    """
+    Vocabulary with consecutive word ids 0, ..., n-1.
+
+    'words' maps ids to words (a list), 'str_to_idx' maps words to ids (a dict), and 'freqs',
+    'dfs' and 'noise_probs' are numpy arrays with the frequency, document frequency and
+    probability under the NCE noise distribution (unigram distribution to the power 0.75)
+    of each word id.
+    """
+    def __init__(self, words, freqs, dfs):
+        self.words = list(words)
+        self.freqs = numpy.asarray(freqs, dtype='int64')
+        self.dfs = numpy.asarray(dfs, dtype='int64')
+        self.str_to_idx = dict(itertools.izip(self.words, itertools.count()))
+
+        if len(self.str_to_idx) != len(self.words):
+            raise ValueError('Dictionary contains duplicate words!')
+
+        self.noise_probs = self.freqs.astype('float64')
+        self.noise_probs /= numpy.sum(self.noise_probs)
+        self.noise_probs = self.noise_probs ** 0.75
+        self.noise_probs /= numpy.sum(self.noise_probs)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.str_to_idx
+
+    def words_to_ids(self, seq, unk_sym=0):
+        return [self.str_to_idx.get(word, unk_sym) for word in seq]
+
+    def ids_to_words(self, seq):
+        return [self.words[word_id] for word_id in seq]
+
+    def frequency_clusters(self, cutoffs, head_words=[]):
+        """
+        Partitions the word ids into clusters of decreasing frequency, e.g. for an adaptive softmax.
+        The words are ranked by frequency, after the words 'head_words' which are always ranked first.
+        The first cluster (the head) contains the words of rank 0, ..., cutoffs[0]-1, the cluster i
+        the words of rank cutoffs[i-1], ..., cutoffs[i]-1 and the last cluster all remaining words.
+        Returns a list of numpy arrays with the word ids of each cluster.
+        """
+        if list(cutoffs) != sorted(set(cutoffs)) or cutoffs[0] <= 0 or cutoffs[-1] >= len(self.words):
+            raise ValueError('Cluster cutoffs must be increasing and between 0 and the vocabulary size!')
+
+        head_words = numpy.unique(numpy.asarray(head_words, dtype='int64'))
+        if len(head_words) > cutoffs[0]:
+            raise ValueError('Head cluster is smaller than the number of words always in the head!')
+
+        # Words of equal frequency are ranked by word id
+        ranking = numpy.argsort(-self.freqs, kind='mergesort')
+        ranking = numpy.concatenate([head_words, ranking[~numpy.in1d(ranking, head_words)]])
+
+        bounds = [0] + list(cutoffs) + [len(self.words)]
+        return [ranking[bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1)]
+
+    @staticmethod
+    def from_raw_dict(raw_dict):
+        """
+        Creates a vocabulary from a list of (word, word id, frequency, document frequency) tuples.
+        """
+        raw_dict = sorted(raw_dict, key=lambda x: x[1])
+        if [x[1] for x in raw_dict] != range(len(raw_dict)):
+            raise ValueError('Dictionary word ids are not consecutive!')
+        return Vocabulary([x[0] for x in raw_dict], [x[2] for x in raw_dict], [x[3] for x in raw_dict])
+
+    def to_raw_dict(self):
+        return [(word, word_id, int(self.freqs[word_id]), int(self.dfs[word_id])) for word_id, word in enumerate(self.words)]
+
+    def save(self, path):
+        """
+        Writes the pickled dictionary file 'path' and its binary sidecar file.
+        """
+        with open(path, 'wb') as f:
+            cPickle.dump(self.to_raw_dict(), f, protocol=cPickle.HIGHEST_PROTOCOL)
+        self.save_sidecar(path)
+
+    def save_sidecar(self, path):
+        # Words never contain white space, since they are obtained by splitting the text on white space
+        tmp_filename = path + '.vocab.tmp%d.npz' % os.getpid()
+        numpy.savez(tmp_filename, words=numpy.array('\n'.join(self.words)), freqs=self.freqs, dfs=self.dfs, \
+                    signature=dictionary_signature(path))
+        os.rename(tmp_filename, path + VOCAB_SUFFIX)
+
+    @staticmethod
+    def load(path):
+        """
+        Loads the vocabulary of a dictionary file, from its sidecar file if it is up to date.
+        Otherwise the dictionary file is unpickled, and the sidecar file is written.
+        """
+        sidecar = path + VOCAB_SUFFIX
+        if os.path.isfile(sidecar):
+            data = numpy.load(sidecar)
+            if numpy.array_equal(data['signature'], dictionary_signature(path)):
+                words = str(data['words'])
+                return Vocabulary(words.split('\n') if len(words) else [], data['freqs'], data['dfs'])
+            logger.info("Vocabulary %s is out of date." % sidecar)
+
+        vocabulary = Vocabulary.from_raw_dict(cPickle.load(open(path, 'rb')))
+        try:
+            vocabulary.save_sidecar(path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not save vocabulary to %s: %s" % (sidecar, e))
+        return vocabulary